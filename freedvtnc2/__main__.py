@@ -1,12 +1,19 @@
-from .modem import FreeDVRX, FreeDVTX, Modems, Packet
+from .modem import FreeDVRX, FreeDVTX, Modems, Packet, RXGovernor
+from .linkquality import LinkQualityTable
+from .arq import ArqSender
+from .compression import Compressor, zstandard
+from .txqueue import TxQueue, default_limits, BULK
 from . import audio
+from .backends import is_uri
 from .shell import FreeDVShell
 import logging
 import configargparse
 from . import tnc
 import time
 from . import rigctl
+from . import offline
 import traceback
+import sys
 from prompt_toolkit.formatted_text import HTML, to_formatted_text
 
 logging.basicConfig()
@@ -18,16 +25,36 @@ def main():
     p.add('--no-cli', action='store_true', env_var="FREEDVTNC2_CLI")
     p.add('--list-audio-devices', action='store_true', default=False)
 
+    p.add('--rx-file', nargs="+", default=None, help="Demodulate raw 16 bit mono audio files (- for stdin) as fast as possible and write decoded packets to stdout, then exit")
+    p.add('--rx-file-format', choices=["json", "kiss"], default="json", help="Output format for --rx-file. json includes mode and snr metadata, kiss only outputs KISS data frames")
+    p.add('--rx-file-sample-rate', type=int, default=8000, help="Sample rate of the --rx-file audio")
+    p.add('--rx-file-workers', type=int, default=1, help="Number of processes used to demodulate --rx-file files in parallel")
+
     p.add('--log-level', type=str, default="INFO", env_var="FREEDVTNC2_LOG_LEVEL", choices=logging._nameToLevel.keys())
 
-    p.add('--input-device', type=str, default=None, env_var="FREEDVTNC2_INPUT_DEVICE")
-    p.add('--output-device', type=str, default=None, env_var="FREEDVTNC2_OUTPUT_DEVICE")
+    p.add('--input-device', type=str, default=None, env_var="FREEDVTNC2_INPUT_DEVICE", help="Sound card name or id, or file:PATH, stdio: or udp://HOST:PORT for raw 16 bit audio (add ?rate=8000&channels=1&pace=realtime|fast to change the format and pacing)")
+    p.add('--output-device', type=str, default=None, env_var="FREEDVTNC2_OUTPUT_DEVICE", help="Same as --input-device")
     p.add('--output-volume', type=float, default=0, env_var="FREEDVTNC2_OUTPUT_DB", help="in db. postive = louder, negative = quiter")
 
+    p.add('--frames-per-buffer', type=str, default="4096", env_var="FREEDVTNC2_FRAMES_PER_BUFFER", help="Sound card frames per callback for input and output. Smaller cuts latency but can drop out on slow machines. auto starts small and grows whenever audio drops out")
+    p.add('--full-duplex', action="store_true", default=False, env_var="FREEDVTNC2_FULL_DUPLEX", help="Use one sound card stream for both input and output. Needs the same device for both, opened with the smaller of its input and output channel counts. --output-device defaults to --input-device")
+    p.add('--resampler', choices=["polyphase", "linear"], default="polyphase", env_var="FREEDVTNC2_RESAMPLER", help="How sound card audio is converted to and from the modem's sample rate. linear matches older versions (audioop.ratecv) but lets noise above 4kHz alias into the modem")
     p.add('--mode', type=str, choices=[x.name for x in Modems], default=Modems.DATAC1.name, help="The TX mode for the modem. The modem will receive all modes at once")
     p.add('--follow', action="store_true", default=False, env_var="FREEDVTNC2_FOLLOW", help="When enabled change TX mode to the mode being received. This is useful for stations operating automatically.")
-    p.add('--max-packets-combined', default=5, type=int, env_var="FREEDVTNC2_MAX_PACKETS", help="How many kiss packets to combine into a single transmission")
+    p.add('--adaptive', action="store_true", default=False, env_var="FREEDVTNC2_ADAPTIVE", help="Pick the TX mode for each destination from how well we hear that station. Stations we haven't heard use --mode")
+    p.add('--rx-modes', type=str, default=",".join([x.name for x in Modems]), env_var="FREEDVTNC2_RX_MODES", help="Comma separated list of modes to receive")
+    p.add('--rx-idle-minutes', type=float, default=0, env_var="FREEDVTNC2_RX_IDLE_MINUTES", help="Demote RX modes that haven't had sync for this many minutes to a low duty schedule to save CPU. 0 disables")
+    p.add('--rx-threads', action="store_true", default=False, env_var="FREEDVTNC2_RX_THREADS", help="Run each RX modem on its own thread. Useful on multi core machines like the raspberrypi")
+    p.add('--max-packets-combined', default=5, type=int, env_var="FREEDVTNC2_MAX_PACKETS", help="Most kiss packets that can start in a single modem frame")
 
+    p.add('--arq', action="store_true", default=False, env_var="FREEDVTNC2_ARQ", help="Send packets that span multiple modem frames with ARQ so only lost frames are resent. Receiving ARQ is always enabled")
+    p.add('--fec-repair', default=0, type=float, env_var="FREEDVTNC2_FEC_REPAIR", help="Add this many repair frames per data frame to packets that span multiple modem frames (eg 0.25 adds one for every four) so they can be decoded even if some frames are lost. 0 disables. Not used for packets sent with --arq")
+    p.add('--compression', choices=["none", "zlib", "zstd"], default="none", env_var="FREEDVTNC2_COMPRESSION", help="Compress KISS and chat packets when it makes them smaller. Receiving compressed packets is always enabled. zstd needs the zstandard package")
+    p.add('--frames-per-burst', default=1, type=int, env_var="FREEDVTNC2_FRAMES_PER_BURST", help="Modem frames sent between each preamble and postamble. More frames per burst spends less airtime on preambles. Must match the other stations")
+    p.add('--packing-window', default=16, type=int, env_var="FREEDVTNC2_PACKING_WINDOW", help="How many queued packets can be reordered to fill modem frames. 0 packs in queue order with the original packer")
+    p.add('--tx-queue-kib', default=1024, type=int, env_var="FREEDVTNC2_TX_QUEUE_KIB", help="Most KiB of bulk (non control, non chat) packets to queue. KISS clients are held back when it's full")
+    p.add('--tx-queue-seconds', default=600, type=float, env_var="FREEDVTNC2_TX_QUEUE_SECONDS", help="Most estimated airtime of bulk packets to queue")
+    p.add('--max-tx-seconds', default=60, type=float, env_var="FREEDVTNC2_MAX_TX_SECONDS", help="Longest transmission. Packets queued while transmitting are added to it (without PTT delays) up to this long, ARQ resends included. 0 releases PTT after every batch")
     p.add('--pts', default=False, action='store_true', env_var="FREEDVTNC2_PTS", help="Disables TCP and instead creates a PTS 'fake serial' interface")
     p.add('--kiss-tcp-port', default=8001, type=int, env_var="FREEDVTNC2_KISS_TCP_PORT")
     p.add('--kiss-tcp-address', default="127.0.0.1", type=str, env_var="FREEDVTNC2_KISS_TCP_ADDRESS")
@@ -41,10 +68,34 @@ def main():
     
     options = p.parse_args()
 
+    rx_modes = [x.strip().upper() for x in options.rx_modes.split(",") if x.strip()]
+    for rx_mode in rx_modes:
+        if rx_mode not in Modems.__members__:
+            p.error(f"--rx-modes must be a comma separated list of {', '.join([x.name for x in Modems])}")
+
+    if options.frames_per_buffer != "auto":
+        if not options.frames_per_buffer.isdigit() or int(options.frames_per_buffer) < 1:
+            p.error("--frames-per-buffer must be a number of frames or auto")
+        options.frames_per_buffer = int(options.frames_per_buffer)
+
+    stdio_audio = [x for x in (options.input_device, options.output_device) if x and x.startswith("stdio:")]
+    if stdio_audio and not options.no_cli:
+        p.error("stdio: audio devices need --no-cli")
+
+    if options.frames_per_burst < 1:
+        p.error("--frames-per-burst must be at least 1")
+
+    if options.compression == "zstd" and zstandard is None:
+        p.error("--compression zstd needs the zstandard package (pip install zstandard)")
+
     logger = logging.getLogger()
     logger.setLevel(level=options.log_level)
     logging.debug("Starting")
 
+    if options.rx_file: # offline mode - logs stay on stderr so stdout is just the decoded packets
+        offline.run(options, modes=rx_modes)
+        return
+
 
     class LogHandler(logging.StreamHandler):
         shell = None
@@ -61,7 +112,8 @@ def main():
                     msg += HTML(f": <log.{record.levelname.lower()}.msg>{{}}</log.{record.levelname.lower()}.msg>\n").format(message).value
 
             if options.no_cli:
-                print(self.format(record))
+                # stdout might be carrying audio
+                print(self.format(record), file=sys.stderr if stdio_audio else sys.stdout)
             else:
                 if not self.shell:
                     print(self.format(record))
@@ -92,7 +144,20 @@ def main():
             audio.devices
         )
     else:
-        modem_tx = FreeDVTX(modem=options.mode, max_packets_combined=options.max_packets_combined)
+        if not (is_uri(options.input_device) and is_uri(options.output_device)):
+            audio.warm_up() # PortAudio probes every sound card - let it run while the modems are set up
+        links = LinkQualityTable()
+        modem_tx = FreeDVTX(
+            modem=options.mode,
+            max_packets_combined=options.max_packets_combined,
+            packing_window=options.packing_window,
+            links=links,
+            adaptive=options.adaptive,
+            arq=ArqSender() if options.arq else None,
+            fec_repair=options.fec_repair,
+            compressor=Compressor(options.compression) if options.compression != "none" else None,
+            frames_per_burst=options.frames_per_burst
+        )
         logging.info(f"Initialised TX FreeDV Modem - version: {modem_tx.modem.version} mode: {modem_tx.modem.modem_name}")
         def tx(data):
             try:
@@ -110,6 +175,7 @@ def main():
         def rx(data: Packet):
             logging.debug(f"[{str(data.mode)}] {str(data.header)} / {str(data.data)}")
             try:
+                links.heard(data)
                 if data.header == 255:
                     tnc_interface.tx(data.data)
                 elif data.header == 254: # Chat interface
@@ -123,6 +189,9 @@ def main():
                         )
                     else:
                         print(f"\n<{call.decode()}> {message.decode()}")
+                elif data.header == 253: # ARQ NACK
+                    if modem_tx.arq:
+                        modem_tx.arq.nack(data.data)
                 
                 if options.follow and data.mode != modem_tx.modem.modem_name:
                     logging.info(f"Follow mode active. Switching to {data.mode}")
@@ -141,11 +210,25 @@ def main():
         
         
 
+        def tx_nack(packet: Packet):
+            if "output_device" in locals():
+                output_device.write(packet)
+
         def inhibit(state):
             if "output_device" in  locals():
                 output_device.inhibit = state
 
-        modem_rx = FreeDVRX(callback=rx, progress=progress, inhibit=inhibit)
+        modem_rx = FreeDVRX(
+            callback=rx,
+            progress=progress,
+            inhibit=inhibit,
+            threaded=options.rx_threads,
+            modes=rx_modes,
+            governor=RXGovernor(options.rx_idle_minutes*60) if options.rx_idle_minutes else None,
+            frames_per_burst=options.frames_per_burst
+        )
+        modem_rx.reassembler.dropped = links.dropped
+        modem_rx.reassembler.nack = tx_nack
         for rx_modem in modem_rx.modems:
             logging.info(f"Initialised RX FreeDV Modem - version: {modem_tx.modem.version} mode: {rx_modem.modem_name}")
 
@@ -167,19 +250,32 @@ def main():
             ptt_trigger = None
             ptt_release = None
         
-        input_device = audio.InputDevice(modem_rx.write, modem_rx.sample_rate, name_or_id=input_device_name_or_id)
+        input_device = audio.InputDevice(modem_rx.write, modem_rx.sample_rate, name_or_id=input_device_name_or_id, resampler=options.resampler, frames_per_buffer=options.frames_per_buffer, own_stream=not options.full_duplex)
         logging.info(f"Initialised Input Audio: {input_device.device.name}")
+        if options.full_duplex and output_device_name_or_id is None:
+            output_device_name_or_id = input_device.device.id
+        limits = default_limits()
+        limits[BULK].max_bytes = options.tx_queue_kib * 1024
+        limits[BULK].max_seconds = options.tx_queue_seconds
         output_device = audio.OutputDevice(
             modem_rx.sample_rate,
             modem = modem_tx,
+            send_queue=TxQueue(airtime=modem_tx.airtime, limits=limits),
             name_or_id=output_device_name_or_id,
             ptt_release=ptt_release,
             ptt_trigger=ptt_trigger,
             ptt_on_delay_ms=options.ptt_on_delay_ms,
             ptt_off_delay_ms=options.ptt_off_delay_ms,
-            db=options.output_volume
+            db=options.output_volume,
+            resampler=options.resampler,
+            max_tx_seconds=options.max_tx_seconds,
+            frames_per_buffer=options.frames_per_buffer,
+            own_stream=not options.full_duplex
         )
         logging.info(f"Initialised Output Audio: {output_device.device.name}")
+        if options.full_duplex:
+            duplex = audio.DuplexStream(input_device, output_device, frames_per_buffer=options.frames_per_buffer)
+            logging.info(f"Initialised Full Duplex Audio: {duplex.device.name}")
 
         try:
             if not options.no_cli:
@@ -195,7 +291,11 @@ def main():
             log_handler.shell = None
             if "rig" in locals():
                 rig.ptt_disable()
+            if "duplex" in locals():
+                duplex.close()
             input_device.close()
             output_device.close()
+            modem_rx.close()
+            modem_tx.close()
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,84 @@
+"""
+Sender side of selective retransmission (ARQ) for packets that span multiple modem frames.
+
+ARQ packets are sent on their own frames (see framing.ARQ_HEADER) and the modulated audio for every frame is kept.
+When the receiver NACKs a packet only the missing frames (plus the start frame, so the receiver knows which packet
+they belong to) are put into new bursts and played again - nothing is packed or modulated a second time.
+"""
+from collections import OrderedDict
+from threading import Lock
+import logging
+import random
+import zlib
+from .framing import Packet, ARQ_HEADER, ARQ_NACK_HEADER, ARQ_OVERHEAD, SEQ_MODULO, arq_frame_count, header_bytes
+
+class ArqSender():
+    """
+    Wraps packets for ARQ and caches their frame audio. The cache holds at most max_bytes of audio, the oldest
+    packets are forgotten first.
+    """
+    def __init__(self, max_bytes: int = 64*1024*1024):
+        self.max_bytes = max_bytes
+        self.cache: OrderedDict[bytes, tuple[str, list[bytes]]] = OrderedDict()
+        self.cached_bytes = 0
+        self.next_id = random.randrange(65536) # so ids from a restarted TNC don't match packets the other end still holds
+        self.pending: list[tuple[str, list[bytes]]] = [] # frames to resend, by mode
+        self.lock = Lock() # NACKs arrive on the RX thread
+        self.retransmitted_frames = 0
+
+    def eligible(self, packet: Packet, payload_size: int) -> bool:
+        """
+        Only packets that need more than one frame benefit from ARQ. Continuation frames are placed by sequence number so
+        the packet can't need more frames than there are sequence numbers.
+        """
+        if header_bytes(packet)[0] in (ARQ_HEADER, ARQ_NACK_HEADER):
+            return False
+        return 1 < arq_frame_count(len(packet.data) + ARQ_OVERHEAD, payload_size) <= SEQ_MODULO + 1
+
+    def wrap(self, packet: Packet) -> tuple[bytes, Packet]:
+        """
+        Returns the packet id and the ARQ packet to send in place of packet
+        """
+        packet_id = self.next_id.to_bytes(2)
+        self.next_id = (self.next_id + 1) % 65536
+        data = packet_id + zlib.crc32(packet.data).to_bytes(4) + header_bytes(packet) + packet.data
+        return packet_id, Packet(data, header=bytes([ARQ_HEADER]))
+
+    def store(self, packet_id: bytes, mode: str, frames: list[bytes]) -> None:
+        """
+        Keep the modulated audio of each frame of a packet (in frame order, without preambles or postambles)
+        """
+        with self.lock:
+            if packet_id in self.cache:
+                self.cached_bytes -= sum(len(x) for x in self.cache.pop(packet_id)[1])
+            self.cache[packet_id] = (mode, frames)
+            self.cached_bytes += sum(len(x) for x in frames)
+            while self.cached_bytes > self.max_bytes and len(self.cache) > 1:
+                _, (_, evicted) = self.cache.popitem(last=False)
+                self.cached_bytes -= sum(len(x) for x in evicted)
+
+    def nack(self, data: bytes) -> int:
+        """
+        Queues the frames listed in a NACK for resending. Returns the number of frames queued.
+        """
+        packet_id, bitmap = bytes(data[:2]), data[2:]
+        with self.lock:
+            cached = self.cache.get(packet_id)
+            if cached is None:
+                logging.debug(f"NACK for unknown ARQ packet {packet_id.hex()}")
+                return 0
+            mode, frames = cached
+            missing = [index for index in range(min(len(bitmap)*8, len(frames))) if bitmap[index // 8] >> (index % 8) & 1]
+            if not missing:
+                return 0
+            indexes = sorted(set([0] + missing)) # the start frame tells the receiver which packet the frames are for
+            self.pending.append((mode, [frames[x] for x in indexes]))
+            self.retransmitted_frames += len(indexes)
+        logging.info(f"Resending {len(missing)} frames of ARQ packet {packet_id.hex()} on {mode}")
+        return len(indexes)
+
+    def take_pending(self) -> list[tuple[str, list[bytes]]]:
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+        return pending
@@ -1,29 +1,87 @@
-import pyaudio
-from dataclasses import dataclass
+try:
+    import pyaudio
+except ImportError: # headless installs can still use the file:, stdio: and udp: backends
+    pyaudio = None
 from tabulate import tabulate
 import logging
-import audioop as pyaudioop
 import time
-from threading import Lock, Thread
+from collections import deque
+from threading import Lock, RLock, Thread
 from typing import Callable
-#from pydub import pyaudioop
-import pydub
+import ctypes
 import math
+import traceback
 from .modem import FreeDVTX, Packet
+from .ringbuffer import RingBuffer
+from .dsp import InputDSP, OutputDSP
+from .txqueue import TxQueue
+from .backends import AudioDevice, StreamBackend, SAMPLE_BYTES, CONTINUE, INPUT_OVERFLOW, OUTPUT_UNDERFLOW
+from . import backends
 
-p = pyaudio.PyAudio()
+AUTO_FRAMES_PER_BUFFER = (512, 8192) # where auto tuning starts and the most it will grow to
+TUNE_SECONDS = 2 # how often auto tuning checks for xruns
 
-FORMAT = pyaudio.paInt16
+class BufferTuner():
+    """
+    Keeps track of a stream's frames_per_buffer. A number is used as is. "auto" starts small and doubles it, reopening
+    the stream, whenever xruns() goes up. Backends that can't be reopened (tunable False) stay at the starting size.
+    """
+    def __init__(self, frames_per_buffer: int|str, xruns: Callable[[], int], reopen: Callable[[int], None], name: str,
+                 tunable: bool = True):
+        self.auto = frames_per_buffer == "auto" and tunable
+        self.frames_per_buffer = AUTO_FRAMES_PER_BUFFER[0] if frames_per_buffer == "auto" else int(frames_per_buffer)
+        self.xruns = xruns
+        self.reopen = reopen
+        self.name = name
+        self.running = self.auto
+        if self.auto:
+            Thread(target=self.run, daemon=True, name=f"{name}-tuner").start()
+
+    def run(self):
+        seen = self.xruns()
+        while self.running:
+            time.sleep(TUNE_SECONDS)
+            if self.running and self.xruns() != seen and self.frames_per_buffer < AUTO_FRAMES_PER_BUFFER[1]:
+                self.frames_per_buffer *= 2
+                logging.info(f"Audio {self.name} is dropping out - increasing frames per buffer to {self.frames_per_buffer}")
+                self.reopen(self.frames_per_buffer)
+            seen = self.xruns()
+
+class Latency():
+    """
+    Running latency measurement in ms - the last, a smoothed average and the worst seen
+    """
+    def __init__(self):
+        self.last = None
+        self.average = None
+        self.worst = None
+
+    def add(self, ms: float):
+        self.last = ms
+        self.average = ms if self.average is None else self.average * 0.9 + ms * 0.1
+        self.worst = ms if self.worst is None else max(self.worst, ms)
+
+    def __str__(self):
+        if self.last is None:
+            return "-"
+        return f"{self.last:.0f} (avg {self.average:.0f}, max {self.worst:.0f})"
+
+    @property
+    def short(self) -> str:
+        """
+        The average for the status bar
+        """
+        return "-" if self.average is None else f"{self.average:.0f}ms"
 
 
 class AudioDevices:
     """
-    Gets info of all audio devices
+    Gets info of all audio devices, indexed by id and by name
     """
-    devices = []
-    def __init__(self):
-        for x in range(p.get_device_count()):
-            device_info = p.get_device_info_by_index(x)
+    def __init__(self, pa: "pyaudio.PyAudio"):
+        self.devices: list[AudioDevice] = []
+        for x in range(pa.get_device_count()):
+            device_info = pa.get_device_info_by_index(x)
             self.devices.append(AudioDevice(
                 input_channels = device_info['maxInputChannels'],
                 output_channels = device_info['maxOutputChannels'],
@@ -31,6 +89,37 @@ class AudioDevices:
                 name = device_info['name'].strip(),
                 id = x
             ))
+        self.by_id = {device.id: device for device in self.devices}
+        self.by_name: dict[str, list[AudioDevice]] = {} # names aren't always unique
+        for device in self.devices:
+            self.by_name.setdefault(device.name, []).append(device)
+
+        # machines without a sound card (or a default one) are fine until a device is opened
+        self.default_input = self.default_device(pa.get_default_input_device_info)
+        self.default_output = self.default_device(pa.get_default_output_device_info)
+
+    def default_device(self, get_info: Callable[[], dict]) -> AudioDevice|None:
+        try:
+            return self.by_id.get(get_info()['index'])
+        except IOError:
+            return None
+
+    def find(self, name_or_id: str|int|None, output: bool) -> AudioDevice:
+        """
+        The device with this name or id that has input (or output) channels. None picks the default device
+        """
+        direction = "output" if output else "input"
+        if name_or_id is None:
+            device = self.default_output if output else self.default_input
+            if device is None:
+                raise ValueError(f"There's no default {direction} audio device")
+            return device
+        candidates = [self.by_id[name_or_id]] if name_or_id in self.by_id else self.by_name.get(name_or_id, [])
+        for device in candidates:
+            if (device.output_channels if output else device.input_channels) > 0:
+                return device
+        raise ValueError(f"Could not find audio device {name_or_id}")
+
     def __str__(self):
         rows = [
             ["Id","Name","In", "Out", "SampleRate"]
@@ -46,22 +135,74 @@ class AudioDevices:
                 ]
             )
         return tabulate(rows, tablefmt="plain", headers="firstrow")
-        
-@dataclass
-class AudioDevice:
+
+# PortAudio probes every sound card when it's initialised, which takes a while on a Pi and is wasted on --help,
+# --rx-file and the tests. So it's only done the first time something needs it.
+_init_lock = RLock()
+_pyaudio: "pyaudio.PyAudio|None" = None
+_devices: AudioDevices|None = None
+
+def get_pyaudio() -> "pyaudio.PyAudio":
+    global _pyaudio
+    with _init_lock:
+        if _pyaudio is None:
+            if pyaudio is None:
+                raise ValueError("PyAudio isn't installed - only file:, stdio: and udp: audio devices can be used")
+            start = time.perf_counter()
+            _pyaudio = pyaudio.PyAudio()
+            logging.debug(f"Initialised PortAudio in {(time.perf_counter() - start)*1000:.0f}ms")
+        return _pyaudio
+
+def get_devices() -> AudioDevices:
+    global _devices
+    with _init_lock:
+        if _devices is None:
+            _devices = AudioDevices(get_pyaudio())
+        return _devices
+
+class PyAudioBackend():
     """
-    Information about an audio device
-    """ 
-    input_channels: int
-    output_channels: int
-    sample_rate: int
-    name: str
-    id: int
-   
-devices = AudioDevices()
+    Sound cards through PortAudio. See backends.py for the others
+    """
+    tunable = True # streams can be closed and opened again with a different frames_per_buffer
+    def find(self, name_or_id: str|int|None, output: bool) -> AudioDevice:
+        return get_devices().find(name_or_id, output)
+
+    def open(self, device: AudioDevice, channels: int, input: bool, output: bool, callback: backends.Callback,
+             frames_per_buffer: int) -> "pyaudio.Stream":
+        return get_pyaudio().open(format=pyaudio.paInt16,
+                    channels=channels,
+                    rate=device.sample_rate,
+                    output=output,
+                    input=input,
+                    input_device_index=device.id if input else None,
+                    output_device_index=device.id if output else None,
+                    stream_callback=callback,
+                    frames_per_buffer=frames_per_buffer
+                )
 
-default_input_device = devices.devices[p.get_default_input_device_info()['index']]
-default_output_device = devices.devices[p.get_default_output_device_info()['index']]
+def get_backend(name_or_id: str|int|None) -> PyAudioBackend|StreamBackend:
+    return backends.from_uri(name_or_id) or PyAudioBackend()
+
+def warm_up() -> Thread:
+    """
+    Initialises PortAudio and lists devices in the background so it overlaps with the rest of startup
+    """
+    thread = Thread(target=get_devices, daemon=True, name="audio-init")
+    thread.start()
+    return thread
+
+def __getattr__(name: str):
+    # the module level globals that used to be set up on import
+    if name == "p":
+        return get_pyaudio()
+    if name == "devices":
+        return get_devices()
+    if name == "default_input_device":
+        return get_devices().default_input
+    if name == "default_output_device":
+        return get_devices().default_output
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 class InputDevice():
@@ -69,31 +210,28 @@ class InputDevice():
     Handles receiving audio from an input device
 
     Sample rate is the expected modem sample rate
+
+    The PortAudio callback only copies samples into a ring buffer. Level metering, resampling (see dsp.py) and
+    demodulation happen on a separate DSP thread so that slow demodulation can't stall the audio callback.
     """
 
-    rate_state = None # used for sample rate conversions
     input_level = -99
 
-    def __init__(self, callback: Callable[[bytes], None], sample_rate:int, name_or_id:str|int|None=None):
+    def __init__(self, callback: Callable[[bytes], None], sample_rate:int, name_or_id:str|int|None=None, buffer_seconds:float=2, resampler:str="polyphase", frames_per_buffer:int|str=4096, own_stream:bool=True):
         self.sample_rate = sample_rate
         self.callback = callback
-        self.bit_depth = pyaudio.get_sample_size(FORMAT)
+        self.bit_depth = SAMPLE_BYTES
+
+        # counters for when we fall behind real time
+        self.input_overflows = 0 # PortAudio reported it dropped input before we got to it
+        self.last_callback = time.monotonic()
+        self.latency = Latency() # from the oldest sample being captured to it being demodulated
 
         if type(name_or_id) == str:
             name_or_id = name_or_id.strip()
 
-        if  name_or_id != None:
-            try:
-                self.device = next(
-                    device for device in devices.devices
-                    if (device.name == name_or_id or
-                    device.id == name_or_id) and device.input_channels > 0
-                )
-            except StopIteration:
-                raise ValueError(f"Could not find audio device {name_or_id}")
-        else:
-            self.device = default_input_device
-            
+        self.backend = get_backend(name_or_id)
+        self.device = self.backend.find(name_or_id, output=False)
 
         logging.debug(f"Opening {self.device.name} for input")
 
@@ -104,74 +242,120 @@ class InputDevice():
         if self.device.sample_rate < sample_rate:
             logging.critical(f"Input audio device sample rate {self.device.sample_rate} is less than modems sample rate {sample_rate} - this will cause problems")
 
-        self.stream = p.open(format=FORMAT,
-                    channels=self.device.input_channels,
-                    rate=self.device.sample_rate,
-                    output=False,
-                    input=True,
-                    stream_callback=self.pa_callback,
-                    input_device_index=self.device.id,
-                    frames_per_buffer=4096
-                )
+        self.resampler = resampler
+        self.dsp = InputDSP(self.device.input_channels, self.device.sample_rate, sample_rate, resampler=resampler)
+        self.ring = RingBuffer(int(buffer_seconds * self.device.sample_rate) * self.device.input_channels * self.bit_depth)
+        self.dsp_buffer = memoryview(bytearray(self.ring.capacity))
+        self.running = True
+        self.dsp_thread = Thread(target=self.run_dsp, daemon=True, name="input-dsp")
+        self.dsp_thread.start()
+
+        self.bytes_per_second = self.device.sample_rate * self.device.input_channels * self.bit_depth
+        self.own_stream = own_stream # False when a DuplexStream opens the stream and calls pa_callback
+        # free running file/pipe input waits for the DSP thread rather than losing audio. Never for sound cards
+        self.wait_for_room = getattr(self.backend, "pace", None) == "fast"
+        self.stream = None
+        self.stream_latency = 0 # seconds. Kept here as the DSP thread can't call into a stream that's being reopened
+        self.tuner = None
+        if own_stream:
+            self.tuner = BufferTuner(frames_per_buffer, lambda: self.input_overflows, self.open_stream, "input",
+                                     tunable=self.backend.tunable)
+            self.open_stream(self.tuner.frames_per_buffer)
+
+    def use_channels(self, channels: int):
+        """
+        Captures channels channels instead - for a DuplexStream, before it opens the stream. The ring already has room
+        as it's never more than were opened with
+        """
+        self.device.input_channels = channels
+        self.dsp = InputDSP(channels, self.device.sample_rate, self.sample_rate, resampler=self.resampler)
+        self.bytes_per_second = self.device.sample_rate * channels * self.bit_depth
+
+    def open_stream(self, frames_per_buffer: int):
+        if self.stream:
+            self.stream.close()
+        self.stream = self.backend.open(self.device, self.device.input_channels, input=True, output=False,
+                                        callback=self.pa_callback, frames_per_buffer=frames_per_buffer)
+        self.stream_latency = self.stream.get_input_latency()
+        logging.debug(f"Input stream latency {self.stream_latency*1000:.0f}ms with {frames_per_buffer} frames per buffer")
+
+    @property
+    def overruns(self) -> int:
+        """
+        Blocks of audio lost either in PortAudio or because the DSP thread couldn't keep up
+        """
+        return self.input_overflows + self.ring.overruns
 
     def close(self):
-        self.stream.close()
+        if self.own_stream:
+            self.tuner.running = False
+            self.stream.close()
+        self.running = False
+        self.ring.data_ready.set()
+        self.dsp_thread.join()
 
     def __enter__(self):
-        pass
+        return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
 
     def pa_callback(self, in_data: bytes, frame_count: int, time_info, status_flag):
-        max_audio = pyaudioop.max(in_data,pyaudio.get_sample_size(FORMAT))
-        if max_audio:
-            self.input_level = 20*math.log10(max_audio/(2**(self.bit_depth*8-1)))
-        else:
-            self.input_level = -99
-
-        if self.device.input_channels == 2:
-            in_data = pyaudioop.tomono(
-                in_data,
-                pyaudio.get_sample_size(FORMAT),
-                1,
-                0
-            )
+        if status_flag & INPUT_OVERFLOW:
+            self.input_overflows += 1
+        while self.wait_for_room and self.ring.free < len(in_data) and self.running:
+            time.sleep(0.005)
+        # only whole blocks are written so the DSP thread never sees half a sample
+        self.ring.write(in_data, partial=False)
+        self.last_callback = time.monotonic()
+        return (None, CONTINUE)
+
+    def run_dsp(self):
+        reported_overruns = 0
+        while self.running:
+            if not self.ring.wait(0.1):
+                continue
+            in_data = self.dsp_buffer[:self.ring.read_into(self.dsp_buffer)]
+
+            if self.overruns != reported_overruns:
+                logging.warning(f"Input audio overrun - audio has been lost. Total overruns: {self.overruns}")
+                reported_overruns = self.overruns
 
-        if self.device.sample_rate != self.sample_rate:
-            (in_data, self.rate_state) = pyaudioop.ratecv(
-                in_data, 
-                pyaudio.get_sample_size(FORMAT),
-                1,
-                self.device.sample_rate,
-                self.sample_rate,
-                self.rate_state
+            try:
+                self.process(in_data)
+            except:
+                logging.critical(traceback.format_exc())
+            # the oldest sample in in_data was captured its duration before the last callback, plus PortAudio's latency
+            self.latency.add(
+                (time.monotonic() - self.last_callback + len(in_data) / self.bytes_per_second + self.stream_latency) * 1000
             )
 
+    def process(self, in_data: bytes):
+        in_data = self.dsp.process(in_data)
+        self.input_level = self.dsp.level
         self.callback(in_data)
-
-        return (None, pyaudio.paContinue)
     
 class OutputDevice():
     """
     Handles sending audio from an output device
 
     Sample rate is the expected modem sample rate
-    """
-
-    rate_state = None # used for sample rate conversions
 
-    buffer = bytearray()
+    Modulated audio goes into a preallocated ring buffer. The PortAudio callback only copies one block out of it so
+    its work doesn't depend on how much audio is queued, and it never takes a lock - it checks the send queue through
+    TxQueue.waiting and output_buffer_lock is only shared by the writers.
+    """
 
     output_buffer_lock = Lock()
-    send_queue_lock = Lock()
 
     inhibit = False
     output_buffer_thread = None
+    clear_count = 0 # incremented by clear() so the modulation thread knows to stop
+    cleared = 0 # the last clear_count the callback has discarded the ring for
 
     @property
     def queue_ms(self):
-        return (len(self.buffer)/self.bit_depth/self.device.sample_rate)*1000
+        return len(self.ring) / self.bytes_per_ms
 
     def __init__(self, 
                  sample_rate: int,
@@ -181,31 +365,31 @@ class OutputDevice():
                  ptt_release:Callable[[],None]=None, 
                  ptt_on_delay_ms:int=0, 
                  ptt_off_delay_ms:int=0,
-                 db:float=0
+                 db:float=0,
+                 lookahead_ms:int=1000,
+                 send_queue:TxQueue|None=None,
+                 resampler:str="polyphase",
+                 max_tx_seconds:float=60,
+                 chain_margin_ms:int=300,
+                 frames_per_buffer:int|str=4096,
+                 own_stream:bool=True
                  ):
         self.sample_rate = sample_rate
-        self.bit_depth = pyaudio.get_sample_size(FORMAT)
+        self.lookahead_ms = lookahead_ms # how far ahead of playback modulation runs
+        self.max_tx_seconds = max_tx_seconds # longest transmission - later batches are added to it up to this much audio. 0 never adds
+        self.chain_margin_ms = chain_margin_ms # how little audio can be left before it's too late to add the next batch
+        self.chained_batches = 0
+        self.bit_depth = SAMPLE_BYTES
         self.ptt_on_delay_ms = ptt_on_delay_ms
         self.ptt_off_delay_ms = ptt_off_delay_ms
-        self.db = db
-        self.send_queue = []
         self.modem = modem
+        self.send_queue = send_queue if send_queue is not None else TxQueue(airtime=modem.airtime)
 
         if type(name_or_id) == str:
             name_or_id = name_or_id.strip()
 
-        if name_or_id != None:
-            try:
-                self.device = next(
-                    device for device in devices.devices 
-                    if (device.name == name_or_id or
-                    device.id == name_or_id) and device.output_channels > 0
-                )
-            except StopIteration:
-                raise ValueError(f"Could not find audio device {name_or_id}")
-        else:
-            self.device = default_output_device
-            
+        self.backend = get_backend(name_or_id)
+        self.device = self.backend.find(name_or_id, output=True)
 
         logging.debug(f"Opening {self.device.name} for output")
 
@@ -216,116 +400,223 @@ class OutputDevice():
         if self.device.sample_rate < sample_rate:
             logging.critical(f"Output audio device sample rate {self.device.sample_rate} is less than modems sample rate {sample_rate} - this will cause problems")
 
+        self.resampler = resampler
+        self.dsp = OutputDSP(self.device.output_channels, sample_rate, self.device.sample_rate, db, resampler=resampler)
+
+        # room for the lookahead plus the longest burst (and the PTT delays) so the modulation thread only ever waits
+        # on the lookahead, never on space in the ring
+        self.bytes_per_ms = self.bit_depth * self.device.output_channels * self.device.sample_rate / 1000
+        longest_burst_ms = max(x.burst_bytes / 2 / x.sample_rate for x in modem.modems.values()) * 1000
+        self.ring = RingBuffer(int(
+            (lookahead_ms + longest_burst_ms + ptt_on_delay_ms + ptt_off_delay_ms + 1000) * self.bytes_per_ms
+        ))
+        self.underruns = 0 # blocks played short while still transmitting
+        self.late_callbacks = 0 # PortAudio ran out of audio before the callback returned
+        self.callback_buffer = bytearray()
+        self.callback_view = memoryview(self.callback_buffer)
+        self.callback_out = self.callback_buffer
+        self.silent_blocks: dict[int, bytes] = {}
+        self.air_markers: deque[tuple[int, float]] = deque() # (ring position, when queued) of the start of each batch
+        self.latency = Latency() # from a packet being queued to its audio reaching the sound card
+
         self.ptt_trigger = ptt_trigger
         self.ptt_release = ptt_release
         self.ptt = False
 
-        self.stream = p.open(format=FORMAT,
-                    channels=self.device.output_channels,
-                    rate=self.device.sample_rate,
-                    output=True,
-                    input=False,
-                    output_device_index=self.device.id,
-                    stream_callback=self.pa_callback,
-                    frames_per_buffer=4096
-                )
+        self.own_stream = own_stream # False when a DuplexStream opens the stream and calls pa_callback
+        self.stream = None
+        self.stream_latency = 0 # seconds, set when the stream is opened
+        self.tuner = None
+        if own_stream:
+            self.tuner = BufferTuner(frames_per_buffer, lambda: self.late_callbacks, self.open_stream, "output",
+                                     tunable=self.backend.tunable)
+            self.open_stream(self.tuner.frames_per_buffer)
+
+    def use_channels(self, channels: int):
+        """
+        Plays channels channels instead - for a DuplexStream, before it opens the stream. The ring already has room
+        as it's never more than were opened with
+        """
+        self.device.output_channels = channels
+        self.dsp = OutputDSP(channels, self.sample_rate, self.device.sample_rate, self.dsp.db, resampler=self.resampler)
+        self.bytes_per_ms = self.bit_depth * channels * self.device.sample_rate / 1000
+        self.silent_blocks.clear()
+
+    def open_stream(self, frames_per_buffer: int):
+        if self.stream:
+            self.stream.close()
+        self.stream = self.backend.open(self.device, self.device.output_channels, input=False, output=True,
+                                        callback=self.pa_callback, frames_per_buffer=frames_per_buffer)
+        self.stream_latency = self.stream.get_output_latency()
+        logging.debug(f"Output stream latency {self.stream_latency*1000:.0f}ms with {frames_per_buffer} frames per buffer")
+
+    def convert(self, data: bytes) -> bytes:
+        """
+        Converts modem audio to the output devices sample rate, volume and channels
+        """
+        return self.dsp.process(data)
 
+    @property
+    def db(self) -> float:
+        return self.dsp.db
 
+    @db.setter
+    def db(self, db: float):
+        self.dsp.db = db
 
     def write_raw(self,data:bytes):
-        if self.device.sample_rate != self.sample_rate:
-            (data, self.rate_state) = pyaudioop.ratecv(
-                data, 
-                pyaudio.get_sample_size(FORMAT),
-                1,
-                self.sample_rate,
-                self.device.sample_rate,
-                self.rate_state,
-            )
-        
-        if self.db:
-            data = pyaudioop.mul(data, 2, 10**(self.db/20.0))
-
-        if self.device.output_channels == 2:
-                    data = pyaudioop.tostereo(
-                        data,
-                        pyaudio.get_sample_size(FORMAT),
-                        1,
-                        1
-                    )
-        with self.output_buffer_lock:
-            self.buffer += data
-
-    def write(self, data: Packet):
-        with self.send_queue_lock:
-            self.send_queue.append(data)
+        self.queue_audio(self.convert(data), self.clear_count)
+
+    def queue_audio(self, data: bytes, clear_count: int) -> bool:
+        """
+        Copies audio into the ring buffer, waiting for playback to make room if needed. Returns False (and stops) if
+        the output is cleared in the meantime.
+        """
+        data = memoryview(data)
+        while data:
+            with self.output_buffer_lock:
+                if clear_count != self.clear_count:
+                    return False
+                written = self.ring.write(data[:self.ring.free])
+            data = data[written:]
+            if data:
+                time.sleep(0.01)
+        return True
+
+    def write(self, data: Packet) -> bool:
+        """
+        Queues a packet to send. Can block if the bulk queue is full. Returns False if the packet was dropped.
+        """
+        return self.send_queue.put(data)
+
+    def silence(self, duration_ms: int) -> bytes:
+        frames = int(duration_ms * self.device.sample_rate / 1000)
+        return bytes(frames * self.device.output_channels * self.bit_depth)
     
     def audio_buffer(self):
+        """
+        Modulates the next batch from the send queue into the output buffer one burst at a time so the first burst goes
+        out while the rest are still being modulated. Modulation is kept lookahead_ms ahead of playback.
+
+        Packets queued before the last batch finishes playing are modulated and added to the same transmission so PTT
+        stays keyed without another set of PTT delays, up to max_tx_seconds of audio. ARQ resends count against it.
+        """
         logging.debug("Populating audio buffer")
-        # ptt delay
-        pre_silence = pydub.AudioSegment.silent(duration=self.ptt_on_delay_ms, frame_rate=self.device.sample_rate)
-        pre_silence = pre_silence.set_channels(self.device.output_channels)
-        write_buffer = pre_silence.raw_data
-        
-        with self.send_queue_lock:
-            send_queue = self.send_queue
-            self.send_queue = []
-        data = self.modem.write(send_queue)
-
-        if self.device.sample_rate != self.sample_rate:
-            (data, self.rate_state) = pyaudioop.ratecv(
-                data, 
-                pyaudio.get_sample_size(FORMAT),
-                1,
-                self.sample_rate,
-                self.device.sample_rate,
-                self.rate_state,
+        clear_count = self.clear_count
+        if self.max_tx_seconds:
+            # resends are played first - a packet still goes out on its own if there aren't any
+            packets = self.send_queue.take(
+                max_seconds=max(self.max_tx_seconds - self.modem.pending_seconds, 0), at_least_one=not self.modem.pending
             )
-        
-        if self.db:
-            data = pyaudioop.mul(data, 2, 10**(self.db/20.0))
-
-        if self.device.output_channels == 2:
-                    data = pyaudioop.tostereo(
-                        data,
-                        pyaudio.get_sample_size(FORMAT),
-                        1,
-                        1
-                    )
-        
-        write_buffer += data
-        
+        else:
+            packets = self.send_queue.take()
+        if not packets and not self.modem.pending: # cleared since the callback saw something queued
+            return
+
         # ptt delay
-        post_silence = pydub.AudioSegment.silent(duration=self.ptt_off_delay_ms, frame_rate=self.device.sample_rate)
-        post_silence = post_silence.set_channels(self.device.output_channels)
-        write_buffer += post_silence.raw_data
+        self.queue_audio(self.silence(self.ptt_on_delay_ms), clear_count)
+
+        sent_ms = 0
+        self.mark_batch()
+        while packets is not None:
+            for data in self.modem.write_stream(packets):
+                data = self.convert(data)
+                if not self.queue_audio(data, clear_count): # the buffer was cleared - stop sending
+                    logging.debug("TX cleared while modulating")
+                    return
+                sent_ms += len(data) / self.bytes_per_ms
+                while self.queue_ms > self.lookahead_ms and clear_count == self.clear_count:
+                    time.sleep(0.01)
+            packets = self.next_batch(self.max_tx_seconds - sent_ms / 1000, clear_count)
+            if packets is not None:
+                self.chained_batches += 1
+                logging.debug(f"Adding {len(packets)} packets to the current transmission")
 
-        with self.output_buffer_lock:
-            self.buffer += write_buffer
+        # ptt delay
+        self.queue_audio(self.silence(self.ptt_off_delay_ms), clear_count)
         logging.debug("wrote to output buffer")
 
-    def pa_callback(self, in_data, frame_count, time_info, status):
-        buffer_size = frame_count * pyaudio.get_sample_size(FORMAT) * self.device.output_channels
+    def next_batch(self, remaining_seconds: float, clear_count: int) -> list[Packet]|None:
+        """
+        Waits while the current transmission plays out for more packets to add to it. None if PTT should be released
+        """
+        while remaining_seconds > 0 and clear_count == self.clear_count:
+            if self.send_queue or self.modem.pending:
+                resend_seconds = self.modem.pending_seconds
+                if resend_seconds > remaining_seconds: # resends that don't fit go first in the next transmission
+                    return None
+                packets = self.send_queue.take(max_seconds=remaining_seconds - resend_seconds, at_least_one=False)
+                self.mark_batch()
+                # packets that don't fit wait for the next transmission
+                return packets if packets or self.modem.pending else None
+            if self.queue_ms <= self.chain_margin_ms:
+                return None
+            time.sleep(0.01)
+        return None
+
+    def mark_batch(self):
+        """
+        Remembers where the batch just taken from the send queue starts in the ring so the callback can measure how
+        long it took to reach the air
+        """
+        if self.send_queue.oldest_taken is not None:
+            self.air_markers.append((self.ring.write_pos, self.send_queue.oldest_taken))
+
+    def air_latency(self, start: int, end: int):
+        """
+        Measures the queue to air latency of batches starting in the block of the ring that's just been read
+        """
+        while self.air_markers and self.air_markers[0][0] < end:
+            position, queued = self.air_markers.popleft()
+            if position < start: # cleared before it was played
+                continue
+            on_air = self.send_queue.clock() + self.stream_latency + (position - start) / self.bytes_per_ms / 1000
+            self.latency.add((on_air - queued) * 1000)
+
+    def silent_block(self, size: int) -> bytes:
+        block = self.silent_blocks.get(size)
+        if block is None:
+            block = self.silent_blocks[size] = bytes(size)
+        return block
 
-        output = bytearray(buffer_size)
+    def pa_callback(self, in_data, frame_count, time_info, status):
+        buffer_size = frame_count * self.bit_depth * self.device.output_channels
 
-        ptt = False
+        if status & OUTPUT_UNDERFLOW:
+            self.late_callbacks += 1
 
+        if self.cleared != self.clear_count: # only the reader side can discard what's in the ring
+            self.cleared = self.clear_count
+            self.ring.skip()
 
         # if we aren't transmitting and we have inhibited tx then skip
         if self.inhibit == True and self.ptt == False:
-            return (bytes(output), pyaudio.paContinue)
+            return (self.silent_block(buffer_size), CONTINUE)
+
+        if len(self.callback_buffer) != buffer_size:
+            self.callback_buffer = bytearray(buffer_size)
+            self.callback_view = memoryview(self.callback_buffer)
+            # PyAudio only takes read only buffers (bytes) - not bytearray or memoryview - but it does take a ctypes
+            # array, which shares callback_buffer's memory so nothing is copied or allocated per callback
+            self.callback_out = (ctypes.c_char * buffer_size).from_buffer(self.callback_buffer)
+        queued = len(self.ring)
+        start = self.ring.read_pos
+        length = self.ring.read_into(self.callback_view)
+        if self.air_markers:
+            self.air_latency(start, start + length)
+        if length < buffer_size:
+            self.callback_view[length:] = self.silent_block(buffer_size)[length:]
 
-        with self.output_buffer_lock:
-            chunk_size = min(len(self.buffer), buffer_size)
-            output[:chunk_size] = self.buffer[:chunk_size]
-            if self.buffer:
-                ptt = True
-            elif self.send_queue and (not self.output_buffer_thread or not self.output_buffer_thread.is_alive()):
-                # if we have no output buffer and queued messages we should start a thread to generate an output buffer
-                self.output_buffer_thread = Thread(target=self.audio_buffer)
-                self.output_buffer_thread.start()
-            del self.buffer[:chunk_size]
+        ptt = False
+        modulating = self.output_buffer_thread and self.output_buffer_thread.is_alive()
+        if queued or (modulating and self.ptt): # keep PTT up if modulation briefly falls behind playback
+            ptt = True
+            if modulating and length < buffer_size:
+                self.underruns += 1
+        elif (self.send_queue.waiting or self.modem.pending) and not modulating:
+            # if we have no output buffer and queued messages we should start a thread to generate an output buffer
+            self.output_buffer_thread = Thread(target=self.audio_buffer)
+            self.output_buffer_thread.start()
 
         if self.ptt != ptt:
             if ptt and self.ptt_trigger:
@@ -336,11 +627,66 @@ class OutputDevice():
                 self.ptt_release()
             self.ptt = ptt
 
-        return (bytes(output), pyaudio.paContinue)
-    
+        return (self.callback_out, CONTINUE)
+
     def clear(self):
         with self.output_buffer_lock:
-            self.buffer = bytearray()
+            self.clear_count += 1
         return
     def close(self):
-        self.stream.close()
\ No newline at end of file
+        if self.own_stream:
+            self.tuner.running = False
+            self.stream.close()
+
+
+class DuplexStream():
+    """
+    One PortAudio stream with both input and output for when RX and TX use the same sound card. Its callback hands
+    the captured block to the InputDevice and plays the block from the OutputDevice, so there's one callback thread
+    instead of two and input and output stay in step sample for sample. Both devices need to be created with
+    own_stream=False.
+    """
+    def __init__(self, input_device: InputDevice, output_device: OutputDevice, frames_per_buffer: int|str = 4096):
+        if (input_device.device.id, input_device.device.name) != (output_device.device.id, output_device.device.name):
+            raise ValueError(
+                f"Full duplex needs the same device for input and output - not {input_device.device.name} and {output_device.device.name}"
+            )
+        self.input_device = input_device
+        self.output_device = output_device
+        self.device = input_device.device
+        # PyAudio takes one channel count for both directions. Cards like the CM108 have 1 in and 2 out
+        self.channels = min(input_device.device.input_channels, output_device.device.output_channels)
+        if (input_device.device.input_channels, output_device.device.output_channels) != (self.channels, self.channels):
+            logging.info(f"Opening {self.device.name} with {self.channels} channels for full duplex")
+            input_device.use_channels(self.channels)
+            output_device.use_channels(self.channels)
+        self.stream = None
+        self.tuner = BufferTuner(
+            frames_per_buffer, lambda: input_device.input_overflows + output_device.late_callbacks, self.open_stream, "duplex"
+        )
+        input_device.tuner = output_device.tuner = self.tuner
+        self.open_stream(self.tuner.frames_per_buffer)
+
+    def open_stream(self, frames_per_buffer: int):
+        if self.stream:
+            self.stream.close()
+        self.stream = self.input_device.backend.open(self.device, self.channels, input=True, output=True,
+                                                     callback=self.pa_callback, frames_per_buffer=frames_per_buffer)
+        self.input_device.stream = self.output_device.stream = self.stream
+        self.input_device.stream_latency = self.stream.get_input_latency()
+        self.output_device.stream_latency = self.stream.get_output_latency()
+        logging.debug(f"Duplex stream latency {self.input_device.stream_latency*1000:.0f}ms in, {self.output_device.stream_latency*1000:.0f}ms out with {frames_per_buffer} frames per buffer")
+
+    def pa_callback(self, in_data: bytes, frame_count: int, time_info, status_flag):
+        self.input_device.pa_callback(in_data, frame_count, time_info, status_flag)
+        return self.output_device.pa_callback(None, frame_count, time_info, status_flag)
+
+    def close(self):
+        self.tuner.running = False
+        self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
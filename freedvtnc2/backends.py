@@ -0,0 +1,218 @@
+"""
+Audio backends other than sound cards, for running headless behind other DSP (SDR receivers, ALSA loopback,
+containers) and for testing without sound cards.
+
+Audio devices are picked with a URI in place of a sound card name or id:
+
+ - file:/path/to/audio.raw - raw signed 16 bit audio. FIFOs work too, so two TNCs can talk through a pair of them
+ - stdio: - stdin for input, stdout for output (needs --no-cli)
+ - udp://host:port - input listens on host:port, output sends to it. Each datagram is just samples
+
+Query parameters set the format and pacing, eg file:/tmp/rx.raw?rate=48000&channels=2&pace=fast
+
+ - rate - sample rate, defaults to 8000 (the modem's rate, so no resampling)
+ - channels - defaults to 1
+ - pace - realtime (default) runs a block of frames_per_buffer every block's worth of time, tied to the sample clock
+   so it doesn't drift. fast runs as fast as the other end reads or writes
+
+Streams look like PyAudio's callback streams - the callback gets (in_data, frame_count, time_info, status) and
+returns (out_data, flag) - so InputDevice and OutputDevice don't care where the audio goes.
+"""
+from dataclasses import dataclass
+from threading import Thread
+from typing import BinaryIO, Callable
+from urllib.parse import urlsplit, parse_qs
+import logging
+import socket
+import sys
+import time
+
+# the same values as PortAudio's so PyAudio's flags can be used as is
+SAMPLE_BYTES = 2 # paInt16
+CONTINUE = 0 # paContinue
+INPUT_OVERFLOW = 2 # paInputOverflow
+OUTPUT_UNDERFLOW = 4 # paOutputUnderflow
+
+SCHEMES = ["file", "stdio", "udp"]
+PACING = ["realtime", "fast"]
+UDP_PAYLOAD = 1024 # bytes of samples per datagram - keeps them under the usual MTU
+
+Callback = Callable[[bytes|None, int, dict, int], tuple[bytes|None, int]]
+
+@dataclass
+class AudioDevice:
+    """
+    Information about an audio device
+    """
+    input_channels: int
+    output_channels: int
+    sample_rate: int
+    name: str
+    id: int
+
+def read_exact(f: BinaryIO, size: int) -> bytes|None:
+    """
+    Reads size bytes, waiting for more from pipes. None at the end of the file
+    """
+    data = bytearray()
+    while len(data) < size:
+        chunk = f.read(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+class PacedStream():
+    """
+    Runs the callback on its own thread a block at a time, like PortAudio does, once start() is called. read(size)
+    supplies input (None when it ends) and write(data) takes output.
+    """
+    def __init__(self, callback: Callback, frames_per_buffer: int, channels: int, sample_rate: int, pace: str,
+                 read: Callable[[int], bytes|None]|None = None, write: Callable[[bytes], None]|None = None,
+                 close: Callable[[], None] = lambda: None, name: str = "audio"):
+        self.callback = callback
+        self.frames_per_buffer = frames_per_buffer
+        self.block_bytes = frames_per_buffer * channels * SAMPLE_BYTES
+        self.block_seconds = frames_per_buffer / sample_rate
+        self.pace = pace
+        self.read = read
+        self.write = write
+        self.close_io = close
+        self.running = True
+        self.thread = Thread(target=self.run, daemon=True, name=name)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        start = time.monotonic()
+        blocks = 0
+        try:
+            while self.running:
+                status = 0
+                if self.pace == "realtime":
+                    # sleep until this block is due. Falling more than a block behind is a late callback - start the
+                    # clock again rather than rushing to catch up
+                    delay = start + blocks * self.block_seconds - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    elif delay < -self.block_seconds:
+                        status = OUTPUT_UNDERFLOW if self.write else 0
+                        start, blocks = time.monotonic(), 0
+                in_data = None
+                if self.read:
+                    in_data = self.read(self.block_bytes)
+                    if in_data is None:
+                        if self.running:
+                            logging.info("Audio input ended")
+                        return
+                out_data, _ = self.callback(in_data, self.frames_per_buffer, {}, status)
+                if self.write and self.running:
+                    self.write(out_data)
+                blocks += 1
+        except (OSError, ValueError) as e: # the other end went away or we were closed mid read
+            if self.running:
+                logging.warning(f"Audio stream stopped: {e}")
+        finally:
+            self.close_io()
+
+    def get_input_latency(self) -> float:
+        return 0.0
+
+    def get_output_latency(self) -> float:
+        return 0.0
+
+    def close(self):
+        self.running = False
+        self.thread.join(self.block_seconds + 1)
+
+class StreamBackend():
+    """
+    Audio from a URI (see the module docstring). There's one device - the URI - with the same channels both ways
+    """
+    # reopening would truncate files and rebind sockets, and a realtime stream falling behind is the CPU not keeping
+    # up rather than a buffer being too small - so --frames-per-buffer auto stays at its starting size
+    tunable = False
+
+    def __init__(self, uri: str):
+        parts = urlsplit(uri)
+        query = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+        self.uri = uri
+        self.scheme = parts.scheme
+        self.path = parts.path
+        self.address = (parts.hostname or "127.0.0.1", parts.port) if self.scheme == "udp" else None
+        self.sample_rate = int(query.get("rate", 8000))
+        self.channels = int(query.get("channels", 1))
+        self.pace = query.get("pace", "realtime")
+        if self.pace not in PACING:
+            raise ValueError(f"pace must be one of {', '.join(PACING)} - not {self.pace}")
+        if self.scheme == "file" and not self.path:
+            raise ValueError(f"{uri} needs a path, eg file:/tmp/audio.raw")
+        if self.scheme == "udp" and not parts.port:
+            raise ValueError(f"{uri} needs a port, eg udp://127.0.0.1:9000")
+
+    def find(self, name_or_id: str|int|None, output: bool) -> AudioDevice:
+        return AudioDevice(
+            input_channels=self.channels, output_channels=self.channels, sample_rate=self.sample_rate, name=self.uri, id=0
+        )
+
+    def open(self, device: AudioDevice, channels: int, input: bool, output: bool, callback: Callback,
+             frames_per_buffer: int) -> PacedStream:
+        if input and output:
+            raise ValueError(f"{self.uri} can't be used for input and output at once")
+        read = write = None
+        close = lambda: None
+        if self.scheme == "udp":
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            close = sock.close
+            if input:
+                sock.bind(self.address)
+                sock.settimeout(0.5) # so the stream can be closed while nothing is being sent
+                pending = bytearray()
+                def read(size: int) -> bytes|None:
+                    while len(pending) < size:
+                        try:
+                            pending.extend(sock.recv(65536))
+                        except TimeoutError:
+                            if not stream.running:
+                                return None
+                    data = bytes(pending[:size])
+                    del pending[:size]
+                    return data
+            else:
+                def write(data: bytes):
+                    for offset in range(0, len(data), UDP_PAYLOAD):
+                        sock.sendto(data[offset:offset+UDP_PAYLOAD], self.address)
+        else:
+            # files are opened on the stream's thread as opening a FIFO waits for the other end
+            files = []
+            def get_file() -> BinaryIO:
+                if not files:
+                    if self.scheme == "stdio":
+                        files.append(sys.stdin.buffer if input else sys.stdout.buffer)
+                    else:
+                        files.append(open(self.path, "rb" if input else "wb"))
+                return files[0]
+            if input:
+                read = lambda size: read_exact(get_file(), size)
+            else:
+                def write(data: bytes):
+                    f = get_file()
+                    f.write(data)
+                    f.flush()
+            def close():
+                if files and self.scheme != "stdio":
+                    files[0].close()
+        stream = PacedStream(callback, frames_per_buffer, channels, self.sample_rate, self.pace, read=read, write=write,
+                             close=close, name=f"audio-{self.scheme}")
+        stream.start()
+        return stream
+
+def is_uri(name_or_id: str|int|None) -> bool:
+    return isinstance(name_or_id, str) and urlsplit(name_or_id).scheme in SCHEMES
+
+def from_uri(name_or_id: str|int|None) -> StreamBackend|None:
+    """
+    The backend for a file:, stdio: or udp: device. None for anything else (a sound card name or id)
+    """
+    return StreamBackend(name_or_id) if is_uri(name_or_id) else None
@@ -0,0 +1,695 @@
+"""
+Benchmarks for the modem hot paths.
+
+Run with `python -m freedvtnc2.benchmark [name ...]` from the repo root (c01.raw is used as RX audio).
+
+Results can be saved with --save-baseline and later runs compared against them with --baseline to catch regressions.
+Timings depend on the machine so baselines aren't kept in the repo - save one locally before making changes.
+"""
+import argparse
+import json
+import random
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Callable
+from tabulate import tabulate
+import kissfix
+from . import modem
+from .framing import Packet, Reassembler, pack_frames, pack_greedy
+from . import fec
+from . import compression
+from . import dsp
+
+try:
+    import audioop # only used to compare against - removed in python 3.13
+except ImportError:
+    audioop = None
+
+BENCHMARKS: dict[str, Callable[[argparse.Namespace], list[dict]]] = {}
+
+def benchmark(name: str):
+    """
+    Registers a benchmark. Benchmarks return a list of result rows (dicts)
+    """
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+class CountingFFI():
+    """
+    Wraps the cffi FFI object so we can count how many native buffers get allocated
+    """
+    def __init__(self, ffi):
+        self.ffi = ffi
+        self.allocations = 0
+
+    def new(self, *args, **kwargs):
+        self.allocations += 1
+        return self.ffi.new(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.ffi, name)
+
+def read_audio(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+# packet sizes (bytes) for typical traffic. Each mix is repeated to build larger queues
+PACKET_MIXES = {
+    "ack": [17]*10, # AX.25 supervisory frames
+    "aprs": [60, 75, 90, 110, 120],
+    "mixed": [17, 17, 80, 120, 256, 17, 256],
+    "bulk": [2048],
+}
+
+def make_packets(mix: str, count: int|None = None, seed: int = 0) -> list[Packet]:
+    rng = random.Random(seed)
+    sizes = PACKET_MIXES[mix]
+    if count is None:
+        count = len(sizes)
+    return [Packet(rng.randbytes(sizes[x % len(sizes)])) for x in range(count)]
+
+def timed(func: Callable[[], object]) -> tuple[float, float]:
+    """
+    Runs func once for timing and a second time under tracemalloc for peak memory. Returns (seconds, peak KiB)
+    """
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return elapsed, peak / 1024
+
+@benchmark("tx")
+def tx(args: argparse.Namespace) -> list[dict]:
+    """
+    Modulator real time factor and peak memory for each mode and packet mix
+    """
+    rows = []
+    for mode in modem.Modems:
+        tx_modem = modem.Modem(mode)
+        for mix in args.mix:
+            output = []
+            elapsed, peak = timed(lambda: output.append(tx_modem.modulate(make_packets(mix))))
+            audio_seconds = len(output[0]) / 2 / tx_modem.sample_rate
+            rows.append({
+                "mode": mode.name,
+                "mix": mix,
+                "audio s": audio_seconds,
+                "real time factor": audio_seconds / elapsed,
+                "peak KiB": peak,
+            })
+        tx_modem.close()
+    return rows
+
+def legacy_modulate_frames(tx_modem: modem.Modem, frames: list[bytearray]) -> bytes:
+    """
+    The original burst builder - regenerates the preamble and postamble for every frame and grows the output with +=
+    """
+    ffi, lib = modem.ffi, modem.lib
+    output = bytes()
+    for frame in frames:
+        from_modem = ffi.new(f"short mod_out[{lib.freedv_get_n_tx_modem_samples(tx_modem.modem)}]")
+        samples = lib.freedv_rawdatapreambletx(tx_modem.modem, from_modem)
+        output += ffi.buffer(from_modem)[:(samples*ffi.sizeof("short"))]
+        lib.freedv_rawdatatx(tx_modem.modem, from_modem, ffi.from_buffer("unsigned char *", frame))
+        output += ffi.buffer(from_modem)[:]
+        samples = lib.freedv_rawdatapostambletx(tx_modem.modem, from_modem)
+        output += ffi.buffer(from_modem)[:(samples*ffi.sizeof("short"))]
+    output += bytes(lib.freedv_get_n_nom_modem_samples(tx_modem.modem)*ffi.sizeof("short")*2)
+    return output
+
+@benchmark("tx_burst")
+def tx_burst(args: argparse.Namespace) -> list[dict]:
+    """
+    Burst assembly time for large packets - original concatenation vs cached blocks in a preallocated buffer
+    """
+    rows = []
+    for mode in modem.Modems:
+        tx_modem = modem.Modem(mode)
+        for size in (1024, 8192, 32000):
+            frames = tx_modem.pack([Packet(random.Random(0).randbytes(size))])
+
+            start = time.perf_counter()
+            legacy = legacy_modulate_frames(tx_modem, frames)
+            legacy_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            current = tx_modem.modulate_frames(frames)
+            current_seconds = time.perf_counter() - start
+
+            assert len(legacy) == len(current)
+            rows.append({
+                "mode": mode.name,
+                "packet bytes": str(size),
+                "frames": len(frames),
+                "legacy ms": legacy_seconds * 1000,
+                "cached ms": current_seconds * 1000,
+                "speedup": legacy_seconds / current_seconds,
+            })
+        tx_modem.close()
+    return rows
+
+def rss_kib() -> float:
+    """
+    Current resident memory of this process including native allocations
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1024
+    except OSError: # not linux - max rss is the best we can do
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+@benchmark("tx_soak")
+def tx_soak(args: argparse.Namespace) -> list[dict]:
+    """
+    Native memory growth and switch time when changing TX mode for every burst (like --follow) - fresh modems vs the pool
+    """
+    rows = []
+    modes = [x.name for x in modem.Modems]
+    for pooled in (False, True):
+        modem_tx = modem.FreeDVTX()
+        start_rss = rss_kib()
+        switch_seconds = 0
+        for iteration in range(args.soak_iterations):
+            start = time.perf_counter()
+            if pooled:
+                modem_tx.set_mode(modes[iteration % len(modes)])
+            else: # what set_mode used to do - a new freedv instance every time that is never closed
+                modem_tx.modem = modem.Modem(modem.Modems[modes[iteration % len(modes)]])
+            switch_seconds += time.perf_counter() - start
+            modem_tx.write(make_packets("ack", 1))
+        rows.append({
+            "tx modems": "pooled" if pooled else "new per switch",
+            "switches": args.soak_iterations,
+            "switch ms": switch_seconds / args.soak_iterations * 1000,
+            "rss growth KiB": rss_kib() - start_rss,
+        })
+        modem_tx.close()
+    return rows
+
+@benchmark("rx")
+def rx(args: argparse.Namespace) -> list[dict]:
+    """
+    Demodulator real time factor and peak memory for c01.raw and loopback audio from FreeDVTX.write
+    """
+    # (source, tx mode, rx modes, audio) - loopback audio is demodulated by its own mode alone and by all modes
+    sources = [("c01.raw", "", None, read_audio(args.audio))]
+    for mode in modem.Modems:
+        audio = modem.FreeDVTX(mode.name).write(make_packets("mixed"))
+        sources.append(("loopback", mode.name, [mode.name], audio))
+        sources.append(("loopback", mode.name, None, audio))
+
+    rows = []
+    for source, tx_mode, rx_modes, audio in sources:
+        chunks = [audio[offset:offset+args.chunk_size] for offset in range(0, len(audio), args.chunk_size)]
+        packets = []
+        def run():
+            packets.clear()
+            modem_rx = modem.FreeDVRX(callback=packets.append, progress=lambda *args: None, inhibit=lambda state: None, modes=rx_modes)
+            for chunk in chunks:
+                modem_rx.write(chunk)
+            modem_rx.close()
+        elapsed, peak = timed(run)
+        audio_seconds = len(audio) / 2 / 8000
+        rows.append({
+            "source": source,
+            "tx mode": tx_mode,
+            "rx modes": ",".join(rx_modes) if rx_modes else "all",
+            "packets": len(packets),
+            "real time factor": audio_seconds / elapsed,
+            "peak KiB": peak,
+        })
+    return rows
+
+@benchmark("framing")
+def framing(args: argparse.Namespace) -> list[dict]:
+    """
+    Packets per second through packing into frames and reassembly from frames
+    """
+    rows = []
+    for mode in modem.Modems:
+        tx_modem = modem.Modem(mode)
+        for mix in args.mix:
+            count = 50 if mix == "bulk" else 1000
+            packets = make_packets(mix, count)
+
+            frames = []
+            pack_seconds, pack_peak = timed(lambda: frames.append(tx_modem.pack(list(packets))))
+            payloads = [bytes(x[:-2]) for x in frames[0]] # CRC is removed by the modem on RX
+
+            received = []
+            reassembler = Reassembler(received.append)
+            def depack():
+                for payload in payloads:
+                    reassembler.feed(payload, mode.name)
+            depack_seconds, depack_peak = timed(depack)
+
+            assert len(received) == count * 2, "reassembly lost packets"
+            rows.append({
+                "mode": mode.name,
+                "mix": mix,
+                "frames": len(payloads),
+                "pack packets/s": count / pack_seconds,
+                "depack packets/s": count / depack_seconds,
+                "peak KiB": max(pack_peak, depack_peak),
+            })
+        tx_modem.close()
+    return rows
+
+def text_packets(count: int, seed: int = 0) -> list[Packet]:
+    """
+    APRS beacons, APRS messages and chat - the sort of traffic that compresses
+    """
+    rng = random.Random(seed)
+    calls = [f"VK{rng.randint(1,8)}{''.join(rng.choices('ABCDEFGHIJKLMNOPQRSTUVWXYZ', k=3))}" for _ in range(20)]
+    words = "the a station signal report copy weather net tonight antenna power battery good fine thanks see you on frequency".split()
+    packets = []
+    for x in range(count):
+        source = compression.ax25_call(rng.choice(calls), rng.randint(0, 15))
+        kind = x % 3
+        if kind == 0:
+            info = f"!{rng.randint(1000,9000)}.{rng.randint(10,99)}S/{rng.randint(10000,17000)}.{rng.randint(10,99)}E-PHG2360/A={rng.randint(0,3000):06} {' '.join(rng.choices(words, k=4))}"
+            packets.append(Packet(compression.ax25_call("APDW16") + source + compression.ax25_call("WIDE1", 1) + b"\x03\xf0" + info.encode()))
+        elif kind == 1:
+            info = f":{rng.choice(calls):9}:{' '.join(rng.choices(words, k=8))}{{{rng.randint(1,99)}"
+            packets.append(Packet(compression.ax25_call("APRS") + source + b"\x03\xf0" + info.encode()))
+        else:
+            message = " ".join(rng.choices(words, k=rng.randint(5, 20)))
+            packets.append(Packet(rng.choice(calls).encode() + b"\xff" + message.encode(), header=b"\xfe"))
+    return packets
+
+def read_kiss_trace(path: str) -> list[Packet]:
+    """
+    Reads a capture of KISS frames (as sent to the TNC) and returns the data frames as packets
+    """
+    with open(path, "rb") as f:
+        frames = f.read().split(kissfix.FEND)
+    packets = []
+    for frame in frames:
+        frame = kissfix.recover_special_codes(frame)
+        if len(frame) > 1 and frame[0] & 0x0f == 0: # data frames only
+            packets.append(Packet(frame[1:]))
+    return packets
+
+@benchmark("packing")
+def packing(args: argparse.Namespace) -> list[dict]:
+    """
+    Frames (airtime) needed by the original greedy packer vs pack_frames, with the queue split into bursts of --burst-packets
+    """
+    if args.trace:
+        traces = {args.trace: read_kiss_trace(args.trace)}
+    else:
+        traces = {mix: make_packets(mix, 200) for mix in args.mix}
+
+    rows = []
+    for mode in modem.Modems:
+        tx_modem = modem.Modem(mode)
+        payload_size = tx_modem.bytes_per_frame - 2
+        frame_seconds = tx_modem.frame_seconds
+        for name, packets in traces.items():
+            bursts = [packets[x:x+args.burst_packets] for x in range(0, len(packets), args.burst_packets)]
+            greedy = sum(len(pack_greedy(list(burst), payload_size, tx_modem.max_packets_combined)) for burst in bursts)
+            packed = sum(len(pack_frames(list(burst), payload_size, tx_modem.max_packets_combined, tx_modem.packing_window)) for burst in bursts)
+            rows.append({
+                "mode": mode.name,
+                "trace": name,
+                "packets": len(packets),
+                "greedy frames": greedy,
+                "packed frames": packed,
+                "frames saved %": (greedy - packed) / greedy * 100,
+                "airtime saved s": (greedy - packed) * frame_seconds,
+            })
+        tx_modem.close()
+    return rows
+
+@benchmark("burst")
+def burst(args: argparse.Namespace) -> list[dict]:
+    """
+    Airtime per KB of bulk data with --frames-per-burst frames sharing each preamble and postamble, checked by loopback
+    """
+    packets = make_packets("bulk", 20)
+    kilobytes = sum(len(x.data) for x in packets) / 1024
+    rows = []
+    for mode in modem.Modems:
+        single_burst = None
+        for frames_per_burst in args.frames_per_burst:
+            tx_modem = modem.Modem(mode, frames_per_burst=frames_per_burst)
+            audio = tx_modem.modulate_frames(tx_modem.pack(list(packets)))
+            airtime = (len(audio) - tx_modem.silence_bytes) / 2 / tx_modem.sample_rate
+            single_burst = single_burst or airtime
+            tx_modem.close()
+
+            received = []
+            rx = modem.FreeDVRX(callback=received.append, progress=lambda *args: None, inhibit=lambda state: None, modes=[mode.name], frames_per_burst=frames_per_burst)
+            for offset in range(0, len(audio), args.chunk_size):
+                rx.write(audio[offset:offset+args.chunk_size])
+            rx.close()
+            rows.append({
+                "mode": mode.name,
+                "frames/burst": str(frames_per_burst),
+                "airtime s/KB": airtime / kilobytes,
+                "airtime saved %": (single_burst - airtime) / single_burst * 100,
+                "packets": len(received),
+            })
+    return rows
+
+def audioop_input(data: bytes, channels: int, device_rate: int, state):
+    """
+    The InputDevice path before dsp.py
+    """
+    audioop.max(data, 2)
+    if channels == 2:
+        data = audioop.tomono(data, 2, 1, 0)
+    return audioop.ratecv(data, 2, 1, device_rate, 8000, state)
+
+def audioop_output(data: bytes, channels: int, device_rate: int, state, db: float):
+    """
+    The OutputDevice path before dsp.py
+    """
+    data, state = audioop.ratecv(data, 2, 1, 8000, device_rate, state)
+    data = audioop.mul(data, 2, 10**(db/20.0))
+    if channels == 2:
+        data = audioop.tostereo(data, 2, 1, 1)
+    return data, state
+
+@benchmark("dsp")
+def dsp_paths(args: argparse.Namespace) -> list[dict]:
+    """
+    CPU time per second of audio for the sound card input and output processing - dsp.py's resamplers vs audioop.
+    "vs audioop" is the CPU time as a multiple of audioop's
+    """
+    rng = random.Random(0)
+    seconds = 30
+    rows = []
+    for device_rate, channels in ((48000, 2), (44100, 1)):
+        device_audio = rng.randbytes(device_rate * channels * 2 * seconds)
+        modem_audio = rng.randbytes(8000 * 2 * seconds)
+        device_chunk = 4096 * channels * 2
+        modem_chunk = 4096 * 8000 // device_rate * 2 # about the same time per chunk
+        device_chunks = [device_audio[x:x+device_chunk] for x in range(0, len(device_audio), device_chunk)]
+        modem_chunks = [modem_audio[x:x+modem_chunk] for x in range(0, len(modem_audio), modem_chunk)]
+
+        paths = {}
+        for resampler in dsp.RESAMPLERS:
+            input_dsp = dsp.InputDSP(channels, device_rate, 8000, resampler=resampler)
+            output_dsp = dsp.OutputDSP(channels, 8000, device_rate, db=-3, resampler=resampler)
+            paths[f"numpy {resampler}"] = (
+                lambda input_dsp=input_dsp: [input_dsp.process(x) for x in device_chunks],
+                lambda output_dsp=output_dsp: [output_dsp.process(x) for x in modem_chunks],
+            )
+        if audioop:
+            def run_input():
+                state, output = None, []
+                for chunk in device_chunks:
+                    data, state = audioop_input(chunk, channels, device_rate, state)
+                    output.append(data)
+                return output
+            def run_output():
+                state, output = None, []
+                for chunk in modem_chunks:
+                    data, state = audioop_output(chunk, channels, device_rate, state, -3)
+                    output.append(data)
+                return output
+            paths["audioop"] = (run_input, run_output)
+
+        outputs = {}
+        device_rows = []
+        for path, functions in paths.items():
+            for direction, function in zip(("input", "output"), functions):
+                output = []
+                elapsed, _ = timed(lambda: output.append(function()))
+                outputs[path, direction] = output[0]
+                device_rows.append({
+                    "device": f"{device_rate}Hz x{channels}",
+                    "path": path,
+                    "direction": direction,
+                    "cpu ms/audio s": elapsed / seconds * 1000,
+                })
+        if audioop:
+            for direction in ("input", "output"):
+                assert outputs["numpy linear", direction] == outputs["audioop", direction], f"numpy {direction} doesn't match audioop"
+            audioop_ms = {row["direction"]: row["cpu ms/audio s"] for row in device_rows if row["path"] == "audioop"}
+            for row in device_rows:
+                row["vs audioop"] = row["cpu ms/audio s"] / audioop_ms[row["direction"]]
+        rows += device_rows
+    return rows
+
+@benchmark("fec")
+def fec_coding(args: argparse.Namespace) -> list[dict]:
+    """
+    FEC encode and decode cost per frame, decoding with every repair frame used to replace a lost data frame
+    """
+    rows = []
+    rng = random.Random(0)
+    for mode in modem.Modems:
+        tx_modem = modem.Modem(mode)
+        size = tx_modem.bytes_per_frame - 2 - fec.FEC_OVERHEAD
+        tx_modem.close()
+        for n in (4, 16, 64):
+            k = fec.repair_count(n, args.fec_repair)
+            symbols = [rng.randbytes(size) for _ in range(n)]
+            repairs = []
+            encode_seconds, _ = timed(lambda: repairs.append(fec.encode(symbols, k)))
+            received = dict(enumerate(symbols[k:], start=k)) | dict(enumerate(repairs[0], start=n))
+            decoded = []
+            decode_seconds, decode_peak = timed(lambda: decoded.append(fec.decode(received, n)))
+            assert decoded[0] == symbols, "FEC decode failed"
+            rows.append({
+                "mode": mode.name,
+                "frames": f"{n}+{k}",
+                "encode ms/frame": encode_seconds / n * 1000,
+                "decode ms/frame": decode_seconds / n * 1000,
+                "peak KiB": decode_peak,
+            })
+    return rows
+
+@benchmark("compression")
+def compression_ratio(args: argparse.Namespace) -> list[dict]:
+    """
+    Compression ratio, effective bytes per second for each mode and per packet cost on text traffic (or --trace)
+    """
+    packets = read_kiss_trace(args.trace) if args.trace else text_packets(300)
+    frame_info = {}
+    for mode in modem.Modems:
+        tx_modem = modem.Modem(mode)
+        frame_info[mode.name] = (tx_modem.bytes_per_frame - 2, tx_modem.frame_seconds)
+        tx_modem.close()
+
+    rows = []
+    algorithms = ["zlib"] + (["zstd"] if compression.zstandard else [])
+    for algorithm in algorithms:
+        compressed = []
+        def compress():
+            compressor = compression.Compressor(algorithm)
+            compressed[:] = [compressor.compress(x, mode) for mode in frame_info for x in packets]
+            return compressor
+        compress_seconds, _ = timed(compress)
+        compressor = compress()
+        decompress_seconds, _ = timed(lambda: [compression.decompress(Packet(x.data, header=x.header[0])) for x in compressed if x.header == b"\xfb"])
+        for row in compressor.rows(frame_info):
+            payload_size, frame_seconds = frame_info[row["mode"]]
+            rows.append({
+                "algorithm": algorithm,
+                "mode": row["mode"],
+                "packets": row["packets"],
+                "ratio": row["ratio"],
+                "raw B/s": payload_size / frame_seconds,
+                "effective B/s": row["effective B/s"],
+                "compress us/packet": compress_seconds / len(compressed) * 1e6,
+                "decompress us/packet": decompress_seconds / len(compressed) * 1e6,
+            })
+    return rows
+
+# metrics where a smaller number is an improvement
+LOWER_IS_BETTER = ["startup ms", "cpu ms/audio s", "vs audioop", "airtime s/KB", "compress us/packet", "decompress us/packet", "encode ms/frame", "decode ms/frame", "packed frames", "peak KiB", "ms/block", "ffi.new/s audio", "transient KiB/s audio", "legacy ms", "cached ms", "switch ms", "rss growth KiB"]
+
+def row_key(row: dict) -> tuple:
+    """
+    Rows are matched against the baseline using their non numeric columns
+    """
+    return tuple(value for value in row.values() if isinstance(value, str))
+
+def compare(name: str, rows: list[dict], baseline: list[dict], tolerance: float) -> list[dict]:
+    """
+    Returns the metrics that got worse by more than tolerance percent
+    """
+    baseline = {row_key(row): row for row in baseline}
+    regressions = []
+    for row in rows:
+        base = baseline.get(row_key(row))
+        if not base:
+            continue
+        for metric, value in row.items():
+            if isinstance(value, str) or not base.get(metric) or metric in ["audio s", "packets", "frames", "greedy frames", "raw B/s"]:
+                continue
+            change = (value - base[metric]) / base[metric] * 100
+            worse = -change if metric not in LOWER_IS_BETTER else change
+            if worse > tolerance:
+                regressions.append({
+                    "benchmark": name,
+                    "row": " ".join(row_key(row)),
+                    "metric": metric,
+                    "baseline": base[metric],
+                    "current": value,
+                    "change %": change,
+                })
+    return regressions
+
+STARTUP_STEPS = {
+    "import audio": "import freedvtnc2.audio",
+    "import cli": "import freedvtnc2.__main__",
+    "portaudio init": "import freedvtnc2.audio as audio\nstart = time.perf_counter()\naudio.get_devices()",
+}
+
+def startup_ms(code: str) -> float:
+    """
+    Times code in a fresh python process, from just before its last line runs (the whole thing if it's one line)
+    """
+    lines = code.split("\n")
+    if len(lines) == 1:
+        lines = ["start = time.perf_counter()"] + lines
+    script = "\n".join(["import time"] + lines + ["print(time.perf_counter() - start)"])
+    result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True)
+    return float(result.stdout.split()[-1]) * 1000
+
+@benchmark("startup")
+def startup(args: argparse.Namespace) -> list[dict]:
+    """
+    Cold start time of the steps before the TNC is running - each is run in a new process, best of 3
+    """
+    rows = []
+    for step, code in STARTUP_STEPS.items():
+        try:
+            elapsed = min(startup_ms(code) for _ in range(3))
+        except subprocess.CalledProcessError as e:
+            print(f"{step} failed: {e.stderr.strip().splitlines()[-1]}")
+            continue
+        rows.append({"step": step, "startup ms": elapsed})
+    return rows
+
+@benchmark("rx_alloc")
+def rx_alloc(args: argparse.Namespace) -> list[dict]:
+    """
+    Allocations per second of audio in Modem.write for each RX mode
+    """
+    audio = read_audio(args.audio)
+    chunk_size = args.chunk_size
+    rows = []
+    for mode in modem.Modems:
+        rx = modem.Modem(mode, callback=lambda frame: None)
+        audio_seconds = len(audio) / 2 / rx.sample_rate
+
+        counting_ffi = CountingFFI(modem.ffi)
+        modem.ffi = counting_ffi
+        tracemalloc.start()
+        try:
+            allocated = 0
+            start = time.perf_counter()
+            for offset in range(0, len(audio), chunk_size):
+                chunk = audio[offset:offset+chunk_size]
+                tracemalloc.reset_peak()
+                before, _ = tracemalloc.get_traced_memory()
+                rx.write(chunk)
+                _, peak = tracemalloc.get_traced_memory()
+                allocated += peak - before
+            elapsed = time.perf_counter() - start
+        finally:
+            tracemalloc.stop()
+            modem.ffi = counting_ffi.ffi
+
+        rows.append({
+            "mode": mode.name,
+            "ffi.new/s audio": counting_ffi.allocations / audio_seconds,
+            "transient KiB/s audio": allocated / 1024 / audio_seconds,
+            "real time factor": audio_seconds / elapsed,
+        })
+    return rows
+
+@benchmark("rx_parallel")
+def rx_parallel(args: argparse.Namespace) -> list[dict]:
+    """
+    Wall clock demod time per audio block for each mode on its own, all modes sequentially and all modes threaded
+    """
+    audio = read_audio(args.audio)
+    chunks = [audio[offset:offset+args.chunk_size] for offset in range(0, len(audio), args.chunk_size)]
+
+    def run(write: Callable[[bytes], None]) -> float:
+        start = time.perf_counter()
+        for chunk in chunks:
+            write(chunk)
+        return (time.perf_counter() - start) / len(chunks) * 1000
+
+    rows = []
+    for mode in modem.Modems:
+        single = modem.Modem(mode, callback=lambda frame: None)
+        rows.append({"demodulators": mode.name, "ms/block": run(single.write)})
+
+    for threaded in (False, True):
+        rx = modem.FreeDVRX(callback=lambda packet: None, progress=lambda *args: None, inhibit=lambda state: None, threaded=threaded)
+        rows.append({"demodulators": "all threaded" if threaded else "all sequential", "ms/block": run(rx.write)})
+        rx.close()
+    return rows
+
+def main():
+    p = argparse.ArgumentParser(description="freedvtnc2 benchmarks")
+    p.add_argument("benchmarks", nargs="*", help=f"benchmarks to run - defaults to all. One of: {', '.join(BENCHMARKS.keys())}")
+    p.add_argument("--audio", default="c01.raw", help="8kHz 16 bit mono raw audio used for RX benchmarks")
+    p.add_argument("--chunk-size", default=4096, type=int, help="bytes of audio written per call, similar to a sound card callback")
+    p.add_argument("--mix", nargs="+", default=list(PACKET_MIXES), choices=list(PACKET_MIXES), help="packet size mixes to benchmark")
+    p.add_argument("--trace", help="capture of KISS frames sent to the TNC, used by the packing and compression benchmarks instead of generated traffic")
+    p.add_argument("--burst-packets", default=10, type=int, help="packets queued per burst for the packing benchmark")
+    p.add_argument("--frames-per-burst", nargs="+", default=[1, 2, 4, 8], type=int, help="frames per burst compared by the burst benchmark")
+    p.add_argument("--fec-repair", default=0.25, type=float, help="repair frames per data frame for the fec benchmark")
+    p.add_argument("--soak-iterations", default=300, type=int, help="number of mode switches for tx_soak")
+    p.add_argument("--baseline", help="JSON file of previous results to compare against")
+    p.add_argument("--save-baseline", help="Save results to this JSON file")
+    p.add_argument("--tolerance", default=10, type=float, help="Percent a metric can get worse before it's reported as a regression")
+    args = p.parse_args()
+
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            p.error(f"Unknown benchmark {name}")
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    missing = [] # benchmarks run that the baseline has no results for
+    for name in args.benchmarks or BENCHMARKS.keys():
+        print(f"\n{name}: {BENCHMARKS[name].__doc__.strip()}")
+        results[name] = BENCHMARKS[name](args)
+        print(tabulate(results[name], headers="keys", floatfmt=".2f"))
+        if args.baseline and not baseline.get(name):
+            missing.append(name)
+        regressions += compare(name, results[name], baseline.get(name, []), args.tolerance)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(baseline | results, f, indent=2)
+
+    if args.baseline:
+        if missing:
+            print(f"\n{args.baseline} has no results for {', '.join(missing)} - run with --save-baseline to add them")
+            if len(missing) == len(results):
+                sys.exit(1) # nothing was compared so don't report it as passing
+        if regressions:
+            print(f"\nRegressions (more than {args.tolerance}% worse than {args.baseline})")
+            print(tabulate(regressions, headers="keys", floatfmt=".2f"))
+            sys.exit(1)
+        print(f"\nNo regressions against {args.baseline}")
+
+if __name__ == '__main__':
+    main()
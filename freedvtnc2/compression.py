@@ -0,0 +1,142 @@
+"""
+Optional payload compression.
+
+Compressed packets are sent with header 0xfb and data [algorithm][inner header][compressed data]. The algorithm byte
+makes every packet self describing so the receiver doesn't need to know how the sender is configured - receiving is
+always enabled (zstd packets need the zstandard package). Packets that don't get smaller are sent as is.
+
+Both algorithms use a preset dictionary of strings that turn up a lot in AX.25, APRS, Winlink and chat traffic so
+even short packets compress. Changing the dictionary breaks compatibility - add a new algorithm id instead.
+"""
+from dataclasses import dataclass
+import logging
+import zlib
+from .framing import Packet, header_bytes
+
+try:
+    import zstandard
+    DECOMPRESS_ERRORS = (zlib.error, ValueError, zstandard.ZstdError)
+except ImportError:
+    zstandard = None
+    DECOMPRESS_ERRORS = (zlib.error, ValueError)
+
+COMPRESSED_HEADER = 0xfb
+ZLIB = 1
+ZSTD = 2
+ALGORITHMS = {"zlib": ZLIB, "zstd": ZSTD}
+COMPRESSIBLE_HEADERS = (0xff, 0xfe) # KISS and chat
+MAX_PACKET_BYTES = 65536 # stops a corrupt or malicious packet expanding to something huge
+
+def ax25_call(callsign: str, ssid: int = 0) -> bytes:
+    return bytes(x << 1 for x in callsign.ljust(6).encode()) + bytes([0x60 | ssid << 1])
+
+# zlib favours matches near the end of the dictionary so the most common strings are last
+DICTIONARY = b"".join([
+    b"Mime-Version: 1.0\r\nContent-Type: text/plain; charset=\"iso-8859-1\"\r\nContent-Transfer-Encoding: 8bit\r\n",
+    b"Type: Private\r\nFrom: SMTP:\r\nTo: \r\nCc: \r\nSubject: \r\nMbo: \r\nBody: \r\nFile: \r\nDate: ",
+    b"[WL2K-5.0-B2FWIHJM$]\r\n;FW: \r\nFC EM \r\nFF\r\nFQ\r\n;PQ: \r\n;PR: \r\n",
+    b"Message-ID: Content-Type: \r\n\r\n",
+    b"The quick brown fox jumps over the lazy dog. Thanks for the contact, 73 de ",
+    b" please QSL QRZ QTH QSY QRM QSB CQ CQ CQ de  k\r\n",
+    b"hello how are you? I am good thanks - copy your signal, see you on the next sked",
+    b"APRS,TCPIP*,qAC,T2:>Station on FreeDV data modem PHG2360/A=000/ ",
+    b":BLN1     :NWS-WARN :ack{ :rej}",
+    b"!0000.00N/00000.00E-/000/000/A=000000 ",
+    b"=0000.00S/00000.00E#PHG ",
+    b"@000000z0000.00N/00000.00W_000/000g000t000r000p000P000h00b10000 ",
+    ax25_call("BEACON"), ax25_call("ID"), ax25_call("CQ"), ax25_call("QST"),
+    ax25_call("APRS"), ax25_call("APZ"), ax25_call("APDW16"), ax25_call("APX211"),
+    ax25_call("RELAY"), ax25_call("TCPIP"), ax25_call("WIDE2", 2), ax25_call("WIDE2", 1), ax25_call("WIDE1", 1),
+    b"\x03\xf0", b"\x03\xf0!", b"\x03\xf0=", b"\x03\xf0`", b"\x03\xf0:",
+])
+
+@dataclass
+class CompressionStats():
+    packets: int = 0
+    compressed: int = 0 # packets that got smaller
+    raw_bytes: int = 0
+    sent_bytes: int = 0
+
+    @property
+    def ratio(self) -> float:
+        return self.raw_bytes / self.sent_bytes if self.sent_bytes else 1
+
+def zstd_dictionary():
+    return zstandard.ZstdCompressionDict(DICTIONARY, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+
+class Compressor():
+    """
+    Compresses packets before they're packed into frames and keeps per mode stats
+    """
+    def __init__(self, algorithm: str = "zlib", level: int = 9):
+        if algorithm == "zstd" and zstandard is None:
+            raise ValueError("zstd compression needs the zstandard package")
+        self.algorithm = algorithm
+        self.level = level
+        self.stats: dict[str, CompressionStats] = {}
+        if algorithm == "zstd":
+            self.zstd = zstandard.ZstdCompressor(level=level, dict_data=zstd_dictionary(), write_checksum=False, write_content_size=False, write_dict_id=False)
+
+    def compress_data(self, data: bytes) -> bytes:
+        if self.algorithm == "zstd":
+            return self.zstd.compress(data)
+        # raw deflate - the zlib header and checksum would cost 6 bytes and the modem frames already have CRCs
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15, 9, zdict=DICTIONARY)
+        return compressor.compress(data) + compressor.flush()
+
+    def compress(self, packet: Packet, mode: str) -> Packet:
+        """
+        Returns a compressed version of packet, or packet itself if compression doesn't make it smaller
+        """
+        header = header_bytes(packet)
+        if header[0] not in COMPRESSIBLE_HEADERS:
+            return packet
+        stats = self.stats.setdefault(mode, CompressionStats())
+        stats.packets += 1
+        stats.raw_bytes += len(packet.data)
+
+        data = bytes([ALGORITHMS[self.algorithm]]) + header + self.compress_data(packet.data)
+        if len(data) >= len(packet.data):
+            stats.sent_bytes += len(packet.data)
+            return packet
+        stats.compressed += 1
+        stats.sent_bytes += len(data)
+        return Packet(data, header=bytes([COMPRESSED_HEADER]), mode=packet.mode)
+
+    def rows(self, frame_info: dict[str, tuple[int, float]]) -> list[dict]:
+        """
+        Stats for each mode. frame_info maps mode to (frame payload bytes, seconds per frame) to work out throughput
+        """
+        rows = []
+        for mode, stats in self.stats.items():
+            payload_size, frame_seconds = frame_info[mode]
+            rows.append({
+                "mode": mode,
+                "packets": stats.packets,
+                "compressed": stats.compressed,
+                "raw bytes": stats.raw_bytes,
+                "sent bytes": stats.sent_bytes,
+                "ratio": round(stats.ratio, 2),
+                "effective B/s": round(payload_size / frame_seconds * stats.ratio, 1),
+            })
+        return rows
+
+def decompress(packet: Packet) -> Packet|None:
+    """
+    Restores a received 0xfb packet. Returns None if it can't be decompressed.
+    """
+    if len(packet.data) < 2:
+        return None
+    algorithm, header, data = packet.data[0], packet.data[1], packet.data[2:]
+    try:
+        if algorithm == ZLIB:
+            data = zlib.decompressobj(-15, zdict=DICTIONARY).decompress(data, MAX_PACKET_BYTES)
+        elif algorithm == ZSTD and zstandard is not None:
+            data = zstandard.ZstdDecompressor(dict_data=zstd_dictionary()).decompress(data, max_output_size=MAX_PACKET_BYTES)
+        else:
+            logging.warning(f"Received packet compressed with unsupported algorithm {algorithm}")
+            return None
+    except DECOMPRESS_ERRORS as e:
+        logging.warning(f"Failed to decompress packet: {e}")
+        return None
+    return Packet(data, header=header, mode=packet.mode, snr=packet.snr)
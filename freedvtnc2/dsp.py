@@ -0,0 +1,234 @@
+"""
+NumPy audio processing for the sound card side of the modem - metering, downmix, resampling, gain and upmix.
+
+This replaces audioop (removed in python 3.13). Apart from the polyphase resampler every function gives the same
+samples as the audioop call it replaces, including ratecv's interpolation and its state carried between blocks.
+Work arrays and interpolation positions are kept between calls.
+
+ratecv (LinearResampler) doesn't filter at all so anything above 4kHz at the sound card folds down into the modem's
+passband. PolyphaseResampler low pass filters as part of resampling and is the default.
+"""
+from functools import lru_cache
+import math
+import numpy as np
+
+ZERO_CROSSINGS = 6 # filter length either side of centre, in samples at the lower rate
+CUTOFF = 0.85 # of the lower rate's nyquist - DATAC modes stop around 2.5kHz
+KAISER_BETA = 8.0 # about 80dB rejection of anything that would alias into the modem's passband
+
+def rms(data: bytes) -> int:
+    """
+    Same as audioop.rms(data, 2)
+    """
+    samples = np.frombuffer(data, dtype=np.int16)
+    if not len(samples):
+        return 0
+    samples = samples.astype(np.float64)
+    return int(math.sqrt(np.dot(samples, samples) / len(samples)))
+
+def peak(samples: np.ndarray) -> int:
+    """
+    Same as audioop.max - the largest absolute sample
+    """
+    if not len(samples):
+        return 0
+    return max(int(samples.max()), -int(samples.min()))
+
+def dbfs(level: int) -> float:
+    return 20*math.log10(level/2**15) if level else -99
+
+def sine(frequency: float, sample_rate: int, duration_ms: int, volume: float = 0) -> bytes:
+    """
+    16 bit mono sine wave peaking at volume dBFS
+    """
+    t = np.arange(sample_rate * duration_ms // 1000) / sample_rate
+    amplitude = (2**15 - 1) * 10**(volume/20)
+    return (np.sin(2*np.pi*frequency*t) * amplitude).astype(np.int16).tobytes()
+
+class LinearResampler():
+    """
+    Stateful linear interpolating resampler for 16 bit mono audio. Gives exactly the same output as feeding the same
+    blocks through audioop.ratecv(data, 2, 1, in_rate, out_rate, state).
+    """
+    def __init__(self, in_rate: int, out_rate: int):
+        divisor = math.gcd(in_rate, out_rate)
+        self.in_rate = in_rate // divisor
+        self.out_rate = out_rate // divisor
+        self.d = -self.out_rate # ratecv's state - (d, ((prev, cur),)) with samples scaled up to 32 bits
+        self.prev = 0
+        self.cur = 0
+        self.history = np.zeros(0, dtype=np.float64)
+        # sound cards deliver the same block size every time so the interpolation positions repeat. Keyed by
+        # (d, block size)
+        self.positions: dict[tuple[int, int], tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+
+    def interpolation(self, n: int, count: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        For each output sample - index of the previous input in history and the weights of the previous and current
+        input
+        """
+        key = (self.d, n)
+        positions = self.positions.get(key)
+        if positions is None:
+            if len(self.positions) >= 64: # odd block sizes - don't grow forever
+                self.positions.clear()
+            j = np.arange(count, dtype=np.int64) * self.in_rate
+            m = np.maximum(-((self.d - j) // self.out_rate), 0)
+            d = (m * self.out_rate + self.d - j).astype(np.float64)
+            positions = self.positions[key] = (m, d, self.out_rate - d)
+        return positions
+
+    def process(self, samples: np.ndarray) -> np.ndarray:
+        n = len(samples)
+        total = n * self.out_rate + self.d
+        count = total // self.in_rate + 1 if total >= 0 else 0
+        if len(self.history) < n + 2:
+            self.history = np.zeros(n + 2, dtype=np.float64)
+
+        # history is [prev, cur, samples...] so output j interpolates history[m] and history[m + 1] where m is the
+        # number of input samples consumed before it's produced
+        history = self.history[:n+2]
+        history[0] = self.prev
+        history[1] = self.cur
+        np.multiply(samples, 65536.0, out=history[2:])
+
+        m, previous_weight, current_weight = self.interpolation(n, count)
+        # the same double maths as ratecv - every value is an exact integer so there's no rounding until the
+        # truncating divide, then the 32 bit sample is shifted back down to 16 bits
+        output = history[m] * previous_weight
+        output += history[1:][m] * current_weight
+        output /= self.out_rate
+        np.trunc(output, out=output)
+        output /= 65536
+        np.floor(output, out=output)
+
+        self.d = int(total - count * self.in_rate)
+        self.prev = int(history[n])
+        self.cur = int(history[n + 1])
+        return output.astype(np.int16)
+
+@lru_cache(maxsize=None)
+def filter_bank(up: int, down: int) -> np.ndarray:
+    """
+    Windowed sinc low pass filter for resampling by up/down, split into up phases. bank[phase] is in window order
+    (oldest input first) so an output is just a dot product with the inputs.
+    """
+    factor = max(up, down)
+    taps = -(-2 * ZERO_CROSSINGS * factor // up)
+    length = taps * up
+    t = (np.arange(length) - (length - 1) / 2) / factor
+    h = CUTOFF * np.sinc(CUTOFF * t) * np.kaiser(length, KAISER_BETA)
+    h *= up / h.sum()
+    return np.ascontiguousarray(h.reshape(taps, up).T[:, ::-1])
+
+@lru_cache(maxsize=None)
+def period_matrix(up: int, down: int) -> tuple[np.ndarray, int]:
+    """
+    Every down inputs make up outputs with the same phases each time, so resampling is a matrix multiply. Returns the
+    filter arranged as (down, blocks*up) - the weights for the block of down inputs that's 0..blocks-1 blocks after
+    the period starts - and the number of blocks. Cached as sound cards only use a few rates (48000/8000 and
+    44100/8000 both ways).
+    """
+    bank = filter_bank(up, down)
+    taps = bank.shape[1]
+    offsets = [r * down // up for r in range(up)]
+    blocks = -(-(max(offsets) + taps) // down)
+    matrix = np.zeros((blocks * down, up))
+    for r, offset in enumerate(offsets):
+        matrix[offset:offset+taps, r] = bank[r * down % up]
+    matrix = matrix.reshape(blocks, down, up).transpose(1, 0, 2).reshape(down, blocks * up)
+    return np.ascontiguousarray(matrix, dtype=np.float32), blocks
+
+class PolyphaseResampler():
+    """
+    Stateful polyphase FIR resampler for 16 bit mono audio. Inputs that don't make up a whole period (down samples)
+    wait for the next block along with the filter history so blocks join up seamlessly.
+    """
+    def __init__(self, in_rate: int, out_rate: int):
+        divisor = math.gcd(in_rate, out_rate)
+        self.up = out_rate // divisor
+        self.down = in_rate // divisor
+        self.matrix, self.blocks = period_matrix(self.up, self.down)
+        self.bank = filter_bank(self.up, self.down).astype(np.float32)
+        taps = self.bank.shape[1]
+        self.buffer = np.zeros(self.blocks * self.down + taps, dtype=np.float32)
+        self.length = taps - 1 # starts with taps - 1 samples of silence as history
+
+    def process(self, samples: np.ndarray) -> np.ndarray:
+        n = len(samples)
+        if len(self.buffer) < self.length + n:
+            self.buffer = np.concatenate([self.buffer[:self.length], np.zeros(n + self.blocks * self.down, dtype=np.float32)])
+        self.buffer[self.length:self.length+n] = samples
+        self.length += n
+
+        periods = max((self.length - self.blocks * self.down) // self.down + 1, 0)
+        if self.down == 1: # interpolating - a single input per period so the matrix would be one row
+            windows = np.lib.stride_tricks.sliding_window_view(self.buffer[:self.length], self.bank.shape[1])
+            output = (windows[:periods] @ self.bank.T).ravel()
+        else:
+            rows = periods + self.blocks - 1
+            z = self.buffer[:rows*self.down].reshape(rows, self.down) @ self.matrix
+            # period c is the sum of block s of the filter applied to input block c + s
+            row, column = z.strides
+            output = np.lib.stride_tricks.as_strided(
+                z, shape=(periods, self.blocks, self.up), strides=(row, row + self.up*column, column)
+            ).sum(axis=1).ravel()
+
+        used = periods * self.down
+        self.buffer[:self.length-used] = self.buffer[used:self.length]
+        self.length -= used
+        np.rint(output, out=output)
+        np.clip(output, -2**15, 2**15 - 1, out=output)
+        return output.astype(np.int16)
+
+RESAMPLERS = {"polyphase": PolyphaseResampler, "linear": LinearResampler}
+
+def make_resampler(kind: str, in_rate: int, out_rate: int) -> PolyphaseResampler|LinearResampler|None:
+    return RESAMPLERS[kind](in_rate, out_rate) if in_rate != out_rate else None
+
+class InputDSP():
+    """
+    Sound card input to modem audio - peak level of the block, first channel only and resampled to the modem rate
+    """
+    def __init__(self, channels: int, device_rate: int, modem_rate: int, resampler: str = "polyphase"):
+        self.channels = channels
+        self.resampler = make_resampler(resampler, device_rate, modem_rate)
+        self.level = -99 # dBFS of the last block
+
+    def process(self, data: bytes) -> bytes:
+        samples = np.frombuffer(data, dtype=np.int16)
+        self.level = dbfs(peak(samples))
+        mono = samples[::self.channels]
+        if self.resampler:
+            mono = self.resampler.process(mono)
+        return mono.tobytes()
+
+class OutputDSP():
+    """
+    Modem audio to the sound card - resampled to the device rate, gain in db applied and copied to every channel
+    """
+    def __init__(self, channels: int, modem_rate: int, device_rate: int, db: float = 0, resampler: str = "polyphase"):
+        self.channels = channels
+        self.resampler = make_resampler(resampler, modem_rate, device_rate)
+        self.db = db
+        self.gain = np.zeros(0, dtype=np.float64)
+        self.output = np.zeros((0, channels), dtype=np.int16)
+
+    def process(self, data: bytes) -> bytes:
+        samples = np.frombuffer(data, dtype=np.int16)
+        if self.resampler:
+            samples = self.resampler.process(samples)
+        n = len(samples)
+        if len(self.output) < n:
+            self.gain = np.zeros(n, dtype=np.float64)
+            self.output = np.zeros((n, self.channels), dtype=np.int16)
+        output = self.output[:n]
+        if self.db:
+            # audioop.mul rounds down and clips
+            gain = self.gain[:n]
+            np.multiply(samples, 10**(self.db/20.0), out=gain)
+            np.floor(gain, out=gain)
+            np.clip(gain, -2**15, 2**15 - 1, out=gain)
+            samples = gain
+        output[:] = samples[:, None]
+        return output.tobytes()
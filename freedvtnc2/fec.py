@@ -0,0 +1,138 @@
+"""
+Forward erasure coding for packets that span multiple modem frames.
+
+A protected packet is sent as a block of n data frames followed by k repair frames. Every frame in the block is
+[0xfa][packet id 2 bytes][index][n][k][symbol] and the data symbols are [header][2 byte length][data] split into
+equal sized pieces. The receiver can rebuild the packet from any n of the n+k frames.
+
+The code is a systematic Reed-Solomon code over GF(256) using a Cauchy matrix, so any n x n submatrix can be
+inverted and decoding only has to solve for the missing data frames. Multiplying a whole symbol by a constant is a
+single bytes.translate with a 256 byte table and symbols are XORed as ints, which keeps this fast in pure Python.
+"""
+from functools import lru_cache
+import math
+
+FEC_HEADER = 0xfa
+FEC_OVERHEAD = 6 # bytes of header in every FEC frame
+MAX_BLOCK_FRAMES = 255 # data plus repair frames - indexes are a single byte
+
+# log / antilog tables for GF(256) with the 0x11d polynomial
+GF_EXP = [0] * 512
+GF_LOG = [0] * 256
+_x = 1
+for _i in range(255):
+    GF_EXP[_i] = _x
+    GF_LOG[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= 0x11d
+for _i in range(255, 512):
+    GF_EXP[_i] = GF_EXP[_i - 255]
+
+def gf_mul(a: int, b: int) -> int:
+    if a == 0 or b == 0:
+        return 0
+    return GF_EXP[GF_LOG[a] + GF_LOG[b]]
+
+def gf_inv(a: int) -> int:
+    return GF_EXP[255 - GF_LOG[a]]
+
+@lru_cache(maxsize=256)
+def mul_table(c: int) -> bytes:
+    """
+    Translation table that multiplies every byte by c
+    """
+    return bytes(gf_mul(c, x) for x in range(256))
+
+def cauchy(row: int, column: int, n: int) -> int:
+    """
+    Coefficient of data symbol column in repair symbol row. x (n + row) and y (column) never overlap so x ^ y is never 0
+    """
+    return gf_inv((n + row) ^ column)
+
+def repair_count(n: int, repair: float) -> int:
+    """
+    Number of repair frames to add to n data frames for a repair ratio (eg 0.25 = one repair frame per 4 data frames)
+    """
+    return min(math.ceil(n * repair), MAX_BLOCK_FRAMES - n) if repair > 0 else 0
+
+def encode(symbols: list[bytes], k: int) -> list[bytes]:
+    """
+    Returns k repair symbols for the equal length data symbols
+    """
+    n = len(symbols)
+    size = len(symbols[0])
+    repairs = []
+    for row in range(k):
+        accumulator = 0
+        for column, symbol in enumerate(symbols):
+            accumulator ^= int.from_bytes(symbol.translate(mul_table(cauchy(row, column, n))))
+        repairs.append(accumulator.to_bytes(size))
+    return repairs
+
+def invert(matrix: list[list[int]]) -> list[list[int]]:
+    """
+    Gauss-Jordan inversion over GF(256). Cauchy submatrices are always invertible.
+    """
+    size = len(matrix)
+    rows = [row[:] + [int(i == j) for j in range(size)] for i, row in enumerate(matrix)]
+    for column in range(size):
+        pivot = next(i for i in range(column, size) if rows[i][column])
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+        scale = gf_inv(rows[column][column])
+        rows[column] = [gf_mul(scale, x) for x in rows[column]]
+        for i in range(size):
+            if i != column and rows[i][column]:
+                factor = rows[i][column]
+                rows[i] = [x ^ gf_mul(factor, y) for x, y in zip(rows[i], rows[column])]
+    return [row[size:] for row in rows]
+
+def decode(received: dict[int, bytes], n: int) -> list[bytes]:
+    """
+    Rebuilds the n data symbols from any n received symbols (keyed by index - data is 0..n-1, repair n..n+k-1).
+    Raises ValueError if there aren't enough symbols.
+    """
+    missing = [i for i in range(n) if i not in received]
+    if not missing:
+        return [received[i] for i in range(n)]
+    repair_rows = [i - n for i in sorted(received) if i >= n][:len(missing)]
+    if len(repair_rows) < len(missing):
+        raise ValueError(f"Need {n} symbols to decode, only have {len(received)}")
+    size = len(next(iter(received.values())))
+
+    # take the known data symbols out of each repair symbol, leaving a combination of just the missing ones
+    remainders = []
+    for row in repair_rows:
+        accumulator = int.from_bytes(received[n + row])
+        for column in range(n):
+            if column in received:
+                accumulator ^= int.from_bytes(received[column].translate(mul_table(cauchy(row, column, n))))
+        remainders.append(accumulator.to_bytes(size))
+
+    inverse = invert([[cauchy(row, column, n) for column in missing] for row in repair_rows])
+    symbols = dict((i, received[i]) for i in range(n) if i in received)
+    for i, column in enumerate(missing):
+        accumulator = 0
+        for coefficient, remainder in zip(inverse[i], remainders):
+            if coefficient:
+                accumulator ^= int.from_bytes(remainder.translate(mul_table(coefficient)))
+        symbols[column] = accumulator.to_bytes(size)
+    return [symbols[i] for i in range(n)]
+
+def data_frames(length: int, payload_size: int) -> int:
+    """
+    Number of data frames for a packet of length bytes with payload_size frames
+    """
+    return math.ceil((length + 3) / (payload_size - FEC_OVERHEAD))
+
+def fec_frames(packet_id: bytes, header: bytes, data: bytes, payload_size: int, repair: float) -> list[bytearray]:
+    """
+    Frames (without CRCs) for a packet protected with repair frames
+    """
+    size = payload_size - FEC_OVERHEAD
+    n = data_frames(len(data), payload_size)
+    k = repair_count(n, repair)
+    payload = (header + len(data).to_bytes(2) + data).ljust(n * size, b"\x00")
+    symbols = [payload[x*size:(x+1)*size] for x in range(n)]
+    symbols += encode(symbols, k)
+    return [bytearray(bytes([FEC_HEADER]) + packet_id + bytes([index, n, k]) + symbol) for index, symbol in enumerate(symbols)]
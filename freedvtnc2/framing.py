@@ -0,0 +1,570 @@
+"""
+Our packet format is. Packet must be less than 32768
+
+Short packet
+[header byte > 200] [2 byte short for length of data in bytes] [data]
+
+Long packet
+[sequence number 0-200] [data]
+"""
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable
+import logging
+import math
+import time
+import zlib
+from . import fec
+
+SEQ_MODULO = 201 # sequence numbers wrap so they never collide with header bytes (> 200)
+
+# ARQ packets always start at the beginning of a frame and have their frames to themselves so any frame can be
+# placed from its sequence number. [packet id 2 bytes][crc32 of data 4 bytes][inner header][data]
+ARQ_HEADER = 0xfc
+ARQ_OVERHEAD = 7
+# sent back by the receiver - [packet id 2 bytes][bitmap of missing frames, bit 0 of the first byte is the start frame]
+ARQ_NACK_HEADER = 0xfd
+# fills out the last burst when sending multiple frames per burst - the whole frame is ignored
+PADDING_HEADER = 0xf9
+
+@dataclass
+class Packet():
+    data: bytes
+    header: int|bytes = b"\xff"
+    mode: str = None
+    snr: float|None = None
+
+@dataclass
+class PartialPacket():
+    """
+    A packet that is being reassembled. The buffer is allocated up front from the length header.
+    """
+    header: int
+    buffer: bytearray
+    received: int
+    next_seq: int
+    updated: float
+
+    @property
+    def remaining(self) -> int:
+        return len(self.buffer) - self.received
+
+@dataclass
+class ArqPartial(PartialPacket):
+    """
+    An ARQ packet being reassembled. Frames can arrive in any order and are kept across gaps until the packet
+    is complete or times out.
+    """
+    frame_size: int = 0
+    frames: list[bool] = field(default_factory=list) # which frames have been received
+    waiting: bool = False # the transmission ended - ignore continuation frames until the start frame is resent
+    dirty: bool = False # the packet has been heard since the last NACK
+    nacks: int = 0
+
+    @property
+    def packet_id(self) -> bytes:
+        return bytes(self.buffer[:2])
+
+    def offset(self, index: int) -> int:
+        return 0 if index == 0 else self.frame_size - 3 + (index - 1) * (self.frame_size - 1)
+
+    def bitmap(self) -> bytes:
+        bitmap = bytearray(math.ceil(len(self.frames) / 8))
+        for index, received in enumerate(self.frames):
+            if not received:
+                bitmap[index // 8] |= 1 << (index % 8)
+        return bytes(bitmap)
+
+@dataclass
+class FecBlock():
+    """
+    Frames received so far for a packet protected with forward erasure coding (see fec.py)
+    """
+    n: int
+    k: int
+    symbols: dict[int, bytes]
+    updated: float
+
+    @property
+    def size(self) -> int:
+        return sum(len(x) for x in self.symbols.values())
+
+def arq_frame_count(length: int, frame_size: int) -> int:
+    """
+    Number of frames an ARQ packet of length bytes (including the ARQ header) takes in frame_size frames
+    """
+    return 1 + math.ceil(max(0, length - (frame_size - 3)) / (frame_size - 1))
+
+class Reassembler():
+    """
+    Rebuilds packets from modem frames. Each mode has its own in flight packet so bursts arriving on different
+    modes can't corrupt each other.
+
+    Incomplete packets are dropped if no frame has arrived for them in timeout seconds, or when starting a new
+    packet would take the total memory used by in flight packets over max_bytes (oldest are dropped first).
+    Dropped packets are passed to dropped along with their mode.
+
+    Each mode can also hold one incomplete ARQ packet. When the transmission ends (see end_of_transmission) a NACK
+    listing its missing frames is passed to nack to send back, up to max_nacks times. It's NACKed again after any
+    later transmission on the mode, in case that was the resend and its start frame was lost.
+
+    FEC frames are self contained, so any number of FEC blocks can be collected at once. A block is decoded as soon
+    as enough of its frames have arrived.
+    """
+    def __init__(self,
+                 callback: Callable[[Packet],None],
+                 progress: Callable[[int,int,str],None]|None = None,
+                 timeout: float = 120,
+                 max_bytes: int = 256*1024,
+                 clock: Callable[[],float] = time.monotonic,
+                 dropped: Callable[[PartialPacket,str],None]|None = None,
+                 nack: Callable[[Packet],None]|None = None,
+                 max_nacks: int = 3
+                 ):
+        self.callback = callback
+        self.progress = progress
+        self.dropped = dropped
+        self.nack = nack
+        self.max_nacks = max_nacks
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.partials: dict[str, PartialPacket] = {}
+        self.arq: dict[str, ArqPartial] = {}
+        self.arq_active: set[str] = set() # modes where continuation frames belong to the ARQ packet
+        self.arq_done = deque(maxlen=32) # (mode, packet id) of recently completed ARQ packets so late resends are ignored
+        self.fec: dict[tuple[str, bytes], FecBlock] = {}
+        self.fec_done = deque(maxlen=32) # (mode, packet id) of decoded FEC blocks so their remaining repair frames are ignored
+
+    @property
+    def in_flight_bytes(self) -> int:
+        return (
+            sum(len(x.buffer) for x in [*self.partials.values(), *self.arq.values()]) +
+            sum(x.size for x in self.fec.values())
+        )
+
+    def drop(self, mode: str) -> None:
+        partial = self.partials.pop(mode, None)
+        if partial is not None and self.dropped:
+            self.dropped(partial, mode)
+
+    def drop_arq(self, mode: str) -> None:
+        self.arq_active.discard(mode)
+        partial = self.arq.pop(mode, None)
+        if partial is not None and self.dropped:
+            self.dropped(partial, mode)
+
+    def expire(self, now: float) -> None:
+        for mode, partial in list(self.partials.items()):
+            if now - partial.updated > self.timeout:
+                logging.debug(f"[{mode}] Dropping stale partial packet - received {partial.received}/{len(partial.buffer)} bytes")
+                self.drop(mode)
+        for mode, partial in list(self.arq.items()):
+            if now - partial.updated > self.timeout:
+                logging.debug(f"[{mode}] Dropping stale ARQ packet - received {partial.received}/{len(partial.buffer)} bytes")
+                self.drop_arq(mode)
+        for key, block in list(self.fec.items()):
+            if now - block.updated > self.timeout:
+                logging.debug(f"[{key[0]}] Dropping stale FEC block - received {len(block.symbols)}/{block.n} frames")
+                del self.fec[key]
+
+    def make_room(self, length: int) -> bool:
+        """
+        Drops the oldest partial packets until there's room for a new packet of length. False if it can never fit.
+        """
+        if length > self.max_bytes:
+            logging.warning(f"Packet of {length} bytes is larger than the reassembly limit of {self.max_bytes} bytes")
+            return False
+        while self.in_flight_bytes + length > self.max_bytes:
+            held = [(x.updated, self.drop, mode) for mode, x in self.partials.items()]
+            held += [(x.updated, self.drop_arq, mode) for mode, x in self.arq.items()]
+            held += [(x.updated, self.fec.pop, key) for key, x in self.fec.items()]
+            if not held:
+                break
+            _, drop, oldest = min(held, key=lambda x: x[0])
+            logging.warning(f"[{oldest}] Reassembly memory limit reached - dropping partial packet")
+            drop(oldest)
+        return True
+
+    def start(self, mode: str, header: int, length: int, now: float) -> PartialPacket|None:
+        self.drop(mode) # a new start replaces anything in flight on this mode
+        self.arq_active.discard(mode)
+        if not self.make_room(length):
+            return None
+        partial = PartialPacket(header=header, buffer=bytearray(length), received=0, next_seq=0, updated=now)
+        self.partials[mode] = partial
+        return partial
+
+    def start_arq(self, mode: str, packet_id: bytes, length: int, frame_size: int, now: float) -> ArqPartial|None:
+        self.drop(mode)
+        partial = self.arq.get(mode)
+        if partial and partial.packet_id == packet_id and len(partial.buffer) == length and partial.frame_size == frame_size:
+            logging.debug(f"[{mode}] Resuming ARQ packet {packet_id.hex()}")
+        else:
+            self.drop_arq(mode)
+            if (mode, packet_id) in self.arq_done or length < ARQ_OVERHEAD or not self.make_room(length):
+                return None
+            partial = ArqPartial(
+                header=ARQ_HEADER, buffer=bytearray(length), received=0, next_seq=0, updated=now,
+                frame_size=frame_size, frames=[False] * arq_frame_count(length, frame_size)
+            )
+            self.arq[mode] = partial
+        partial.waiting = False
+        partial.dirty = True # NACK again after this transmission even if it only brought frames we already had
+        self.arq_active.add(mode)
+        return partial
+
+    def feed_arq(self, partial: ArqPartial, index: int, chunk: memoryview, mode: str, now: float, snr: float|None) -> None:
+        if partial.waiting or index >= len(partial.frames):
+            return
+        partial.updated = now
+        if partial.frames[index]:
+            return # already have it
+        offset = partial.offset(index)
+        take = min(len(chunk), len(partial.buffer) - offset)
+        partial.buffer[offset:offset+take] = chunk[:take]
+        partial.frames[index] = True
+        partial.received += take
+        partial.dirty = True
+
+        logging.debug(f"[{mode}] ARQ frame {index} Remaining data: {partial.remaining}")
+        if self.progress:
+            self.progress(len(partial.buffer), partial.remaining, mode)
+
+        if not all(partial.frames):
+            return
+        del self.arq[mode]
+        self.arq_active.discard(mode)
+        self.arq_done.append((mode, partial.packet_id))
+        data = bytes(partial.buffer[ARQ_OVERHEAD:])
+        if zlib.crc32(data) != int.from_bytes(partial.buffer[2:6]):
+            logging.warning(f"[{mode}] ARQ packet {partial.packet_id.hex()} failed its CRC")
+            if self.dropped:
+                self.dropped(partial, mode)
+            return
+        self.callback(Packet(header=partial.buffer[6], data=data, mode=mode, snr=snr))
+
+    def feed_fec(self, data: memoryview, mode: str, now: float, snr: float|None) -> None:
+        key = (mode, bytes(data[1:3]))
+        index, n, k = data[3], data[4], data[5]
+        if key in self.fec_done or n == 0 or index >= n + k:
+            return
+        block = self.fec.get(key)
+        if block is None or block.n != n or block.k != k:
+            self.fec.pop(key, None)
+            if not self.make_room(n * (len(data) - fec.FEC_OVERHEAD)):
+                return
+            block = self.fec[key] = FecBlock(n=n, k=k, symbols={}, updated=now)
+        block.symbols[index] = bytes(data[fec.FEC_OVERHEAD:])
+        block.updated = now
+
+        remaining = max(0, n - len(block.symbols))
+        logging.debug(f"[{mode}] FEC frame {index} of {n}+{k} - need {remaining} more")
+        if self.progress:
+            size = len(data) - fec.FEC_OVERHEAD
+            self.progress(n * size, remaining * size, mode)
+        if remaining:
+            return
+
+        del self.fec[key]
+        self.fec_done.append(key)
+        payload = b"".join(fec.decode(block.symbols, n))
+        length = int.from_bytes(payload[1:3])
+        if length > len(payload) - 3:
+            logging.debug(f"[{mode}] FEC block length {length} is longer than the block")
+            return
+        self.callback(Packet(header=payload[0], data=payload[3:3+length], mode=mode, snr=snr))
+
+    def end_of_transmission(self, mode: str) -> None:
+        """
+        Called when the station we were receiving on mode stops transmitting. NACKs the missing frames of the
+        ARQ packet on this mode if any arrived during the transmission.
+        """
+        self.arq_active.discard(mode)
+        partial = self.arq.get(mode)
+        if partial is None:
+            return
+        partial.waiting = True
+        if not partial.dirty:
+            return
+        partial.dirty = False
+        if partial.nacks >= self.max_nacks:
+            logging.debug(f"[{mode}] Giving up on ARQ packet {partial.packet_id.hex()}")
+            self.drop_arq(mode)
+            return
+        partial.nacks += 1
+        logging.debug(f"[{mode}] NACKing {partial.frames.count(False)} frames of ARQ packet {partial.packet_id.hex()}")
+        if self.nack:
+            self.nack(Packet(partial.packet_id + partial.bitmap(), header=bytes([ARQ_NACK_HEADER]), mode=mode))
+
+    def feed(self, data: bytes, mode: str, snr: float|None = None) -> None:
+        """
+        Process the payload of one modem frame (CRC removed) received on mode. snr is attached to any packets completed by this frame.
+        """
+        now = self.clock()
+        self.expire(now)
+
+        data = memoryview(data)
+        waiting = self.arq.get(mode)
+        if waiting is not None and waiting.waiting:
+            # the other station is sending again. If it's our resend and its start frame was lost, the continuation
+            # frames are ignored - NACK again at the end of the transmission rather than wait for the timeout
+            waiting.dirty = True
+        if not len(data) or data[0] == PADDING_HEADER:
+            return
+        if len(data) > fec.FEC_OVERHEAD and data[0] == fec.FEC_HEADER: # FEC frames are self contained
+            self.feed_fec(data, mode, now, snr)
+            return
+        pos = 0
+        while pos < len(data):
+            header = data[pos]
+            pos += 1
+            partial = self.partials.get(mode)
+            if header == ARQ_HEADER and pos == 1 and len(data) >= 5: # ARQ start - always at the start of the frame
+                length = int.from_bytes(data[1:3])
+                logging.debug(f"[{mode}] Found ARQ packet start - Expecting {length} bytes")
+                partial = self.start_arq(mode, bytes(data[3:5]), length, len(data), now)
+                if partial is not None:
+                    self.feed_arq(partial, 0, data[3:], mode, now, snr)
+                return
+            elif header > 200: # start of packet
+                length = int.from_bytes(data[pos:pos+2])
+                pos += 2
+                logging.debug(f"[{mode}] Found packet start - Expecting {length} bytes")
+                partial = self.start(mode, header, length, now)
+                if partial is None:
+                    return
+            elif mode in self.arq_active: # continuation of an ARQ packet - seq is the frame index after the start frame
+                self.feed_arq(self.arq[mode], header + 1, data[1:], mode, now, snr)
+                return
+            elif partial is not None: # should be a seq number
+                if partial.next_seq != header:
+                    logging.debug(f"[{mode}] Missing data - header seq expected {partial.next_seq}, got {header}")
+                    logging.debug(f"Full data frame: {str(bytes(data))}")
+                    self.drop(mode)
+                    return
+                logging.debug(f"[{mode}] Received frame {header}")
+                partial.next_seq = (partial.next_seq + 1) % SEQ_MODULO
+            else:
+                if header != 0:
+                    logging.debug(f"[{mode}] Not expecting data - got {header}")
+                    logging.debug(f"Full data frame: {str(bytes(data))}")
+                return
+
+            take = min(partial.remaining, len(data) - pos)
+            partial.buffer[partial.received:partial.received+take] = data[pos:pos+take]
+            partial.received += take
+            partial.updated = now
+            pos += take
+
+            logging.debug(f"[{mode}] Seq: {header} Remaining data: {partial.remaining}")
+            if self.progress:
+                self.progress(len(partial.buffer), partial.remaining, mode)
+
+            if partial.remaining:
+                return # rest of the packet is in the next frame
+            del self.partials[mode]
+            self.callback(Packet(header=partial.header, data=bytes(partial.buffer), mode=mode, snr=snr))
+
+def header_bytes(packet: Packet) -> bytes:
+    return packet.header if isinstance(packet.header, bytes) else bytes([packet.header])
+
+def pack_greedy(queue: list[Packet], payload_size: int, max_packets_combined: int = 5) -> list[bytearray]:
+    """
+    The original packer - fills frames in queue order, starting a new frame when the current one is full or has
+    max_packets_combined packets starting in it.
+    Frames are payload_size bytes (the modem frame minus the CRC). Packets are removed from the queue.
+    """
+    frames = []
+    pop_packet_length = payload_size - 3 # first iteration we use 3 bytes for the header
+    frame=bytearray(payload_size)
+    used_bytes = 0
+
+    number_combined = 0 # packets starting in this frame
+
+    while queue:
+        packet = queue.pop(0)
+        data = bytearray(packet.data)
+        chunks = []
+        header_byte = header_bytes(packet)
+        
+        while data:
+            chunks.append(data[:pop_packet_length])
+            del data[:pop_packet_length]
+            pop_packet_length = payload_size - 1 # next iterations only use 1 byte for sequence
+
+
+        # header
+        header = header_byte + sum([len(x) for x in chunks]).to_bytes(2)
+        frame[0+used_bytes:3+used_bytes] = header
+
+        chunk = chunks[0]
+
+        # data
+        frame[3+used_bytes:3+len(chunk)+used_bytes] = chunk
+        used_bytes = used_bytes + len(chunk) + len(header) 
+        number_combined += 1
+
+
+        for header, chunk in enumerate(chunks[1:]):
+            used_bytes = 0
+            number_combined = 0
+            frames.append(frame)
+            frame=bytearray(payload_size)
+            # header
+            header = (header % SEQ_MODULO).to_bytes(1)
+            frame[0:len(header)] = header
+        
+            frame[1:1+len(chunk)] = chunk
+            used_bytes = used_bytes + len(chunk) + len(header) 
+
+        # can we fit a little more data in? we need three bytes to start the next payload
+        if number_combined >= max_packets_combined or used_bytes > payload_size - 3:
+            if queue:
+                if number_combined >= max_packets_combined:
+                    logging.debug("max combined frames reached")
+                frames.append(frame)
+                frame=bytearray(payload_size)
+                used_bytes = 0
+                pop_packet_length = payload_size - 3
+                number_combined = 0
+        else:
+            pop_packet_length = payload_size - used_bytes - 3
+    frames.append(frame)
+    return frames
+
+class FrameBuilder():
+    """
+    A frame being filled by pack_frames. Data is always appended at used.
+    """
+    def __init__(self, payload_size: int):
+        self.data = bytearray(payload_size)
+        self.used = 0
+        self.packets = 0 # number of packets that start in this frame
+
+    @property
+    def free(self) -> int:
+        return len(self.data) - self.used
+
+    def append(self, data: bytes) -> None:
+        self.data[self.used:self.used+len(data)] = data
+        self.used += len(data)
+
+class FrameCounter():
+    """
+    Follows the same rules as pack_in_order without building the frames, to count how many an ordering needs
+    """
+    def __init__(self, payload_size: int, max_packets_combined: int):
+        self.payload_size = payload_size
+        self.max_packets_combined = max_packets_combined
+        self.frames = 1
+        self.free = payload_size
+        self.packets = 0
+
+    def full(self) -> bool:
+        return self.free < 3 or self.packets >= self.max_packets_combined
+
+    def add(self, length: int) -> None:
+        if self.full():
+            self.frames += 1
+            self.free = self.payload_size
+            self.packets = 0
+        self.packets += 1
+        self.free -= 3
+        while length > self.free: # continues in the next frames
+            length -= self.free
+            self.frames += 1
+            self.free = self.payload_size - 1
+            self.packets = 0
+        self.free -= length
+
+def count_frames(packets: list[Packet], payload_size: int, max_packets_combined: int) -> int:
+    counter = FrameCounter(payload_size, max_packets_combined)
+    for packet in packets:
+        counter.add(len(packet.data))
+    return counter.frames
+
+def connection(packet: Packet) -> bytes:
+    """
+    Packets with the same connection are never reordered - KISS data frames between the same two AX.25 stations (a
+    reordered I frame gets a REJ and resends) and anything else by its header
+    """
+    header = header_bytes(packet)
+    return header + bytes(packet.data[:14]) if header == b"\xff" else header
+
+def packing_order(queue: list[Packet], payload_size: int, max_packets_combined: int, window: int) -> list[Packet]:
+    """
+    Orders packets to fill frames: packets that fit completely are added in queue order and the last packet slot of
+    each frame is saved for the largest packet, which fills the rest of the frame and carries on into the next one.
+    Packets are only moved within each group of window queued packets, and never ahead of an earlier packet on the
+    same connection.
+    """
+    order = []
+    counter = FrameCounter(payload_size, max_packets_combined)
+    for offset in range(0, len(queue), window):
+        batch = queue[offset:offset+window]
+        while batch:
+            seen = set()
+            movable = [] # the first packet of each connection in the batch
+            for i, packet in enumerate(batch):
+                if connection(packet) not in seen:
+                    seen.add(connection(packet))
+                    movable.append(i)
+            free, packets = (payload_size, 0) if counter.full() else (counter.free, counter.packets)
+
+            index = None
+            if packets < max_packets_combined - 1:
+                index = next((i for i in movable if len(batch[i].data) + 3 <= free), None)
+            if index is None:
+                index = max(movable, key=lambda i: len(batch[i].data))
+            packet = batch.pop(index)
+            counter.add(len(packet.data))
+            order.append(packet)
+    return order
+
+def pack_in_order(packets: list[Packet], payload_size: int, max_packets_combined: int) -> list[bytearray]:
+    """
+    Packs packets into frames in the order given. The same frames as pack_greedy
+    """
+    frames = []
+    frame = FrameBuilder(payload_size)
+    for packet in packets:
+        if frame.free < 3 or frame.packets >= max_packets_combined:
+            frames.append(frame.data)
+            frame = FrameBuilder(payload_size)
+
+        data = memoryview(packet.data)
+        frame.append(header_bytes(packet) + len(data).to_bytes(2))
+        frame.packets += 1
+        chunk = min(frame.free, len(data))
+        frame.append(data[:chunk])
+        data = data[chunk:]
+
+        seq = 0
+        while data: # continues in the next frames
+            frames.append(frame.data)
+            frame = FrameBuilder(payload_size)
+            frame.append(bytes([seq % SEQ_MODULO]))
+            chunk = min(frame.free, len(data))
+            frame.append(data[:chunk])
+            data = data[chunk:]
+            seq += 1
+    frames.append(frame.data)
+    return frames
+
+def pack_frames(queue: list[Packet], payload_size: int, max_packets_combined: int = 5, window: int = 16) -> list[bytearray]:
+    """
+    Packs packets into as few frames (and so as little airtime) as possible.
+
+    Packets can be split across frames, so the only wasted space is when a frame has max_packets_combined packets
+    starting in it before it's full, or has less than 3 bytes left for a header. packing_order reorders packets to
+    avoid the first case, and is only used when it needs fewer frames than queue order - so this never needs more
+    frames than pack_greedy and doesn't reorder for nothing.
+
+    Frames are payload_size bytes (the modem frame minus the CRC). Packets are removed from the queue.
+    """
+    order = packing_order(queue, payload_size, max_packets_combined, window)
+    if count_frames(order, payload_size, max_packets_combined) >= count_frames(queue, payload_size, max_packets_combined):
+        order = list(queue)
+    queue.clear()
+    return pack_in_order(order, payload_size, max_packets_combined)
@@ -0,0 +1,172 @@
+"""
+Tracks how well we hear each station on each mode so TX can pick the fastest mode that station is likely to decode.
+
+Stations are identified by the AX.25 source address of packets we receive. We assume the path is roughly symmetric -
+if we hear them at a given SNR they'll hear us at about the same SNR.
+"""
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import Callable
+import math
+import time
+from .framing import Packet, PartialPacket
+
+# SNR (dB) where each mode loses about 10% of frames on a typical HF channel
+SNR_THRESHOLDS = {
+    "DATAC1": 5.0,
+    "DATAC3": 0.0,
+    "DATAC4": -4.0,
+}
+SNR_SCALE = 1.5 # dB - how quickly the frame success rate falls off around the threshold
+PRIOR_WEIGHT = 4 # how many decodes the SNR model is worth when blended with what we've actually seen
+
+def ax25_address(data: bytes, offset: int) -> str|None:
+    """
+    Decodes the AX.25 address at offset (0 for destination, 7 for source) into CALL-SSID. Returns None if the data
+    doesn't look like AX.25
+    """
+    if len(data) < offset + 7:
+        return None
+    call = bytes(x >> 1 for x in data[offset:offset+6])
+    if not all(x == 0x20 or 0x30 <= x <= 0x39 or 0x41 <= x <= 0x5a for x in call):
+        return None
+    call = call.decode().strip()
+    if not call:
+        return None
+    ssid = (data[offset+6] >> 1) & 0x0f
+    return f"{call}-{ssid}" if ssid else call
+
+def frame_success(snr: float, mode: str) -> float:
+    """
+    Modelled probability that a single frame in mode gets through at snr
+    """
+    return 1 / (1 + math.exp(-(snr - SNR_THRESHOLDS[mode]) / SNR_SCALE) / 9)
+
+@dataclass
+class ModeQuality():
+    snr: float # exponentially weighted average
+    decoded: int = 0
+    failed: int = 0 # packets that started arriving but were never completed
+    updated: float = 0
+
+@dataclass
+class Link():
+    callsign: str
+    modes: dict[str, ModeQuality] = field(default_factory=dict)
+    updated: float = 0
+    selected: str|None = None # last mode we chose for this station
+
+class LinkQualityTable():
+    """
+    Per station, per mode SNR and decode counts. Entries that haven't been heard from in max_age seconds are ignored.
+    """
+    def __init__(self, alpha: float = 0.3, max_age: float = 30*60, hysteresis: float = 0.1, clock: Callable[[],float] = time.monotonic):
+        self.alpha = alpha
+        self.max_age = max_age
+        self.hysteresis = hysteresis # a new mode must be this much (fraction) faster before we switch
+        self.clock = clock
+        self.links: dict[str, Link] = {}
+        self.lock = Lock() # updated from the RX thread, read from the TX thread
+
+    def heard(self, packet: Packet) -> None:
+        """
+        Update the table from a received packet. Only KISS packets carry a callsign.
+        """
+        if packet.header != 255 or packet.mode is None:
+            return
+        callsign = ax25_address(packet.data, 7)
+        if callsign is None:
+            return
+        now = self.clock()
+        with self.lock:
+            link = self.links.setdefault(callsign, Link(callsign))
+            quality = link.modes.get(packet.mode)
+            if quality is None:
+                quality = link.modes[packet.mode] = ModeQuality(snr=packet.snr if packet.snr is not None else 0)
+            elif packet.snr is not None:
+                quality.snr += self.alpha * (packet.snr - quality.snr)
+            quality.decoded += 1
+            quality.updated = now
+            link.updated = now
+
+    def dropped(self, partial: PartialPacket, mode: str) -> None:
+        """
+        Reassembler callback for packets that were never completed. If enough arrived to see who sent it, it counts
+        against that station on mode.
+        """
+        if partial.header != 255 or partial.received < 14:
+            return
+        callsign = ax25_address(partial.buffer, 7)
+        with self.lock:
+            link = self.links.get(callsign)
+            if link is not None and mode in link.modes:
+                link.modes[mode].failed += 1
+
+    def snr(self, link: Link, mode: str, now: float) -> float|None:
+        """
+        Best SNR estimate for mode - measured on that mode if we've heard it recently, otherwise from the most
+        recently heard mode
+        """
+        quality = link.modes.get(mode)
+        if quality and now - quality.updated <= self.max_age:
+            return quality.snr
+        recent = max(link.modes.values(), key=lambda x: x.updated)
+        return recent.snr if now - recent.updated <= self.max_age else None
+
+    def success(self, link: Link, mode: str, now: float) -> float|None:
+        snr = self.snr(link, mode, now)
+        if snr is None:
+            return None
+        modelled = frame_success(snr, mode)
+        quality = link.modes.get(mode)
+        if not quality:
+            return modelled
+        # blend the model with observed decodes so a station that keeps failing on a mode gets moved off it
+        return (quality.decoded + modelled * PRIOR_WEIGHT) / (quality.decoded + quality.failed + PRIOR_WEIGHT)
+
+    def select(self, callsign: str|None, sizes: list[int], modes: dict[str, tuple[int, float]]) -> str|None:
+        """
+        Picks the mode with the lowest expected airtime to deliver packets of sizes to callsign, including resends
+        of packets that don't get through. modes maps mode name to (frame payload bytes, seconds per frame).
+
+        Returns None if we don't know enough about the station.
+        """
+        now = self.clock()
+        with self.lock:
+            link = self.links.get(callsign)
+            if link is None or now - link.updated > self.max_age:
+                return None
+
+            airtime = {}
+            for mode, (payload_size, frame_seconds) in modes.items():
+                success = self.success(link, mode, now)
+                if not success:
+                    continue
+                frames = math.ceil(sum(x + 3 for x in sizes) / payload_size)
+                # a packet needs all of its frames to get through, otherwise it's resent
+                resends = sum(x * success ** -math.ceil((x + 3) / payload_size) for x in sizes) / max(sum(sizes), 1)
+                airtime[mode] = frames * frame_seconds * resends
+            if not airtime:
+                return None
+
+            best = min(airtime, key=airtime.get)
+            if link.selected in airtime and airtime[link.selected] <= airtime[best] * (1 + self.hysteresis):
+                best = link.selected
+            link.selected = best
+            return best
+
+    def rows(self) -> list[dict]:
+        now = self.clock()
+        with self.lock:
+            return [
+                {
+                    "callsign": link.callsign,
+                    "mode": mode,
+                    "snr": round(quality.snr, 1),
+                    "decoded": quality.decoded,
+                    "failed": quality.failed,
+                    "age s": round(now - quality.updated),
+                    "tx mode": link.selected or "",
+                }
+                for link in self.links.values() for mode, quality in sorted(link.modes.items())
+            ]
@@ -1,9 +1,20 @@
 from _freedv_cffi import ffi, lib
 
-from typing import Callable
+from typing import Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import math
+import time
 from dataclasses import dataclass
 from enum import Enum
 import logging
+from .framing import Packet, Reassembler, pack_frames, pack_greedy, header_bytes, ARQ_HEADER, ARQ_NACK_HEADER, PADDING_HEADER
+from . import fec
+from . import dsp
+import random
+from .linkquality import LinkQualityTable, ax25_address
+from .arq import ArqSender
+from .compression import Compressor, COMPRESSED_HEADER, decompress
 
 class Modems(Enum):
     """
@@ -23,22 +34,52 @@ class FreeDVFrame:
     snr: float
     modem: Modems
 
-@dataclass
-class Packet():
-    data: bytes
-    header: int|bytes = b"\xff"
-    mode: str = None
-
 class Modem():
-    def __init__(self, modem: Modems,  callback: Callable[[FreeDVFrame],None]|None=None, max_packets_combined: int = 5):
+    def __init__(self, modem: Modems,  callback: Callable[[FreeDVFrame],None]|None=None, max_packets_combined: int = 5, packing_window: int = 16, fec_repair: float = 0, frames_per_burst: int = 1):
         self.modem = lib.freedv_open(modem.value)
         self.modem_name = modem.name
-        self.buffer = bytearray()
         self.callback = callback
         self.max_packets_combined = max_packets_combined
+        self.packing_window = packing_window
+        self.fec_repair = fec_repair # repair frames per data frame for multi frame packets. 0 disables FEC
+        self.fec_id = random.randrange(65536)
         # self.stats = ffi.new('struct MODEM_STATS *')
 
-        lib.freedv_set_frames_per_burst(self.modem, 1)
+        self.frames_per_burst = frames_per_burst
+        lib.freedv_set_frames_per_burst(self.modem, frames_per_burst)
+
+        self._bytes_per_frame = lib.freedv_get_bits_per_modem_frame(self.modem)//8
+
+        # RX buffers are allocated once and reused for every demod call so the audio callback doesn't churn memory.
+        # Incoming audio is copied straight into rx_in at rx_fill (in bytes) until the modem has nin samples to work with.
+        self.rx_in = ffi.new("short[]", lib.freedv_get_n_max_modem_samples(self.modem))
+        self.rx_in_buffer = ffi.buffer(self.rx_in)
+        self.rx_fill = 0
+        self.demod_seconds = 0 # CPU time spent in the demodulator, used for reporting real time factor
+        self.rx_out = ffi.new("unsigned char[]", self._bytes_per_frame)
+        self.stats_sync = ffi.new("int *")
+        self.stats_snr = ffi.new("float *")
+        # the last stats read by the demodulating thread, so other threads (the status bar) never touch the freedv instance
+        self.last_sync = 0
+        self.last_snr = 0.0
+
+        # TX blocks that never change - generated on first use so RX only modems don't pay for them
+        self.preamble = None
+        self.postamble = None
+
+    def close(self) -> None:
+        """
+        Frees the underlying freedv instance. The modem can't be used after this.
+        """
+        if self.modem is not None:
+            lib.freedv_close(self.modem)
+            self.modem = None
+
+    def reset(self) -> None:
+        """
+        Discards any partially buffered RX audio
+        """
+        self.rx_fill = 0
 
     @property
     def version(self) -> int:
@@ -56,19 +97,23 @@ class Modem():
         """
         Max number of bytes returned for each frame of audio sent. Used to build buffers.
         """
-        return lib.freedv_get_bits_per_modem_frame(self.modem)//8
+        return self._bytes_per_frame
     
+    def stats(self) -> tuple[int, float]:
+        """
+        Reads the modems sync state and SNR in a single call. Only call this from the thread demodulating - snr and sync
+        are the thread safe copies
+        """
+        lib.freedv_get_modem_stats(self.modem, self.stats_sync, self.stats_snr)
+        self.last_sync, self.last_snr = self.stats_sync[0], self.stats_snr[0]
+        return self.last_sync, self.last_snr
+
     @property
     def snr(self) -> float:
         """
-        Receivers SNR reported by the modem
+        Receivers SNR as of the last block of audio demodulated
         """
-        sync = ffi.new("int *")
-        snr = ffi.new("float *")
-
-        lib.freedv_get_modem_stats(self.modem,sync,snr)
-
-        return snr[0]
+        return self.last_snr
 
     # @property
     # def extendedStats(self):
@@ -80,14 +125,9 @@ class Modem():
     @property
     def sync(self) -> float:
         """
-        Modems sync status.
+        Modems sync status as of the last block of audio demodulated
         """
-        sync = ffi.new("int *")
-        snr = ffi.new("float *")
-
-        lib.freedv_get_modem_stats(self.modem,sync,snr)
-
-        return sync[0]
+        return self.last_sync
     
     @property
     def sample_rate(self) -> int:
@@ -100,231 +140,527 @@ class Modem():
         """
         Feed in audio bytes.
         """
-        # add data to our internal buffer
-        self.buffer += data
+        for frame in self.demodulate(data):
+            if self.callback:
+                self.callback(frame)
+
+    def demodulate(self, data: bytes) -> list[FreeDVFrame]:
+        """
+        Feed in audio bytes and return any frames decoded. Doesn't touch anything outside of this modem so it's safe to run
+        each modem on its own thread (cffi releases the GIL while the demodulator is running)
+        """
+        frames = []
+        data = memoryview(data).cast("B")
+        offset = 0
+
+        while offset < len(data):
+            nin = self.nin
+            # copy as much as we can into the modems input buffer - nin can change between calls so we check each time
+            needed = nin - self.rx_fill
+            take = min(needed, len(data) - offset)
+            self.rx_in_buffer[self.rx_fill:self.rx_fill+take] = data[offset:offset+take]
+            self.rx_fill += take
+            offset += take
 
-        # if we have enough data run the demodulator
-        while (nin := self.nin) <= len(self.buffer):
-            # setup the memory location where audio samples will be read from
-            to_modem = ffi.from_buffer("short[]", self.buffer[:nin] )
-            # remove the loaded samples from the buffer
-            del self.buffer[:nin] 
-            # setup a location to put the results
-            from_modem = ffi.new("unsigned char packed_payload_bits[]", bytes(self.bytes_per_frame))
+            if self.rx_fill < nin:
+                break # wait for more audio
+
+            self.rx_fill = 0
 
             # run the demodulator
-            bytes_returned = lib.freedv_rawdatarx(self.modem,from_modem,to_modem)
+            start = time.perf_counter()
+            bytes_returned = lib.freedv_rawdatarx(self.modem, self.rx_out, self.rx_in)
+            self.demod_seconds += time.perf_counter() - start
 
             # check if we get returned bytes
-            if bytes_returned and self.callback:
+            if bytes_returned:
+                sync, snr = self.stats()
                 # if we do, create a freedvframe object and return the data
-                self.callback( # we should change this to do depacketization
+                frames.append(
                     FreeDVFrame(
-                        data = bytes(from_modem)[:bytes_returned-2], # Remove the CRC
-                        sync = self.sync,
-                        snr = self.snr,
+                        data = ffi.buffer(self.rx_out, bytes_returned-2)[:], # Remove the CRC
+                        sync = sync,
+                        snr = snr,
                         modem = self.modem_name
                     )
                 )
+        return frames
+
     def crc(self, data: bytes) -> bytes:
         data_in = ffi.from_buffer(f"unsigned char[{self.bytes_per_frame - 2}]", data)
         return lib.freedv_gen_crc16(data_in, self.bytes_per_frame - 2).to_bytes(2, byteorder="big")
 
-    def modulate(self, queue: list[Packet]) -> bytes:
+    def modulate(self, queue: list[Packet]) -> bytearray:
         """
         Modulates bytes into audio samples (also bytes)
         """
-        
+        return self.modulate_frames(self.pack(queue))
+
+    def fec_eligible(self, packet: Packet) -> bool:
+        """
+        FEC is only used for packets that need more than one frame and fit in a single FEC block. ARQ packets are
+        left alone as the lost frames get resent.
         """
-        Our packet format is. Packet must be less than 32768
+        if header_bytes(packet)[0] in (ARQ_HEADER, ARQ_NACK_HEADER):
+            return False
+        return 1 < fec.data_frames(len(packet.data), self.bytes_per_frame - 2) < fec.MAX_BLOCK_FRAMES
 
-        ## TODO build tests for packets exactly the max length
-        
-        Short packet
-        0xff [2 byte short for length of data in bytes] [data]
+    def pack(self, queue: list[Packet]) -> list[bytearray]:
+        """
+        Packs the queued packets into modem frames (with CRCs). Packets are removed from the queue.
 
-        Long packet
-        [sequence number 0-127] [data]
+        A packing_window of 0 uses the original in order greedy packer. When fec_repair is set, multi frame packets
+        are sent as FEC blocks after the other packets.
         """
-        
-        # Convert to byte array as it will be easier to slice 
+        protected = []
+        if self.fec_repair:
+            protected = [x for x in queue if self.fec_eligible(x)]
+            queue[:] = [x for x in queue if not self.fec_eligible(x)]
+
         frames = []
-        pop_packet_length = self.bytes_per_frame - 2 - 3 # first iteration we use 3 bytes for the header
-        frame=bytearray(self.bytes_per_frame)
-        used_bytes = 0
-
-        number_combined = 0
-
-        while queue:
-            packet = queue.pop(0)
-            data = bytearray(packet.data)
-            chunks = []
-            header_byte = packet.header
-            
-            while data:
-                chunks.append(data[:pop_packet_length])
-                del data[:pop_packet_length]
-                pop_packet_length = self.bytes_per_frame - 2 - 1 # next iterations only use 1 byte for sequence
-
-
-            # header
-            header = header_byte + sum([len(x) for x in chunks]).to_bytes(2)
-            frame[0+used_bytes:3+used_bytes] = header
-
-            chunk = chunks[0]
-
-            # data
-            frame[3+used_bytes:3+len(chunk)+used_bytes] = chunk
-            used_bytes = used_bytes + len(chunk) + len(header) 
-
-
-            for header, chunk in enumerate(chunks[1:]):
-                used_bytes = 0
-                frames.append(frame)
-                frame=bytearray(self.bytes_per_frame)
-                # header
-                header = header.to_bytes(1)
-                frame[0:len(header)] = header
-            
-                frame[1:1+len(chunk)] = chunk
-                used_bytes = used_bytes + len(chunk) + len(header) 
-
-            # can we fit a little more data in?
-            
-            # 2 for crc
-            if number_combined > self.max_packets_combined: # limit to 5 packets combined - probably turn this into an option
-                if queue:
-                    logging.debug("max combined frames reached")
-                    frames.append(frame)
-                    frame=bytearray(self.bytes_per_frame)
-                    used_bytes = 0
-                    pop_packet_length = self.bytes_per_frame - 2 - 3
-                    number_combined = 0
-            if used_bytes + 2 <= self.bytes_per_frame - 3: # we need three bytes to start the next payload
-                pop_packet_length = self.bytes_per_frame - used_bytes - 2 - 3
-                number_combined += 1
+        if queue or not protected:
+            if self.packing_window:
+                frames = pack_frames(queue, self.bytes_per_frame - 2, self.max_packets_combined, self.packing_window)
             else:
-                if queue:
-                    frames.append(frame)
-                    frame=bytearray(self.bytes_per_frame)
-                    used_bytes = 0
-                    pop_packet_length = self.bytes_per_frame - 2 - 3
-                    number_combined = 0
-        frames.append(frame)
-
-        output = bytes()
+                frames = pack_greedy(queue, self.bytes_per_frame - 2, self.max_packets_combined)
+
+        for packet in protected:
+            packet_id = self.fec_id.to_bytes(2)
+            self.fec_id = (self.fec_id + 1) % 65536
+            frames += fec.fec_frames(packet_id, header_bytes(packet), packet.data, self.bytes_per_frame - 2, self.fec_repair)
+
         for frame in frames:
             # calculate CRCs
-            frame[-2:] = self.crc(bytes(frame)[:-2])
-            #logging.debug(f"modulating {str(bytes(frame))}")
+            frame += self.crc(frame)
+        return frames
+
+    def cache_tx_blocks(self) -> None:
+        """
+        The preamble, postamble and padding frame are the same for every burst so we generate them once
+        """
+        n_tx_samples = lib.freedv_get_n_tx_modem_samples(self.modem)
+        tx_buffer = ffi.new("short[]", max(
+            n_tx_samples,
+            lib.freedv_get_n_tx_preamble_modem_samples(self.modem),
+            lib.freedv_get_n_tx_postamble_modem_samples(self.modem)
+        ))
+        samples = lib.freedv_rawdatapreambletx(self.modem, tx_buffer)
+        self.preamble = ffi.buffer(tx_buffer)[:samples*ffi.sizeof("short")]
+        samples = lib.freedv_rawdatapostambletx(self.modem, tx_buffer)
+        self.postamble = ffi.buffer(tx_buffer)[:samples*ffi.sizeof("short")]
+        self.frame_audio_bytes = n_tx_samples*ffi.sizeof("short")
+        # an extra bit of silence at the end of a transmission to clear out buffers
+        self.silence_bytes = lib.freedv_get_n_nom_modem_samples(self.modem)*ffi.sizeof("short")*2
+        # fills up the last burst when there aren't enough frames. The receiver ignores it
+        padding = bytearray(self.bytes_per_frame - 2)
+        padding[0] = PADDING_HEADER
+        padding += self.crc(padding)
+        self.padding_audio = bytes(self.modulate_frame_audio(padding))
+
+    @property
+    def burst_bytes(self) -> int:
+        """
+        Size of the audio for a full burst of frames_per_burst frames including the preamble and postamble
+        """
+        if self.preamble is None:
+            self.cache_tx_blocks()
+        return len(self.preamble) + self.frame_audio_bytes*self.frames_per_burst + len(self.postamble)
+
+    @property
+    def frame_seconds(self) -> float:
+        """
+        Airtime per frame in a full burst
+        """
+        return self.burst_bytes / self.frames_per_burst / ffi.sizeof("short") / self.sample_rate
 
-            from_modem = ffi.new(f"short mod_out[{lib.freedv_get_n_tx_modem_samples(self.modem)}]")
-            
-            # preamble
-            samples = lib.freedv_rawdatapreambletx(self.modem, from_modem)
-            output += ffi.buffer(from_modem)[:(samples*ffi.sizeof("short"))]
+    def modulate_frame_audio(self, frame: bytearray) -> bytearray:
+        """
+        Audio for a single packed frame without the preamble and postamble
+        """
+        output = bytearray(lib.freedv_get_n_tx_modem_samples(self.modem)*ffi.sizeof("short"))
+        lib.freedv_rawdatatx(self.modem, ffi.from_buffer("short[]", output), ffi.from_buffer("unsigned char[]", frame))
+        return output
 
-            to_modem = ffi.from_buffer("unsigned char *", frame)
+    def modulate_into(self, view: memoryview, frames: list[bytearray]) -> int:
+        """
+        Writes a burst - the preamble, up to frames_per_burst modulated frames (padded if there are fewer) and the
+        postamble into view. Returns the number of bytes written.
+        """
+        offset = 0
+        #logging.debug(f"modulating {str(bytes(frame))}")
+
+        # preamble
+        view[offset:offset+len(self.preamble)] = self.preamble
+        offset += len(self.preamble)
 
-            # setup a location to put the results
+        for frame in frames:
+            to_modem = ffi.from_buffer("unsigned char[]", frame)
+            from_modem = ffi.from_buffer("short[]", view[offset:offset+self.frame_audio_bytes])
             lib.freedv_rawdatatx(self.modem, from_modem, to_modem)
-            output += ffi.buffer(from_modem)[:]
-            
-            #postamble
-            samples=lib.freedv_rawdatapostambletx(self.modem, from_modem)
-            output += ffi.buffer(from_modem)[:(samples*ffi.sizeof("short"))]
-        
-            
-        # add an extra bit of silence to clear out buffers
-        output += bytes(lib.freedv_get_n_nom_modem_samples(self.modem)*ffi.sizeof("short")*2)
-                
+            offset += self.frame_audio_bytes
+        for _ in range(self.frames_per_burst - len(frames)):
+            view[offset:offset+self.frame_audio_bytes] = self.padding_audio
+            offset += self.frame_audio_bytes
+
+        #postamble
+        view[offset:offset+len(self.postamble)] = self.postamble
+        offset += len(self.postamble)
+        return offset
+
+    def bursts(self, frames: list) -> list[list]:
+        return [frames[x:x+self.frames_per_burst] for x in range(0, len(frames), self.frames_per_burst)]
+
+    def modulate_frames(self, frames: list[bytearray]) -> bytearray:
+        """
+        Modulates packed frames into audio samples.
+
+        The output is allocated once at its final size and the modem writes each frame straight into it.
+        """
+        bursts = self.bursts(frames)
+        output = bytearray(self.burst_bytes*len(bursts) + self.silence_bytes) # ends with silence as it's zero filled
+        view = memoryview(output)
+        offset = 0
+        for burst in bursts:
+            offset += self.modulate_into(view[offset:], burst)
         return output
 
+    def modulate_burst(self, frames: list[bytearray]) -> bytearray:
+        """
+        Audio for a single burst of up to frames_per_burst frames
+        """
+        output = bytearray(self.burst_bytes)
+        self.modulate_into(memoryview(output), frames)
+        return output
+
+    def burst_from_audio(self, frames: list[bytes]) -> bytearray:
+        """
+        Builds a burst from frames that have already been modulated (see modulate_frame_audio)
+        """
+        if self.preamble is None:
+            self.cache_tx_blocks()
+        padding = [self.padding_audio] * (self.frames_per_burst - len(frames))
+        return bytearray().join([self.preamble, *frames, *padding, self.postamble])
+
+    def modulate_stream(self, queue: list[Packet]) -> Iterator[bytearray]:
+        """
+        Same as modulate but yields the audio one burst at a time so playback can start as soon as the first burst is ready.
+        The final item is the trailing silence.
+        """
+        for burst in self.bursts(self.pack(queue)):
+            yield self.modulate_burst(burst)
+        yield bytearray(self.silence_bytes)
+
+
+
+class RXGovernor():
+    """
+    Saves CPU by demoting RX modes that haven't had sync for a while to a low duty acquisition schedule, where they
+    only demodulate duty_window seconds out of every duty_period seconds. A demoted mode is promoted back to full time
+    when it gets sync or when the input energy rises above the noise floor (someone has started transmitting).
 
+    All times are in seconds of audio received rather than wall clock so it behaves the same when processing recordings.
+    """
+    def __init__(self, idle_seconds: float, duty_period: float = 10, duty_window: float = 2, energy_threshold_db: float = 10):
+        self.idle_seconds = idle_seconds
+        self.duty_period = duty_period
+        self.duty_window = duty_window
+        self.energy_threshold_db = energy_threshold_db
+        self.noise_floor = None
+        self.last_sync: dict[str, float] = {}
+        self.demoted: set[str] = set()
+
+    def should_demodulate(self, now: float, modem_name: str) -> bool:
+        if modem_name not in self.demoted:
+            return True
+        return now % self.duty_period < self.duty_window
+
+    def update(self, now: float, modem_name: str, sync: bool):
+        if sync or modem_name not in self.last_sync:
+            self.last_sync[modem_name] = now
+        if sync and modem_name in self.demoted:
+            logging.info(f"{modem_name} has sync - promoting to full time RX")
+            self.demoted.discard(modem_name)
+        elif modem_name not in self.demoted and now - self.last_sync[modem_name] > self.idle_seconds:
+            logging.info(f"{modem_name} hasn't had sync for {self.idle_seconds/60:.1f} minutes - demoting to low duty RX")
+            self.demoted.add(modem_name)
+
+    def energy(self, now: float, duration: float, level_db: float):
+        """
+        Tracks the noise floor (falls instantly, rises at 1db per second) and promotes all modes when the level jumps above it
+        """
+        if self.noise_floor is None or level_db < self.noise_floor:
+            self.noise_floor = level_db
+        else:
+            self.noise_floor = min(level_db, self.noise_floor + duration)
+
+        if self.demoted and level_db > self.noise_floor + self.energy_threshold_db:
+            logging.info(f"Signal detected {level_db - self.noise_floor:.1f}db above the noise floor - promoting {', '.join(self.demoted)} to full time RX")
+            for modem_name in self.demoted:
+                self.last_sync[modem_name] = now
+            self.demoted.clear()
 
 class FreeDVRX():
-    def __init__(self, callback: Callable[[bytes],None], progress: Callable[[int,int],None], inhibit: Callable[[bool],None]):
+    def __init__(self, callback: Callable[[bytes],None], progress: Callable[[int,int],None], inhibit: Callable[[bool],None], threaded: bool = False, modes: list[str]|None = None, governor: RXGovernor|None = None, end_of_transmission_seconds: float = 2, frames_per_burst: int = 1):
         self.callback = callback
+        self.frames_per_burst = frames_per_burst # must match the sending station
         self.progress = progress
         self.inhibit = inhibit
+        self.governor = governor
+        self.end_of_transmission_seconds = end_of_transmission_seconds # no sync for this long means the other station has stopped
+        self.receiving: dict[str, float] = {} # modes we've had sync on and when we last had it (audio seconds)
+
+        # by default we RX all the modems at once
+        if modes is None:
+            modes = [x.name for x in Modems]
+        self.modems_lock = Lock()
+        self.modems = [Modem(Modems[x], callback=self.rx, frames_per_burst=frames_per_burst) for x in modes]
 
-        # we RX all the modems at once
-        self.modems = [Modem(x, callback=self.rx) for x in Modems]
+        # optionally run each demodulator on its own thread so RX time is the slowest mode rather than the sum of them all
+        self.executor = ThreadPoolExecutor(max_workers=len(Modems), thread_name_prefix="demod") if threaded else None
 
         # set sample rate so that the audio processor can perform the required sampling conversion
-        if len(set([x.sample_rate for x in self.modems])) != 1:
+        # modes can be added later so check against a full set of modems
+        sample_rates = set([x.sample_rate for x in self.modems])
+        if not self.modems:
+            probe = Modem(Modems.DATAC1)
+            sample_rates.add(probe.sample_rate)
+            probe.close()
+        if len(sample_rates) != 1:
             raise NotImplemented("Not all modems are running the same sample rate - We can't handle this right now")
         else:
-            self.sample_rate = self.modems[0].sample_rate
+            self.sample_rate = sample_rates.pop()
+
+        self.audio_seconds = 0 # amount of audio received, used as a clock by the governor
+
+        # packet rx
+        self.reassembler = Reassembler(callback=self.deliver, progress=self.progress)
+
+    @property
+    def modes(self) -> list[str]:
+        return [x.modem_name for x in self.modems]
+
+    def add_mode(self, mode: str) -> None:
+        """
+        Start receiving an additional mode
+        """
+        if mode in self.modes:
+            return
+        modem = Modem(Modems[mode], callback=self.rx, frames_per_burst=self.frames_per_burst)
+        if modem.sample_rate != self.sample_rate:
+            modem.close()
+            raise ValueError(f"{mode} runs at {modem.sample_rate} which doesn't match the other modems at {self.sample_rate}")
+        with self.modems_lock:
+            # keep the modems in the same order as Modems so frame delivery order is consistent
+            self.modems = sorted(self.modems + [modem], key=lambda x: list(Modems.__members__).index(x.modem_name))
+
+    def remove_mode(self, mode: str) -> None:
+        """
+        Stop receiving a mode and free its modem
+        """
+        with self.modems_lock:
+            # closed under the lock so write() can't be demodulating with it
+            for modem in self.modems:
+                if modem.modem_name == mode:
+                    modem.close()
+            self.modems = [x for x in self.modems if x.modem_name != mode]
+        if self.governor:
+            self.governor.demoted.discard(mode)
+            self.governor.last_sync.pop(mode, None)
 
-        # data for packet rx
-        self.remaining_bytes = None
-        self.next_seq_number = None
-        self.partial_data = None
-        
     def write(self, data: bytes) -> None:
         """
         Accepts bytes of data that will be read by tge modem and demodulated
         """
         sync = False
-        for modem in self.modems:
-            modem.write(data)
-            if modem.sync:
-                sync = True
+        with self.modems_lock:
+            now = self.audio_seconds
+            duration = len(data) / ffi.sizeof("short") / self.sample_rate
+            self.audio_seconds += duration
+
+            modems = self.modems
+            if self.governor:
+                if self.governor.demoted:
+                    self.governor.energy(now, duration, dsp.dbfs(dsp.rms(data)))
+
+                modems = []
+                for modem in self.modems:
+                    if self.governor.should_demodulate(now, modem.modem_name):
+                        modems.append(modem)
+                    else:
+                        modem.reset() # don't stitch together audio from either side of the gap
+
+            if self.executor:
+                # wait for every modem to finish the block then deliver frames in modem order so the result
+                # is the same as running them one after another
+                results = list(self.executor.map(lambda modem: modem.demodulate(data), modems))
+                for modem, frames in zip(modems, results):
+                    for frame in frames:
+                        if modem.callback:
+                            modem.callback(frame)
+            else:
+                for modem in modems:
+                    modem.write(data)
+            for modem in modems:
+                modem_sync, _ = modem.stats() # also updates the copies the status bar reads
+                if modem_sync:
+                    sync = True
+                    self.receiving[modem.modem_name] = self.audio_seconds
+                elif self.audio_seconds - self.receiving.get(modem.modem_name, math.inf) > self.end_of_transmission_seconds:
+                    del self.receiving[modem.modem_name]
+                    self.reassembler.end_of_transmission(modem.modem_name)
+                if self.governor:
+                    self.governor.update(now, modem.modem_name, modem_sync)
         self.inhibit(sync)
 
+    def close(self):
+        if self.executor:
+            self.executor.shutdown()
+        with self.modems_lock:
+            for modem in self.modems:
+                modem.close()
+            self.modems = []
+
     def rx(self, data_frame: FreeDVFrame):
         logging.debug(f"Received data. snr:{data_frame.snr}")
-        data = bytearray(data_frame.data)
-        while data:
-            #logging.debug(f"Received data: {str(data)}")
-            header = data.pop(0)
-            if header > 200: # start of packet
-                self.remaining_bytes = int.from_bytes(data[0:2])
-                self.total_bytes = self.remaining_bytes
-                del data[0:2]
-                logging.debug(f"Found packet start - Expecting {self.remaining_bytes} bytes")
-                self.next_seq_number = 0
-                self.partial_data=b''
-                self.header = header
-            elif self.next_seq_number != None: # should be a seq number
-                if self.next_seq_number != header:
-                    logging.debug(f"Missing data - header seq expected {self.next_seq_number}, got {header}")
-                    logging.debug(f"Full data frame: {str(data_frame.data)}")
-                    self.next_seq_number = None
-                    self.remaining_bytes = None
-                    return
-                else:
-                    logging.debug(f"Received frame {header}")
-                    self.next_seq_number += 1
-                    
-            else:
-                if header != 0:
-                    logging.debug(f"Not expecting data - got {header}")
-                    logging.debug(f"Full data frame: {str(data_frame.data)}")
-                self.next_seq_number = None
-                self.remaining_bytes = None
-                return
-            self.partial_data += data[:self.remaining_bytes]
-            received_bytes = len(data[:self.remaining_bytes])
-            self.remaining_bytes -= received_bytes
-
-            logging.debug(f"Seq: {header} Remaining data: {self.remaining_bytes}")
-
-            self.progress(self.total_bytes, self.remaining_bytes, data_frame.modem)
-            if self.remaining_bytes == 0:
-                self.next_seq_number = None
-                del data[:received_bytes]
-                self.remaining_bytes = None
-                self.callback(Packet(header=self.header, data=self.partial_data, mode=data_frame.modem))
-            else:
+        self.reassembler.feed(data_frame.data, data_frame.modem, data_frame.snr)
+
+    def deliver(self, packet: Packet):
+        if packet.header == COMPRESSED_HEADER:
+            packet = decompress(packet)
+            if packet is None:
                 return
+        self.callback(packet)
 
 
 class FreeDVTX():
-    def __init__(self, modem: str = Modems.DATAC1.name, max_packets_combined: int = 5):
-        self.modem = Modem(modem={x.name:x for x in Modems}[modem])
+    def __init__(self, modem: str = Modems.DATAC1.name, max_packets_combined: int = 5, packing_window: int = 16, links: LinkQualityTable|None = None, adaptive: bool = False, arq: ArqSender|None = None, fec_repair: float = 0, compressor: Compressor|None = None, frames_per_burst: int = 1):
+        # every mode is opened up front so switching modes (eg in follow mode) is just a lookup
+        self.modems = {
+            x.name: Modem(x, max_packets_combined=max_packets_combined, packing_window=packing_window, fec_repair=fec_repair, frames_per_burst=frames_per_burst)
+            for x in Modems
+        }
+        self.modem = self.modems[modem]
+        self.links = links
+        self.adaptive = adaptive # pick the mode for each destination from links. Unknown stations use self.modem
+        self._frame_info = None
+        self.arq = arq # send multi frame packets with ARQ so only lost frames need resending
+        self.compressor = compressor
+    @property
+    def max_packets_combined(self) -> int:
+        return self.modem.max_packets_combined
+    @max_packets_combined.setter
+    def max_packets_combined(self, value: int):
+        for modem in self.modems.values():
+            modem.max_packets_combined = value
+    @property
+    def packing_window(self) -> int:
+        return self.modem.packing_window
+    @packing_window.setter
+    def packing_window(self, value: int):
+        for modem in self.modems.values():
+            modem.packing_window = value
+    @property
+    def fec_repair(self) -> float:
+        return self.modem.fec_repair
+    @fec_repair.setter
+    def fec_repair(self, value: float):
+        for modem in self.modems.values():
+            modem.fec_repair = value
     def set_mode(self,  modem: str):
-        self.modem = Modem(modem={x.name:x for x in Modems}[modem])
+        self.modem = self.modems[modem]
+    def plan(self, queue: list[Packet]) -> list[tuple[Modem, list[Packet]]]:
+        """
+        Splits the queue into the packets to send with each mode, keeping queue order within each mode.
+        In adaptive mode each destination gets the mode expected to deliver its packets in the least airtime.
+        """
+        if not self.adaptive or self.links is None:
+            return [(self.modem, queue)]
+
+        destinations = [
+            ax25_address(packet.data, 0) if packet.header in (255, b"\xff") else None for packet in queue
+        ]
+        sizes = {}
+        for destination, packet in zip(destinations, queue):
+            sizes.setdefault(destination, []).append(len(packet.data))
+        modes = {
+            destination: (self.links.select(destination, packet_sizes, self.frame_info) if destination else None) or self.modem.modem_name
+            for destination, packet_sizes in sizes.items()
+        }
+        for destination, mode in modes.items():
+            if destination and mode != self.modem.modem_name:
+                logging.debug(f"Adaptive mode - sending to {destination} with {mode}")
+
+        groups = {}
+        for destination, packet in zip(destinations, queue):
+            groups.setdefault(modes[destination], []).append(packet)
+        queue.clear()
+        return [(self.modems[mode], packets) for mode, packets in groups.items()]
+    @property
+    def frame_info(self) -> dict[str, tuple[int, float]]:
+        """
+        Frame payload bytes and seconds of audio per frame for each mode
+        """
+        if self._frame_info is None:
+            self._frame_info = {
+                name: (modem.bytes_per_frame - 2, modem.frame_seconds) for name, modem in self.modems.items()
+            }
+        return self._frame_info
+    def airtime(self, packet: Packet) -> float:
+        """
+        Rough seconds to send packet on the current TX mode
+        """
+        payload_size, frame_seconds = self.frame_info[self.modem.modem_name]
+        return math.ceil((len(packet.data) + 3) / payload_size) * frame_seconds
+    @property
+    def pending(self) -> bool:
+        """
+        True if there are ARQ frames waiting to be resent
+        """
+        return bool(self.arq and self.arq.pending)
+    @property
+    def pending_seconds(self) -> float:
+        """
+        Rough seconds of audio the waiting ARQ resends take
+        """
+        if not self.arq:
+            return 0
+        return sum(len(frames) * self.frame_info[mode][1] for mode, frames in list(self.arq.pending))
     def write(self, data: list[Packet]):
-        return self.modem.modulate(data)
\ No newline at end of file
+        return bytearray().join(self.write_stream(data))
+    def write_stream(self, data: list[Packet]) -> Iterator[bytearray]:
+        """
+        Yields audio for ARQ resends and then the queued packets, one burst at a time. Each mode ends with silence.
+        Nothing is yielded when there's nothing to send.
+        """
+        if self.arq:
+            for mode, frames in self.arq.take_pending():
+                modem = self.modems[mode]
+                for burst in modem.bursts(frames):
+                    yield modem.burst_from_audio(burst)
+                yield bytearray(modem.silence_bytes)
+        if not data: # eg the queue was cleared between checking it and taking from it
+            return
+        for modem, packets in self.plan(data):
+            if self.compressor:
+                packets = [self.compressor.compress(x, modem.modem_name) for x in packets]
+            if self.arq:
+                payload_size = modem.bytes_per_frame - 2
+                eligible = [self.arq.eligible(x, payload_size) for x in packets]
+                arq_packets = [x for x, arq in zip(packets, eligible) if arq]
+                packets = [x for x, arq in zip(packets, eligible) if not arq]
+                for packet in arq_packets:
+                    packet_id, arq_packet = self.arq.wrap(packet)
+                    frames = []
+                    for burst in modem.bursts(modem.pack([arq_packet])):
+                        audio = [modem.modulate_frame_audio(frame) for frame in burst]
+                        frames += audio
+                        yield modem.burst_from_audio(audio)
+                    self.arq.store(packet_id, modem.modem_name, frames)
+                if not packets:
+                    if arq_packets:
+                        yield bytearray(modem.silence_bytes)
+                    continue
+            yield from modem.modulate_stream(packets)
+    def close(self):
+        for modem in self.modems.values():
+            modem.close()
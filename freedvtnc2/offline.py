@@ -0,0 +1,121 @@
+"""
+Demodulates recorded audio as fast as the CPU allows - no sound card required.
+
+Input is raw 16 bit signed mono audio (the same format as c01.raw). Decoded packets are written to stdout either as
+JSON lines with metadata or as KISS frames that can be piped into other tools.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
+import argparse
+import base64
+import json
+import logging
+import sys
+import time
+from typing import Callable
+import kissfix
+import numpy as np
+from .modem import FreeDVRX, Packet
+from .dsp import make_resampler
+
+@dataclass
+class OfflineResult():
+    """
+    Packets decoded from a single file along with timing information
+    """
+    path: str
+    packets: list[dict] = field(default_factory=list)
+    packet_count: int = 0
+    audio_seconds: float = 0
+    wall_seconds: float = 0
+    demod_seconds: dict[str, float] = field(default_factory=dict)
+
+def open_audio(path: str):
+    if path == "-":
+        return sys.stdin.buffer
+    return open(path, "rb")
+
+def demodulate_file(path: str, modes: list[str]|None = None, sample_rate: int = 8000, chunk_size: int = 8192, on_packet: Callable[[dict],None]|None = None, frames_per_burst: int = 1) -> OfflineResult:
+    """
+    Demodulates a whole file. Packets are passed to on_packet as they are decoded, or collected in the result if on_packet isn't set
+    (needed when running in a process pool)
+    """
+    result = OfflineResult(path=path)
+
+    def rx(packet: Packet):
+        record = {
+            "file": path,
+            "time": round(modem_rx.audio_seconds, 3), # seconds into the recording at the end of the audio block that completed the packet
+            "mode": packet.mode,
+            "snr": round(packet.snr, 2) if packet.snr is not None else None,
+            "header": packet.header,
+            "data": packet.data
+        }
+        if on_packet:
+            on_packet(record)
+        else:
+            result.packets.append(record)
+        result.packet_count += 1
+
+    modem_rx = FreeDVRX(callback=rx, progress=lambda *args: None, inhibit=lambda state: None, modes=modes, frames_per_burst=frames_per_burst)
+    resampler = make_resampler("polyphase", sample_rate, modem_rx.sample_rate)
+    start = time.perf_counter()
+    f = open_audio(path)
+    try:
+        while chunk := f.read(chunk_size):
+            if len(chunk) % 2: # can happen when reading from a pipe
+                chunk += f.read(1)
+            if resampler:
+                chunk = resampler.process(np.frombuffer(chunk, dtype=np.int16)).tobytes()
+            modem_rx.write(chunk)
+    finally:
+        if f is not sys.stdin.buffer:
+            f.close()
+    result.wall_seconds = time.perf_counter() - start
+    result.audio_seconds = modem_rx.audio_seconds
+    result.demod_seconds = {x.modem_name: x.demod_seconds for x in modem_rx.modems}
+    modem_rx.close()
+    return result
+
+def write_packet(packet: dict, output_format: str):
+    if output_format == "kiss":
+        if packet["header"] == 255: # only KISS payloads
+            sys.stdout.buffer.write(kissfix.FEND + b'\00' + kissfix.escape_special_codes(packet["data"]) + kissfix.FEND)
+            sys.stdout.buffer.flush()
+    else:
+        packet = dict(packet, data=base64.b64encode(packet["data"]).decode())
+        print(json.dumps(packet), flush=True)
+
+def report(result: OfflineResult):
+    """
+    Logs the real time factor for the file and for each mode
+    """
+    if not result.wall_seconds:
+        return
+    per_mode = ", ".join(
+        f"{mode}: {result.audio_seconds/seconds:.1f}x" for mode, seconds in result.demod_seconds.items() if seconds
+    )
+    logging.info(
+        f"{result.path}: {result.packet_count} packets from {result.audio_seconds:.1f}s of audio in {result.wall_seconds:.1f}s "
+        f"- {result.audio_seconds/result.wall_seconds:.1f}x real time ({per_mode})"
+    )
+
+def run(options: argparse.Namespace, modes: list[str]|None = None):
+    """
+    Demodulates every file in options.rx_file, in parallel if options.rx_file_workers > 1. Output is always in file order.
+    """
+    paths = options.rx_file
+    args = (modes, options.rx_file_sample_rate)
+    demodulate = partial(demodulate_file, frames_per_burst=options.frames_per_burst)
+    if options.rx_file_workers > 1 and len(paths) > 1 and "-" not in paths:
+        with ProcessPoolExecutor(max_workers=options.rx_file_workers) as executor:
+            results = executor.map(demodulate, paths, *[[x]*len(paths) for x in args])
+            for result in results:
+                for packet in result.packets:
+                    write_packet(packet, options.rx_file_format)
+                report(result)
+    else:
+        for path in paths:
+            result = demodulate(path, *args, on_packet=lambda packet: write_packet(packet, options.rx_file_format))
+            report(result)
@@ -0,0 +1,89 @@
+import threading
+
+class RingBuffer():
+    """
+    Fixed size byte ring buffer for passing audio between a single producer and a single consumer
+    (eg the PortAudio callback and a worker thread).
+
+    The read and write positions are ever increasing counters that are only updated by their own side, so neither side
+    needs a lock. The GIL makes the integer updates atomic.
+    """
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.read_pos = 0
+        self.write_pos = 0
+        self.overruns = 0 # number of writes that didn't fit
+        self.dropped_bytes = 0
+        self.data_ready = threading.Event()
+
+    def __len__(self) -> int:
+        return self.write_pos - self.read_pos
+
+    @property
+    def free(self) -> int:
+        return self.capacity - len(self)
+
+    def write(self, data: bytes, partial: bool = True) -> int:
+        """
+        Copies in as much of data as will fit. Anything that doesn't fit is dropped and counted as an overrun.
+        If partial is False then data is either written in full or dropped entirely (useful to keep audio frames aligned)
+        Returns the number of bytes written.
+        """
+        data = memoryview(data).cast("B")
+        length = min(len(data), self.free)
+        if length < len(data):
+            self.overruns += 1
+            if not partial:
+                length = 0
+            self.dropped_bytes += len(data) - length
+
+        start = self.write_pos % self.capacity
+        first = min(length, self.capacity - start)
+        self.view[start:start+first] = data[:first]
+        self.view[:length-first] = data[first:length]
+
+        self.write_pos += length
+        self.data_ready.set()
+        return length
+
+    def read_into(self, out: memoryview) -> int:
+        """
+        Fills out with as much data as is available. Returns the number of bytes read.
+        """
+        out = memoryview(out).cast("B")
+        length = min(len(out), len(self))
+
+        start = self.read_pos % self.capacity
+        first = min(length, self.capacity - start)
+        out[:first] = self.view[start:start+first]
+        out[first:length] = self.view[:length-first]
+
+        self.read_pos += length
+        return length
+
+    def read(self, size: int|None = None) -> bytes:
+        """
+        Returns up to size bytes (or everything available) as a new bytes object
+        """
+        out = bytearray(len(self) if size is None else min(size, len(self)))
+        self.read_into(out)
+        return bytes(out)
+
+    def wait(self, timeout: float|None = None) -> bool:
+        """
+        Blocks the consumer until data has been written. Returns True if there's data to read.
+        """
+        if not len(self):
+            self.data_ready.wait(timeout)
+        self.data_ready.clear()
+        return bool(len(self))
+
+    def skip(self) -> int:
+        """
+        Consumer side clear - discards everything currently in the buffer
+        """
+        length = len(self)
+        self.read_pos += length
+        return length
@@ -17,11 +17,13 @@ import logging
 from prompt_toolkit.completion import NestedCompleter
 import sys
 from . import audio
+from . import dsp
 import readline
 import code
 import rlcompleter
-import pydub.generators
+from tabulate import tabulate
 from .modem import Modems, FreeDVRX, FreeDVTX, Packet
+from .compression import Compressor
 import traceback
 from pathlib import Path
 import argparse
@@ -36,9 +38,11 @@ class LogHandler(logging.StreamHandler):
         self.callback(record + "\n")
 
 class FreeDVShellCommands():
-    def __init__(self, modem_tx: FreeDVTX, output_device: audio.OutputDevice, parser: configargparse.ArgParser, options:argparse.Namespace):
+    def __init__(self, modem_rx: FreeDVRX, modem_tx: FreeDVTX, output_device: audio.OutputDevice, input_device: audio.InputDevice, parser: configargparse.ArgParser, options:argparse.Namespace):
+        self.modem_rx = modem_rx
         self.modem_tx = modem_tx
         self.output_device = output_device
+        self.input_device = input_device
         self.p = parser
         self.options = options
 
@@ -77,14 +81,8 @@ class FreeDVShellCommands():
 
     def do_test_ptt(self, arg):
         "Turns on PTT for 2 seconds"
-        sin_wave = pydub.generators.Sine(
-            440,
-            sample_rate=self.modem_tx.modem.sample_rate,
-            bit_depth=16,
-            ).to_audio_segment(2000, volume=-6)
-        sin_wave.set_channels(1)
-        
-        self.output_device.write_raw(sin_wave.raw_data)
+        sin_wave = dsp.sine(440, self.modem_tx.modem.sample_rate, 2000, volume=-6)
+        self.output_device.write_raw(sin_wave)
 
     def help_mode(self):
         return f"Change TX Mode: mode [{', '.join([x.name for x in Modems])}]"
@@ -107,11 +105,39 @@ class FreeDVShellCommands():
             x.name : None for x in Modems
         }
 
+    def help_rx_modes(self):
+        return f"Show, add or remove RX modes: rx_modes [add|remove] [{', '.join([x.name for x in Modems])}]"
+
+    def do_rx_modes(self, arg):
+        if arg == "":
+            demoted = self.modem_rx.governor.demoted if self.modem_rx.governor else set()
+            return "RX modes: " + ", ".join([f"{x} (idle)" if x in demoted else x for x in self.modem_rx.modes])
+        try:
+            action, mode = arg.split()
+        except ValueError:
+            return "Usage: rx_modes add DATAC4"
+        mode = mode.upper()
+        if mode not in [x.name for x in Modems]:
+            return f"Mode must be {', '.join([x.name for x in Modems])}"
+        if action == "add":
+            self.modem_rx.add_mode(mode)
+        elif action == "remove":
+            self.modem_rx.remove_mode(mode)
+        else:
+            return "Usage: rx_modes add DATAC4"
+        self.options.rx_modes = ",".join(self.modem_rx.modes)
+        return f"RX modes: {', '.join(self.modem_rx.modes)}"
+    def completion_rx_modes(self):
+        return {
+            action: {x.name : None for x in Modems} for action in ["add", "remove"]
+        }
+
     def do_clear(self, arg):
         "Clears TX queues"
         self.output_device.clear()
-        with self.output_device.send_queue_lock:
-            self.output_device.send_queue = []
+        self.output_device.send_queue.clear()
+        if self.modem_tx.arq:
+            self.modem_tx.arq.take_pending()
         return "TX buffer cleared"
 
     def do_list_audio_devices(self, arg):
@@ -142,7 +168,7 @@ class FreeDVShellCommands():
             return "Usage is: volume -4.5"
         return f"Set TX volume to {float(arg)} db"
     def do_max_packets_combined(self,arg):
-        "Set the max number of packets to combine together for a single transmission"
+        "Set the max number of packets that can start in a single modem frame"
         if arg == "":
             return f"max_packets_combined: {self.options.max_packets_combined}"
         try: 
@@ -152,6 +178,40 @@ class FreeDVShellCommands():
             return "Usage is: max_packets_combined 5"
         return f"Set max_packets_combined to {int(arg)}"
     
+    def do_fec_repair(self,arg):
+        "Set the repair frames added per data frame for packets that span multiple frames - 0 disables"
+        if arg == "":
+            return f"fec_repair: {self.options.fec_repair}"
+        try: 
+            self.modem_tx.fec_repair = float(arg)
+            self.options.fec_repair = float(arg)
+        except ValueError:
+            return "Usage is: fec_repair 0.25"
+        return f"Set fec_repair to {float(arg)}"
+
+    def help_compression(self):
+        return "Show compression stats or change compression: compression [none, zlib, zstd]"
+    def do_compression(self, arg):
+        if arg == "":
+            if not self.modem_tx.compressor:
+                return "Compression is off"
+            rows = self.modem_tx.compressor.rows(self.modem_tx.frame_info)
+            if not rows:
+                return f"Compression: {self.modem_tx.compressor.algorithm} - nothing sent yet"
+            return f"Compression: {self.modem_tx.compressor.algorithm}\n" + tabulate(rows, headers="keys")
+        if arg not in ["none", "zlib", "zstd"]:
+            return "Usage: compression zlib"
+        try:
+            self.modem_tx.compressor = Compressor(arg) if arg != "none" else None
+        except ValueError as e:
+            return str(e)
+        self.options.compression = arg
+        return f"Set compression to {arg}"
+    def completion_compression(self):
+        return {
+            x: None for x in ["none", "zlib", "zstd"]
+        }
+
     def do_callsign(self,arg):
         "Sets callsign - example: callsign N0CALL"
         self.options.callsign = arg
@@ -204,7 +264,51 @@ class FreeDVShellCommands():
             "on": None,
             "off": None
         }        
+
+    def do_adaptive(self,arg):
+        "Picks the TX mode for each destination from the link table - adaptive on"
+        if arg not in ["on", "off"]:
+            return "Usage: adaptive on or adaptive off"
+        self.modem_tx.adaptive = arg == "on"
+        self.options.adaptive = self.modem_tx.adaptive
+        return f"Set adaptive mode to {arg}"
+    def completion_adaptive(self):
+        return {
+            "on": None,
+            "off": None
+        }
+
+    def do_links(self, arg):
+        "Shows how well we hear each station on each mode"
+        rows = self.modem_tx.links.rows() if self.modem_tx.links else []
+        if not rows:
+            return "No stations heard yet"
+        return tabulate(rows, headers="keys")
     
+    def do_tx_queue(self, arg):
+        "Shows queued packets, bytes, airtime and drops for each TX queue class"
+        return tabulate(self.output_device.send_queue.rows(), headers="keys")
+
+    def do_audio(self, arg):
+        "Shows sound card buffer use, latency, underruns and late callbacks"
+        output = self.output_device
+        input_device = self.input_device
+        rows = [
+            {"stat": "input frames per buffer", "value": f"{input_device.tuner.frames_per_buffer}{' (auto)' if input_device.tuner.auto else ''}"},
+            {"stat": "input stream latency ms", "value": round(input_device.stream_latency * 1000)},
+            {"stat": "input to demod ms", "value": str(input_device.latency)},
+            {"stat": "output frames per buffer", "value": f"{output.tuner.frames_per_buffer}{' (auto)' if output.tuner.auto else ''}"},
+            {"stat": "output stream latency ms", "value": round(output.stream_latency * 1000)},
+            {"stat": "queue to air ms", "value": str(output.latency)},
+            {"stat": "output queued ms", "value": round(output.queue_ms)},
+            {"stat": "output buffer ms", "value": round(output.ring.capacity / output.bytes_per_ms)},
+            {"stat": "output underruns", "value": output.underruns},
+            {"stat": "output late callbacks", "value": output.late_callbacks},
+            {"stat": "output chained batches", "value": output.chained_batches},
+            {"stat": "input overruns", "value": input_device.overruns},
+        ]
+        return tabulate(rows, headers="keys")
+
     def do_exception(self, arg):
         "Raises and exemption to test the shell"
         raise NotImplementedError("woof\nwoof\n")
@@ -258,7 +362,7 @@ class FreeDVShell():
         self.input_device = input_device
 
         self.logger = logging.getLogger()
-        self.shell_commands = FreeDVShellCommands(modem_tx, output_device, parser, options)
+        self.shell_commands = FreeDVShellCommands(modem_rx, modem_tx, output_device, input_device, parser, options)
         self.log_text_area = TextArea(
             text="",
             scrollbar=True,
@@ -349,12 +453,20 @@ class FreeDVShell():
                 (f"class:status.{dbfs_color}",f"{self.input_device.input_level:6.2f}"),
                 ("class:status",f" dBFS | "),
 
+                ("class:status", f"Overruns: "),
+                (f"class:status.{'red' if self.input_device.overruns else 'green'}", f"{self.input_device.overruns}"),
+                ("class:status",f" | "),
+
                 ("class:status", f"PTT: "),
                 (f"class:status.{ 'red' if self.output_device.ptt else 'green' }", f"{ ' on' if self.output_device.ptt else 'off' }"),
                 ("class:status", f" | "),
 
                 ("class:status", f"Audio Queue: { (self.output_device.queue_ms / 1000) :5.1f}s | "),
-                ("class:status", f"TX Queue: { len(self.output_device.send_queue) :3.0f} | "),
+                ("class:status", f"Underruns: "),
+                (f"class:status.{'red' if self.output_device.underruns else 'green'}", f"{self.output_device.underruns}"),
+                ("class:status", f" | "),
+                ("class:status", f"Latency: RX {self.input_device.latency.short} TX {self.output_device.latency.short} | "),
+                ("class:status", "TX Queue: " + " ".join(f"{name}:{depth}" for name, depth in self.output_device.send_queue.depths().items()) + " | "),
                 ("class:status", f"Channel: "),
                 (f"class:status.{'red' if self.output_device.inhibit else 'green'}", f"{'busy' if self.output_device.inhibit else 'clear'}"),
                 ("class:status", f" | TX Mode: "),
@@ -363,15 +475,20 @@ class FreeDVShell():
                 ]
 
                 nl = "\n"
+                modems = self.modem_rx.modems # the list can be replaced when rx modes change
+                demoted = self.modem_rx.governor.demoted if self.modem_rx.governor else set()
                 snrs = [
-                    ("class:status", f'{x[1].modem_name}: {x[1].snr:6.2f}db {"|" +nl if x[0] == len(self.modem_rx.modems)-1 else "| "}' ) for x in enumerate(self.modem_rx.modems)
+                    ("class:status", f'{x[1].modem_name}: {x[1].snr:6.2f}db {"|" +nl if x[0] == len(modems)-1 else "| "}' ) for x in enumerate(modems)
                 ]
 
 
                 syncs = []
-                for x in self.modem_rx.modems:
+                for x in modems:
                     syncs.append(("class:status", f"{x.modem_name}: "))
-                    syncs.append((f"class:status.{'red' if x.sync == 0 else 'green'}",f"{x.sync:8}"))
+                    if x.modem_name in demoted:
+                        syncs.append(("class:status.yellow",f"{'idle':>8}"))
+                    else:
+                        syncs.append((f"class:status.{'red' if x.sync == 0 else 'green'}",f"{x.sync:8}"))
                     syncs.append(("class:status",f" | " ))
                     
                 
@@ -0,0 +1,39 @@
+import unittest
+from . import arq
+from .framing import Packet, ARQ_HEADER
+
+class TestArqSender(unittest.TestCase):
+    def test_eligible(self):
+        sender = arq.ArqSender()
+        self.assertFalse(sender.eligible(Packet(bytes(50)), 124))
+        self.assertTrue(sender.eligible(Packet(bytes(500)), 124))
+        self.assertFalse(sender.eligible(Packet(bytes(500), header=bytes([ARQ_HEADER])), 124))
+        self.assertFalse(sender.eligible(Packet(bytes(30000)), 54)) # more frames than sequence numbers
+
+    def test_wrap(self):
+        sender = arq.ArqSender()
+        first, packet = sender.wrap(Packet(b"hello", header=b"\xfe"))
+        second, _ = sender.wrap(Packet(b"hello"))
+        self.assertNotEqual(first, second)
+        self.assertEqual(packet.header, bytes([ARQ_HEADER]))
+        self.assertEqual(packet.data[:2], first)
+        self.assertEqual(packet.data[6:], b"\xfehello")
+
+    def test_nack(self):
+        sender = arq.ArqSender()
+        frames = [bytes([x])*10 for x in range(10)]
+        sender.store(b"\x00\x01", "DATAC4", frames)
+        self.assertEqual(sender.nack(b"\x00\x01" + bytes([0b00100100, 0b10])), 4)
+        self.assertEqual(sender.take_pending(), [("DATAC4", [frames[0], frames[2], frames[5], frames[9]])])
+        self.assertEqual(sender.take_pending(), [])
+        self.assertEqual(sender.nack(b"\x00\x02\xff"), 0) # unknown packet
+
+    def test_cache_limit(self):
+        sender = arq.ArqSender(max_bytes=250)
+        for packet_id in range(5):
+            sender.store(packet_id.to_bytes(2), "DATAC1", [bytes(50)]*2)
+        self.assertEqual(list(sender.cache), [(3).to_bytes(2), (4).to_bytes(2)])
+        self.assertEqual(sender.cached_bytes, 200)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,8 +4,153 @@ logging.basicConfig(level=logging.DEBUG)
 import unittest
 from unittest.mock import Mock, call
 from . import audio
+from .framing import Packet
+from .txqueue import TxQueue
+import os
+import tempfile
 import time
 
+class FakePyAudio():
+    def __init__(self, devices: list[tuple[str, int, int]], default_input: int|None, default_output: int|None):
+        self.devices = devices
+        self.defaults = (default_input, default_output)
+    def get_device_count(self):
+        return len(self.devices)
+    def get_device_info_by_index(self, index):
+        name, inputs, outputs = self.devices[index]
+        return {"name": name, "maxInputChannels": inputs, "maxOutputChannels": outputs, "defaultSampleRate": 48000.0}
+    def default(self, index):
+        if index is None:
+            raise IOError("No Default Device")
+        return {"index": index}
+    def get_default_input_device_info(self):
+        return self.default(self.defaults[0])
+    def get_default_output_device_info(self):
+        return self.default(self.defaults[1])
+
+class TestAudioDevices(unittest.TestCase):
+    def test_find(self):
+        devices = audio.AudioDevices(FakePyAudio([("USB", 1, 0), ("USB", 0, 2), ("hdmi", 0, 8)], 0, 2))
+        self.assertEqual(devices.find("USB", output=False).id, 0)
+        self.assertEqual(devices.find("USB", output=True).id, 1)
+        self.assertEqual(devices.find(2, output=True).name, "hdmi")
+        self.assertEqual(devices.find(None, output=True).id, 2)
+        with self.assertRaises(ValueError):
+            devices.find("hdmi", output=False)
+
+    def test_no_default_device(self):
+        devices = audio.AudioDevices(FakePyAudio([], None, None))
+        with self.assertRaises(ValueError):
+            devices.find(None, output=False)
+
+class TestBufferTuner(unittest.TestCase):
+    def test_fixed(self):
+        tuner = audio.BufferTuner(1024, lambda: 0, Mock(), "test")
+        self.assertEqual((tuner.auto, tuner.frames_per_buffer), (False, 1024))
+
+    def test_stream_backend_not_tuned(self):
+        # reopening a file: output would truncate everything written so far
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "tx.raw")
+            tx = Mock(pending=[])
+            tx.modems = {"DATAC1": Mock(burst_bytes=16000, sample_rate=8000)}
+            output = audio.OutputDevice(8000, tx, name_or_id=f"file:{path}?pace=fast", frames_per_buffer="auto")
+            self.assertFalse(output.tuner.auto)
+            self.assertEqual(output.tuner.frames_per_buffer, audio.AUTO_FRAMES_PER_BUFFER[0])
+            stream = output.stream
+            output.late_callbacks += 1
+            time.sleep(0.1)
+            self.assertIs(output.stream, stream)
+            output.close()
+            self.assertGreater(os.path.getsize(path), 0)
+
+class TestLatency(unittest.TestCase):
+    def test_latency(self):
+        latency = audio.Latency()
+        self.assertEqual((str(latency), latency.short), ("-", "-"))
+        latency.add(100)
+        latency.add(200)
+        self.assertEqual(str(latency), "200 (avg 110, max 200)")
+        self.assertEqual(latency.short, "110ms")
+
+class TestInputDevice(unittest.TestCase):
+    def test_no_stream_yet(self):
+        # with --full-duplex the stream is opened after the input device, and auto tuning reopens it - the DSP thread
+        # has to keep going without one
+        callback = Mock()
+        input_device = audio.InputDevice(callback, 8000, name_or_id="file:/dev/null", own_stream=False)
+        input_device.pa_callback(bytes(1600), 800, {}, 0)
+        wait = time.monotonic() + 5
+        while input_device.latency.last is None and time.monotonic() < wait:
+            time.sleep(0.01)
+        self.assertTrue(input_device.dsp_thread.is_alive())
+        callback.assert_called()
+        self.assertIsNotNone(input_device.latency.last)
+        input_device.close()
+
+class TestOutputDevice(unittest.TestCase):
+    def test_callback_reuses_buffer(self):
+        tx = Mock(pending=[])
+        tx.modems = {"DATAC1": Mock(burst_bytes=16000, sample_rate=8000)}
+        output = audio.OutputDevice(8000, tx, name_or_id="file:/dev/null", own_stream=False)
+        output.ring.write(bytes(range(256)) * 2)
+        first, _ = output.pa_callback(None, 256, {}, 0)
+        self.assertEqual(bytes(first), bytes(range(256)) * 2)
+        second, _ = output.pa_callback(None, 256, {}, 0)
+        self.assertIs(first, second) # played straight from the same buffer rather than a copy per callback
+        self.assertEqual(bytes(second), bytes(512))
+
+    def test_nothing_to_send(self):
+        # the queue can be cleared between the callback seeing packets and the modulation thread taking them
+        tx = Mock(pending=False, pending_seconds=0)
+        tx.modems = {"DATAC1": Mock(burst_bytes=16000, sample_rate=8000)}
+        output = audio.OutputDevice(8000, tx, name_or_id="file:/dev/null", ptt_on_delay_ms=100, own_stream=False)
+        output.audio_buffer()
+        tx.write_stream.assert_not_called()
+        self.assertEqual(len(output.ring), 0) # no PTT delay queued so PTT isn't keyed
+
+    def first_batch(self, pending_seconds: float) -> list:
+        tx = Mock(pending=bool(pending_seconds), pending_seconds=pending_seconds, write_stream=Mock(return_value=[]))
+        tx.modems = {"DATAC1": Mock(burst_bytes=16000, sample_rate=8000)}
+        queue = TxQueue(airtime=lambda packet: 10)
+        for x in range(5):
+            queue.put(Packet(bytes([x])))
+        output = audio.OutputDevice(8000, tx, name_or_id="file:/dev/null", send_queue=queue, max_tx_seconds=25, own_stream=False)
+        output.next_batch = Mock(return_value=None)
+        output.audio_buffer()
+        return [x.data for x in tx.write_stream.call_args[0][0]]
+
+    def test_first_batch_capped(self):
+        self.assertEqual(self.first_batch(0), [b"\x00", b"\x01"])
+        # ARQ resends are played first and count against max_tx_seconds
+        self.assertEqual(self.first_batch(15), [b"\x00"])
+        self.assertEqual(self.first_batch(30), [])
+
+    def test_use_channels(self):
+        tx = Mock(pending=[])
+        tx.modems = {"DATAC1": Mock(burst_bytes=16000, sample_rate=8000)}
+        output = audio.OutputDevice(8000, tx, name_or_id="file:/dev/null?channels=2", own_stream=False)
+        self.assertEqual(len(output.convert(bytes(160))), 320)
+        output.use_channels(1)
+        self.assertEqual(len(output.convert(bytes(160))), 160)
+        self.assertEqual(len(output.silence(10)), 160)
+
+class TestDuplexStream(unittest.TestCase):
+    def test_channel_counts_differ(self):
+        # CM108 style cards have one input channel and two output channels
+        device = Mock(id=1, input_channels=1, output_channels=2)
+        device.name = "CM108"
+        stream = Mock()
+        stream.get_input_latency.return_value = stream.get_output_latency.return_value = 0.01
+        input_device = Mock(device=device, input_overflows=0)
+        input_device.backend.open.return_value = stream
+        output_device = Mock(device=device, late_callbacks=0)
+        duplex = audio.DuplexStream(input_device, output_device, frames_per_buffer=1024)
+        input_device.use_channels.assert_called_once_with(1)
+        output_device.use_channels.assert_called_once_with(1)
+        self.assertEqual(input_device.backend.open.call_args[0][1], 1)
+        duplex.close()
+
 class TestAudio(unittest.TestCase):
     def test_audio_list_devices(self):
         audio.devices # just test that this function doesn't error - we can probably mock out pyaudio for proper tests
@@ -0,0 +1,103 @@
+import unittest
+import os
+import socket
+import tempfile
+import time
+from . import backends
+
+def collect(received: list):
+    def callback(in_data, frame_count, time_info, status):
+        received.append(in_data)
+        return (None, backends.CONTINUE)
+    return callback
+
+def counter(blocks: int, frame_count: int):
+    """
+    Output callback that plays blocks of incrementing samples then silence
+    """
+    sent = []
+    def callback(in_data, frames, time_info, status):
+        block = bytes([len(sent) % 256]) * frame_count * 2 if len(sent) < blocks else bytes(frame_count * 2)
+        sent.append(block)
+        return (block, backends.CONTINUE)
+    return callback, sent
+
+def wait_for(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+class TestBackends(unittest.TestCase):
+    def test_uri(self):
+        backend = backends.from_uri("file:/tmp/rx.raw?rate=48000&channels=2&pace=fast")
+        self.assertEqual((backend.path, backend.sample_rate, backend.channels, backend.pace), ("/tmp/rx.raw", 48000, 2, "fast"))
+        self.assertEqual(backends.from_uri("udp://127.0.0.1:9000").address, ("127.0.0.1", 9000))
+        self.assertIsNone(backends.from_uri("hw:1,0")) # an ALSA device name
+        self.assertIsNone(backends.from_uri(3))
+        with self.assertRaises(ValueError):
+            backends.from_uri("file:/tmp/rx.raw?pace=slow")
+        with self.assertRaises(ValueError):
+            backends.from_uri("udp://127.0.0.1")
+
+    def test_file_fast(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "audio.raw")
+            with open(path, "wb") as f:
+                f.write(os.urandom(100 * 2 * 10 + 50)) # the partial block at the end isn't played
+            backend = backends.from_uri(f"file:{path}?pace=fast")
+            received = []
+            stream = backend.open(backend.find(None, output=False), 1, input=True, output=False,
+                                  callback=collect(received), frames_per_buffer=100)
+            stream.thread.join(5)
+            with open(path, "rb") as f:
+                self.assertEqual(b"".join(received), f.read()[:2000])
+
+    def test_realtime_pacing(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "audio.raw")
+            with open(path, "wb") as f:
+                f.write(bytes(400 * 2 * 6))
+            backend = backends.from_uri(f"file:{path}")
+            received = []
+            start = time.monotonic()
+            stream = backend.open(backend.find(None, output=False), 1, input=True, output=False,
+                                  callback=collect(received), frames_per_buffer=400)
+            stream.thread.join(5)
+            self.assertEqual(len(received), 6)
+            self.assertGreater(time.monotonic() - start, 0.25) # 6 blocks of 50ms, the first one straight away
+
+    @unittest.skipUnless(hasattr(os, "mkfifo"), "needs FIFOs")
+    def test_fifo(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "fifo")
+            os.mkfifo(path)
+            backend = backends.from_uri(f"file:{path}?pace=fast")
+            device = backend.find(None, output=True)
+            received = []
+            callback, sent = counter(20, 160)
+            output = backend.open(device, 1, input=False, output=True, callback=callback, frames_per_buffer=160)
+            input = backend.open(device, 1, input=True, output=False, callback=collect(received), frames_per_buffer=160)
+            wait_for(lambda: len(received) >= 20)
+            output.close()
+            input.thread.join(5) # the reader sees the end of the file once the writer closes
+            self.assertFalse(input.thread.is_alive())
+            self.assertEqual(received[:20], sent[:20])
+
+    def test_udp(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        backend = backends.from_uri(f"udp://127.0.0.1:{port}")
+        device = backend.find(None, output=True)
+        received = []
+        input = backend.open(device, 1, input=True, output=False, callback=collect(received), frames_per_buffer=800)
+        callback, sent = counter(5, 800) # 1600 byte blocks are sent as two datagrams
+        output = backend.open(device, 1, input=False, output=True, callback=callback, frames_per_buffer=800)
+        wait_for(lambda: len(received) >= 5)
+        output.close()
+        input.close()
+        self.assertFalse(input.thread.is_alive())
+        self.assertEqual(received[:5], sent[:5])
+
+if __name__ == '__main__':
+    unittest.main()
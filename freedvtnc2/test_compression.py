@@ -0,0 +1,43 @@
+import unittest
+import random
+from . import compression
+from .framing import Packet
+
+APRS = compression.ax25_call("APDW16") + compression.ax25_call("VK4ABC", 9) + compression.ax25_call("WIDE1", 1) + \
+    b"\x03\xf0!2730.00S/15300.00E-PHG2360/A=000100 Brisbane igate on the FreeDV data modem"
+
+class TestCompression(unittest.TestCase):
+    def roundtrip(self, algorithm: str):
+        compressor = compression.Compressor(algorithm)
+        packets = [Packet(APRS), Packet(b"VK4ABC\xffhello how are you? copy your signal fine, 73", header=b"\xfe")]
+        for packet in packets:
+            compressed = compressor.compress(packet, "DATAC3")
+            self.assertEqual(compressed.header, bytes([compression.COMPRESSED_HEADER]))
+            self.assertLess(len(compressed.data), len(packet.data))
+            restored = compression.decompress(Packet(compressed.data, header=compression.COMPRESSED_HEADER, mode="DATAC3", snr=3))
+            self.assertEqual(restored, Packet(packet.data, header=packet.header[0], mode="DATAC3", snr=3))
+        stats = compressor.stats["DATAC3"]
+        self.assertEqual((stats.packets, stats.compressed), (2, 2))
+        self.assertGreater(compressor.rows({"DATAC3": (124, 3.5)})[0]["effective B/s"], 124 / 3.5)
+
+    def test_zlib(self):
+        self.roundtrip("zlib")
+
+    @unittest.skipUnless(compression.zstandard, "zstandard isn't installed")
+    def test_zstd(self):
+        self.roundtrip("zstd")
+
+    def test_fallback(self):
+        compressor = compression.Compressor()
+        packet = Packet(random.Random(0).randbytes(200))
+        self.assertIs(compressor.compress(packet, "DATAC1"), packet)
+        control = Packet(APRS, header=b"\xfd")
+        self.assertIs(compressor.compress(control, "DATAC1"), control)
+        self.assertEqual(compressor.stats["DATAC1"].ratio, 1)
+
+    def test_corrupt(self):
+        self.assertIsNone(compression.decompress(Packet(b"\x01\xff\xff\xff\xff\xff", header=compression.COMPRESSED_HEADER)))
+        self.assertIsNone(compression.decompress(Packet(b"\x09\xffabc", header=compression.COMPRESSED_HEADER)))
+
+if __name__ == '__main__':
+    unittest.main()
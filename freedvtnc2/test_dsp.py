@@ -0,0 +1,91 @@
+import unittest
+import random
+import numpy as np
+from . import dsp
+
+try:
+    import audioop
+except ImportError: # python 3.13+
+    audioop = None
+
+def noise(samples: int, seed: int = 0) -> bytes:
+    return random.Random(seed).randbytes(samples * 2)
+
+class TestDSP(unittest.TestCase):
+    def test_blocks_match_whole(self):
+        data = np.frombuffer(noise(48000), dtype=np.int16)
+        whole = dsp.LinearResampler(48000, 8000).process(data)
+        resampler = dsp.LinearResampler(48000, 8000)
+        blocks = np.concatenate([resampler.process(data[x:x+1000]) for x in range(0, len(data), 1000)])
+        self.assertTrue(np.array_equal(whole, blocks))
+        self.assertEqual(len(whole), 8000)
+
+    def test_input(self):
+        stereo = np.zeros((4800, 2), dtype=np.int16)
+        stereo[:, 0] = 16384
+        stereo[:, 1] = -32768 # only the left channel is used but metering covers both
+        input_dsp = dsp.InputDSP(2, 48000, 8000, resampler="linear")
+        mono = np.frombuffer(input_dsp.process(stereo.tobytes()), dtype=np.int16)
+        self.assertEqual(input_dsp.level, 0)
+        self.assertEqual(len(mono), 800)
+        self.assertTrue(np.all(mono[1:] == 16384))
+
+    def test_output(self):
+        output_dsp = dsp.OutputDSP(2, 8000, 8000, db=6.0206)
+        samples = np.array([100, -100, 20000, -20000], dtype=np.int16)
+        stereo = np.frombuffer(output_dsp.process(samples.tobytes()), dtype=np.int16).reshape(-1, 2)
+        self.assertEqual(stereo[:, 0].tolist(), [200, -201, 32767, -32768])
+        self.assertTrue(np.array_equal(stereo[:, 0], stereo[:, 1]))
+
+    def test_polyphase_blocks_match_whole(self):
+        for in_rate, out_rate in ((48000, 8000), (44100, 8000), (8000, 48000), (8000, 44100)):
+            data = np.frombuffer(noise(in_rate), dtype=np.int16)
+            whole = dsp.PolyphaseResampler(in_rate, out_rate).process(data)
+            resampler = dsp.PolyphaseResampler(in_rate, out_rate)
+            blocks = np.concatenate([resampler.process(data[x:x+777]) for x in range(0, len(data), 777)])
+            self.assertEqual(len(whole), len(blocks))
+            # float32 sums can round differently depending on block size
+            self.assertLessEqual(np.abs(whole.astype(np.int32) - blocks).max(), 1)
+
+    def test_polyphase_filters(self):
+        t = np.arange(48000) / 48000
+        for frequency, linear_rms, polyphase_rms in ((1500, 7000, 7000), (7000, 7000, 1)):
+            tone = (10000 * np.sin(2 * np.pi * frequency * t)).astype(np.int16)
+            for resampler, expected in ((dsp.LinearResampler, linear_rms), (dsp.PolyphaseResampler, polyphase_rms)):
+                output = resampler(48000, 8000).process(tone)[100:].astype(np.float64)
+                rms = np.sqrt(np.mean(output**2))
+                if expected > 1:
+                    self.assertGreater(rms, expected)
+                else: # 7kHz would alias to 1kHz - right in the modem's passband
+                    self.assertLess(rms, expected)
+
+    def test_sine(self):
+        data = dsp.sine(440, 8000, 2000, volume=-6)
+        self.assertEqual(len(data), 8000 * 2 * 2)
+        self.assertAlmostEqual(dsp.dbfs(dsp.peak(np.frombuffer(data, dtype=np.int16))), -6, places=1)
+
+    @unittest.skipIf(audioop is None, "audioop isn't available")
+    def test_matches_audioop(self):
+        for in_rate, out_rate in ((48000, 8000), (44100, 8000), (8000, 48000), (8000, 44100)):
+            resampler = dsp.LinearResampler(in_rate, out_rate)
+            state = None
+            for block in range(20):
+                data = noise(random.Random(block).randrange(0, 4096), seed=block)
+                expected, state = audioop.ratecv(data, 2, 1, in_rate, out_rate, state)
+                self.assertEqual(resampler.process(np.frombuffer(data, dtype=np.int16)).tobytes(), expected)
+
+        data = noise(8192)
+        self.assertEqual(dsp.rms(data), audioop.rms(data, 2))
+        self.assertEqual(dsp.peak(np.frombuffer(data, dtype=np.int16)), audioop.max(data, 2))
+
+        output_dsp = dsp.OutputDSP(2, 8000, 48000, db=-3, resampler="linear")
+        expected = audioop.ratecv(data, 2, 1, 8000, 48000, None)[0]
+        expected = audioop.tostereo(audioop.mul(expected, 2, 10**(-3/20)), 2, 1, 1)
+        self.assertEqual(output_dsp.process(data), expected)
+
+        stereo = audioop.tostereo(data, 2, 1, 1)
+        expected = audioop.ratecv(audioop.tomono(stereo, 2, 1, 0), 2, 1, 48000, 8000, None)[0]
+        self.assertEqual(dsp.InputDSP(2, 48000, 8000, resampler="linear").process(stereo), expected)
+
+if __name__ == '__main__':
+    unittest.main()
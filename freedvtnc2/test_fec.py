@@ -0,0 +1,58 @@
+import unittest
+from unittest.mock import Mock
+import random
+from . import fec
+from . import framing
+
+class TestFec(unittest.TestCase):
+    def test_gf(self):
+        for a in range(1, 256):
+            self.assertEqual(fec.gf_mul(a, fec.gf_inv(a)), 1)
+        self.assertEqual(fec.mul_table(7)[0], 0)
+
+    def test_any_n_of_n_plus_k(self):
+        rng = random.Random(0)
+        n, k = 10, 4
+        symbols = [rng.randbytes(50) for _ in range(n)]
+        everything = dict(enumerate(symbols + fec.encode(symbols, k)))
+        for _ in range(50):
+            lost = rng.sample(range(n + k), k)
+            received = {index: symbol for index, symbol in everything.items() if index not in lost}
+            self.assertEqual(fec.decode(received, n), symbols)
+
+    def test_not_enough(self):
+        symbols = [bytes([x])*10 for x in range(5)]
+        everything = dict(enumerate(symbols + fec.encode(symbols, 1)))
+        del everything[0], everything[1]
+        with self.assertRaises(ValueError):
+            fec.decode(everything, 5)
+
+    def test_repair_count(self):
+        self.assertEqual(fec.repair_count(10, 0), 0)
+        self.assertEqual(fec.repair_count(10, 0.25), 3)
+        self.assertEqual(fec.repair_count(250, 1), 5)
+
+    def test_reassembly(self):
+        callback = Mock()
+        reassembler = framing.Reassembler(callback)
+        data = bytes(range(256)) * 3
+        frames = fec.fec_frames(b"\x12\x34", b"\xff", data, 100, 0.5)
+        self.assertEqual(len(frames), 9 + 5)
+        del frames[2], frames[5], frames[7] # lose some data frames
+        for frame in frames:
+            reassembler.feed(bytes(frame), "DATAC3")
+        callback.assert_called_once_with(framing.Packet(data=data, header=0xff, mode="DATAC3"))
+        self.assertEqual(reassembler.fec, {})
+
+    def test_reassembly_interleaved(self):
+        callback = Mock()
+        reassembler = framing.Reassembler(callback)
+        a = fec.fec_frames(b"\x00\x01", b"\xff", b"a"*300, 100, 0.5)
+        b = fec.fec_frames(b"\x00\x02", b"\xfe", b"b"*300, 100, 0.5)
+        for frame_a, frame_b in zip(a[1:], b[2:]):
+            reassembler.feed(bytes(frame_a), "DATAC3")
+            reassembler.feed(bytes(frame_b), "DATAC3")
+        self.assertEqual({x[0][0].data for x in callback.call_args_list}, {b"a"*300, b"b"*300})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,254 @@
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+import random
+import unittest
+from unittest.mock import Mock
+from . import framing
+from . import arq
+
+def split_packet(data: bytes, frame_size: int, header: int = 0xff) -> list[bytes]:
+    """
+    Builds frames for a single packet in the same layout the modulator uses
+    """
+    frames = []
+    first = bytes([header]) + len(data).to_bytes(2) + data[:frame_size-3]
+    frames.append(first.ljust(frame_size, b"\x00"))
+    data = data[frame_size-3:]
+    seq = 0
+    while data:
+        frames.append((bytes([seq % framing.SEQ_MODULO]) + data[:frame_size-1]).ljust(frame_size, b"\x00"))
+        data = data[frame_size-1:]
+        seq += 1
+    return frames
+
+class TestReassembler(unittest.TestCase):
+    def test_interleaved_modes(self):
+        callback = Mock()
+        reassembler = framing.Reassembler(callback)
+        a = split_packet(b"a"*100, 30)
+        b = split_packet(b"b"*100, 40, header=0xfe)
+        for frame_a, frame_b in zip(a, b):
+            reassembler.feed(frame_a, "DATAC1")
+            reassembler.feed(frame_b, "DATAC3")
+        for frame in a[len(b):]:
+            reassembler.feed(frame, "DATAC1")
+        self.assertEqual(callback.call_args_list[0][0][0], framing.Packet(data=b"b"*100, header=0xfe, mode="DATAC3"))
+        self.assertEqual(callback.call_args_list[1][0][0], framing.Packet(data=b"a"*100, header=0xff, mode="DATAC1"))
+
+    def test_max_size_packet(self):
+        callback = Mock()
+        reassembler = framing.Reassembler(callback)
+        data = bytes(range(256))*127 # close to the 32kb limit and more than 201 frames
+        for frame in split_packet(data, 54):
+            reassembler.feed(frame, "DATAC4")
+        callback.assert_called_once_with(framing.Packet(data=data, header=0xff, mode="DATAC4"))
+
+    def test_missing_frame(self):
+        callback = Mock()
+        dropped = Mock()
+        reassembler = framing.Reassembler(callback, dropped=dropped)
+        frames = split_packet(b"a"*100, 30)
+        del frames[1]
+        for frame in frames:
+            reassembler.feed(frame, "DATAC1")
+        callback.assert_not_called()
+        self.assertEqual(reassembler.partials, {})
+        self.assertEqual(dropped.call_args[0][0].received, 27)
+        self.assertEqual(dropped.call_args[0][1], "DATAC1")
+
+    def test_timeout(self):
+        callback = Mock()
+        now = [0]
+        reassembler = framing.Reassembler(callback, timeout=10, clock=lambda: now[0])
+        frames = split_packet(b"a"*100, 30)
+        reassembler.feed(frames[0], "DATAC1")
+        now[0] = 11
+        for frame in frames[1:]:
+            reassembler.feed(frame, "DATAC1")
+        callback.assert_not_called()
+
+    def test_memory_cap(self):
+        callback = Mock()
+        reassembler = framing.Reassembler(callback, max_bytes=150)
+        a = split_packet(b"a"*100, 30)
+        b = split_packet(b"b"*100, 30)
+        reassembler.feed(a[0], "DATAC1")
+        reassembler.feed(b[0], "DATAC3") # evicts the DATAC1 packet
+        self.assertEqual(list(reassembler.partials), ["DATAC3"])
+        self.assertLessEqual(reassembler.in_flight_bytes, 150)
+
+    def test_combined_packets(self):
+        callback = Mock()
+        reassembler = framing.Reassembler(callback)
+        frame = b"\xff\x00\x02hi\xfe\x00\x03bye\x00\x00"
+        reassembler.feed(frame, "DATAC1")
+        self.assertEqual([x[0][0].data for x in callback.call_args_list], [b"hi", b"bye"])
+
+    def test_padding_frames(self):
+        callback = Mock()
+        reassembler = framing.Reassembler(callback)
+        frames = split_packet(b"a"*100, 30)
+        padding = bytes([framing.PADDING_HEADER]).ljust(30, b"\x00")
+        for frame in frames[:2] + [padding] + frames[2:] + [padding]:
+            reassembler.feed(frame, "DATAC1")
+        callback.assert_called_once_with(framing.Packet(data=b"a"*100, header=0xff, mode="DATAC1"))
+class TestArqReassembly(unittest.TestCase):
+    def setUp(self):
+        self.callback = Mock()
+        self.nack = Mock()
+        self.reassembler = framing.Reassembler(self.callback, nack=self.nack)
+        self.data = bytes(range(256)) * 4
+        _, packet = arq.ArqSender().wrap(framing.Packet(self.data))
+        self.frames = [bytes(x) for x in framing.pack_frames([packet], 100)]
+
+    def test_resend_missing(self):
+        for index, frame in enumerate(self.frames):
+            if index not in (3, 7):
+                self.reassembler.feed(frame, "DATAC3")
+        self.reassembler.end_of_transmission("DATAC3")
+        self.callback.assert_not_called()
+
+        nack = self.nack.call_args[0][0]
+        self.assertEqual(nack.header, bytes([framing.ARQ_NACK_HEADER]))
+        self.assertEqual(nack.data[2:], bytes([0b10001000, 0]))
+
+        # a resend always leads with the start frame
+        for index in (0, 3, 7):
+            self.reassembler.feed(self.frames[index], "DATAC3")
+        self.assertEqual(self.callback.call_args[0][0], framing.Packet(data=self.data, header=0xff, mode="DATAC3"))
+        self.assertEqual(self.reassembler.arq, {})
+
+        # late duplicate resend is ignored
+        self.reassembler.feed(self.frames[0], "DATAC3")
+        self.assertEqual(self.reassembler.arq, {})
+
+    def test_ignores_frames_without_start(self):
+        for frame in self.frames[:5]:
+            self.reassembler.feed(frame, "DATAC3")
+        self.reassembler.end_of_transmission("DATAC3")
+        # next transmission's start frame was lost - these frames can't be trusted
+        for frame in self.frames[5:]:
+            self.reassembler.feed(frame, "DATAC3")
+        self.callback.assert_not_called()
+        self.assertEqual(self.reassembler.arq["DATAC3"].frames.count(True), 5)
+
+    def test_resent_start_lost(self):
+        for index, frame in enumerate(self.frames):
+            if index != 3:
+                self.reassembler.feed(frame, "DATAC3")
+        self.reassembler.end_of_transmission("DATAC3")
+        self.assertEqual(self.nack.call_count, 1)
+        # the resend's start frame is lost so frame 3 can't be placed - NACK again rather than stall until the timeout
+        self.reassembler.feed(self.frames[3], "DATAC3")
+        self.reassembler.end_of_transmission("DATAC3")
+        self.assertEqual(self.nack.call_count, 2)
+        self.assertEqual(self.nack.call_args_list[0], self.nack.call_args_list[1])
+        for index in (0, 3):
+            self.reassembler.feed(self.frames[index], "DATAC3")
+        self.assertEqual(self.callback.call_args[0][0].data, self.data)
+
+    def test_other_packets_between_resends(self):
+        for index, frame in enumerate(self.frames):
+            if index != 2:
+                self.reassembler.feed(frame, "DATAC3")
+        self.reassembler.end_of_transmission("DATAC3")
+        for frame in split_packet(b"a"*150, 100):
+            self.reassembler.feed(frame, "DATAC3")
+        self.reassembler.feed(self.frames[0], "DATAC3")
+        self.reassembler.feed(self.frames[2], "DATAC3")
+        self.assertEqual([x[0][0].data for x in self.callback.call_args_list], [b"a"*150, self.data])
+
+    def test_crc(self):
+        self.frames[4] = self.frames[4][:10] + b"x" + self.frames[4][11:]
+        for frame in self.frames:
+            self.reassembler.feed(frame, "DATAC3")
+        self.callback.assert_not_called()
+
+    def test_gives_up(self):
+        self.reassembler.max_nacks = 1
+        self.reassembler.feed(self.frames[0], "DATAC3")
+        self.reassembler.end_of_transmission("DATAC3")
+        self.reassembler.feed(self.frames[0], "DATAC3")
+        self.reassembler.end_of_transmission("DATAC3")
+        self.assertEqual(self.nack.call_count, 1)
+        self.assertEqual(self.reassembler.arq, {})
+
+class TestPacking(unittest.TestCase):
+    def roundtrip(self, packer, packets: list[framing.Packet], payload_size: int) -> tuple[list[bytearray], list[framing.Packet]]:
+        callback = Mock()
+        frames = packer(list(packets), payload_size)
+        reassembler = framing.Reassembler(callback)
+        for frame in frames:
+            self.assertEqual(len(frame), payload_size)
+            reassembler.feed(frame, "DATAC1")
+        return frames, [x[0][0] for x in callback.call_args_list]
+
+    def test_pack_frames(self):
+        sizes = [17, 200, 17, 60, 1000, 17, 17, 90, 3, 1, 37, 51, 52]
+        packets = [framing.Packet(bytes([x % 200])*size) for x, size in enumerate(sizes)]
+        for packer in (framing.pack_greedy, framing.pack_frames):
+            frames, received = self.roundtrip(packer, packets, 54)
+            self.assertEqual(
+                sorted([x.data for x in received]),
+                sorted([x.data for x in packets])
+            )
+
+    def test_pack_frames_saves_frames(self):
+        # a run of short frames hits max_packets_combined before the frame is full
+        packets = [framing.Packet(b"a"*17) for x in range(8)] + [framing.Packet(b"b"*400) for x in range(2)]
+        greedy, _ = self.roundtrip(lambda queue, size: framing.pack_greedy(queue, size, max_packets_combined=5), packets, 510)
+        packed, _ = self.roundtrip(lambda queue, size: framing.pack_frames(queue, size, max_packets_combined=5), packets, 510)
+        self.assertLess(len(packed), len(greedy))
+        self.assertEqual(len(packed), 2)
+
+    def test_pack_frames_window(self):
+        packets = [framing.Packet(bytes([x])*(10 + x)) for x in range(10)]
+        _, received = self.roundtrip(lambda queue, size: framing.pack_frames(queue, size, window=5), packets, 54)
+        # packets can only be reordered within their window
+        self.assertEqual(sorted([x.data for x in received[:5]]), sorted([x.data for x in packets[:5]]))
+
+    def test_max_packets_combined(self):
+        packets = [framing.Packet(b"a") for x in range(10)]
+        frames = framing.pack_frames(list(packets), 54, max_packets_combined=3)
+        self.assertEqual(len(frames), 4)
+
+    def test_greedy_max_packets_combined(self):
+        frames = framing.pack_greedy([framing.Packet(b"a") for x in range(10)], 54, max_packets_combined=3)
+        self.assertEqual(len(frames), 4)
+
+    def test_never_worse_than_greedy(self):
+        rng = random.Random(0)
+        for _ in range(500):
+            packets = [framing.Packet(bytes([x])*rng.randint(1, 60)) for x in range(rng.randint(1, 20))]
+            greedy = framing.pack_greedy(list(packets), 508)
+            packed = framing.pack_frames(list(packets), 508)
+            self.assertLessEqual(len(packed), len(greedy))
+            if len(packed) == len(greedy): # nothing to gain so nothing is reordered
+                self.assertEqual(packed, greedy)
+
+    def test_no_reorder_for_nothing(self):
+        packets = [framing.Packet(b"a"*600), framing.Packet(b"b"*700)]
+        _, received = self.roundtrip(framing.pack_frames, packets, 508)
+        self.assertEqual([x.data for x in received], [x.data for x in packets])
+
+    def test_connection_order(self):
+        # AX.25 frames between the same stations stay in order - only other connections' packets move past them
+        a = bytes([ord(x) << 1 for x in "AAAAAA"]) + b"\x60"
+        b = bytes([ord(x) << 1 for x in "BBBBBB"]) + b"\x60"
+        c = bytes([ord(x) << 1 for x in "CCCCCC"]) + b"\x60"
+        packets = [framing.Packet(a + b + bytes([x])*3) for x in range(8)] + [framing.Packet(a + b + b"x"*400)]
+        packets += [framing.Packet(a + c + b"y"*400)]
+        _, received = self.roundtrip(lambda queue, size: framing.pack_frames(queue, size, max_packets_combined=5), packets, 510)
+        same = [x.data for x in received if x.data[7:14] == b]
+        self.assertEqual(same, [x.data for x in packets[:9]])
+        self.assertEqual(len(received), len(packets))
+
+    def test_exact_fit(self):
+        frames = framing.pack_frames([framing.Packet(b"a"*51)], 54)
+        self.assertEqual(len(frames), 1)
+        frames = framing.pack_frames([framing.Packet(b"a"*52)], 54)
+        self.assertEqual(len(frames), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+from . import linkquality
+from .framing import Packet, PartialPacket
+
+# (payload bytes, seconds per frame) - close to the real modes
+FRAME_INFO = {
+    "DATAC1": (508, 5.0),
+    "DATAC3": (124, 3.5),
+    "DATAC4": (54, 6.0),
+}
+
+def address(callsign: str, ssid: int = 0) -> bytes:
+    return bytes(x << 1 for x in callsign.ljust(6).encode()) + bytes([0x60 | ssid << 1])
+
+def ax25(destination: str, source: str, payload: bytes = b"", source_ssid: int = 0) -> bytes:
+    return address(destination) + address(source, source_ssid) + b"\x03\xf0" + payload
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0
+    def __call__(self):
+        return self.now
+
+class TestLinkQuality(unittest.TestCase):
+    def test_ax25_address(self):
+        data = ax25("VK4ABC", "N0CALL", source_ssid=1)
+        self.assertEqual(linkquality.ax25_address(data, 0), "VK4ABC")
+        self.assertEqual(linkquality.ax25_address(data, 7), "N0CALL-1")
+        self.assertIsNone(linkquality.ax25_address(b"hello world", 0))
+        self.assertIsNone(linkquality.ax25_address(data[:10], 7))
+
+    def test_select_by_snr(self):
+        table = linkquality.LinkQualityTable()
+        table.heard(Packet(ax25("N0CALL", "VK4ABC"), header=255, mode="DATAC3", snr=12))
+        table.heard(Packet(ax25("N0CALL", "VK4XYZ"), header=255, mode="DATAC4", snr=-3))
+        self.assertEqual(table.select("VK4ABC", [256]*8, FRAME_INFO), "DATAC1")
+        self.assertEqual(table.select("VK4XYZ", [256]*8, FRAME_INFO), "DATAC4")
+        self.assertIsNone(table.select("VK4QQQ", [256], FRAME_INFO))
+
+    def test_select_by_queue_size(self):
+        table = linkquality.LinkQualityTable()
+        table.heard(Packet(ax25("N0CALL", "VK4ABC"), header=255, mode="DATAC1", snr=12))
+        # a single ack is quicker in a short frame, a big queue is quicker in the big frames
+        self.assertEqual(table.select("VK4ABC", [17], FRAME_INFO), "DATAC3")
+        table.links["VK4ABC"].selected = None
+        self.assertEqual(table.select("VK4ABC", [256]*8, FRAME_INFO), "DATAC1")
+
+    def test_failures_move_mode(self):
+        table = linkquality.LinkQualityTable()
+        table.heard(Packet(ax25("N0CALL", "VK4ABC"), header=255, mode="DATAC1", snr=8))
+        self.assertEqual(table.select("VK4ABC", [256]*8, FRAME_INFO), "DATAC1")
+        buffer = bytearray(ax25("N0CALL", "VK4ABC", bytes(100)))
+        for _ in range(10):
+            table.dropped(PartialPacket(header=255, buffer=buffer, received=50, next_seq=1, updated=0), "DATAC1")
+        self.assertEqual(table.links["VK4ABC"].modes["DATAC1"].failed, 10)
+        self.assertNotEqual(table.select("VK4ABC", [256]*8, FRAME_INFO), "DATAC1")
+
+    def test_stale(self):
+        clock = FakeClock()
+        table = linkquality.LinkQualityTable(max_age=60, clock=clock)
+        table.heard(Packet(ax25("N0CALL", "VK4ABC"), header=255, mode="DATAC1", snr=12))
+        clock.now = 61
+        self.assertIsNone(table.select("VK4ABC", [256], FRAME_INFO))
+
+    def test_ignores_non_kiss(self):
+        table = linkquality.LinkQualityTable()
+        table.heard(Packet(ax25("N0CALL", "VK4ABC"), header=254, mode="DATAC1", snr=12))
+        self.assertEqual(table.rows(), [])
+
+if __name__ == '__main__':
+    unittest.main()
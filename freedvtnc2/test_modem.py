@@ -4,6 +4,10 @@ logging.basicConfig(level=logging.DEBUG)
 import unittest
 from unittest.mock import Mock, call
 from . import modem
+from . import offline
+import os
+import tempfile
+import time
 
 class TestModem(unittest.TestCase):
     def testMultiRX(self):
@@ -31,6 +35,187 @@ class TestModem(unittest.TestCase):
         rx.write(tx_output)
         self.assertEqual(callback.call_args_list[0][0][0],modem.Packet(data=b'test',header=255))
         self.assertEqual(callback.call_args_list[1][0][0],modem.Packet(data=b'test'*200,header=255))
+    def testThreadedRX(self):
+        results = []
+        for threaded in (False, True):
+            callback = Mock()
+            inhibit = Mock()
+            rx = modem.FreeDVRX(callback, progress=Mock(), inhibit=inhibit, threaded=threaded)
+            with open("c01.raw","rb") as f:
+                while chunk := f.read(4096):
+                    rx.write(chunk)
+            rx.close()
+            results.append((callback.call_args_list, inhibit.call_args_list))
+        self.assertEqual(results[0], results[1])
+    def testGovernor(self):
+        governor = modem.RXGovernor(idle_seconds=60, duty_period=10, duty_window=2)
+        governor.update(0, "DATAC4", False)
+        governor.update(61, "DATAC4", False)
+        self.assertIn("DATAC4", governor.demoted)
+        self.assertTrue(governor.should_demodulate(71, "DATAC4"))
+        self.assertFalse(governor.should_demodulate(75, "DATAC4"))
+        self.assertTrue(governor.should_demodulate(75, "DATAC1"))
+
+        governor.energy(80, 1, -60) # sets the noise floor
+        governor.energy(81, 1, -30)
+        self.assertNotIn("DATAC4", governor.demoted)
+
+    def testRXModes(self):
+        rx = modem.FreeDVRX(Mock(), progress=Mock(), inhibit=Mock(), modes=["DATAC1"])
+        rx.add_mode("DATAC4")
+        rx.add_mode("DATAC3")
+        self.assertEqual(rx.modes, ["DATAC1", "DATAC3", "DATAC4"])
+        removed = rx.modems[0]
+        rx.remove_mode("DATAC1")
+        self.assertEqual(rx.modes, ["DATAC3", "DATAC4"])
+        self.assertIsNone(removed.modem)
+        self.assertEqual((removed.sync, removed.snr), (0, 0.0)) # the status bar can still read a removed modem
+        rx.close()
+    def testOfflineRX(self):
+        tx = modem.FreeDVTX()
+        with tempfile.NamedTemporaryFile(suffix=".raw") as f:
+            f.write(tx.write([modem.Packet(b'test'), modem.Packet(b'test'*200)]))
+            f.flush()
+            result = offline.demodulate_file(f.name)
+        self.assertEqual([x["data"] for x in result.packets], [b'test', b'test'*200])
+        self.assertEqual(result.packets[0]["mode"], "DATAC1")
+        self.assertIsInstance(result.packets[0]["snr"], float)
+        self.assertGreater(result.audio_seconds, 0)
+        self.assertEqual(set(result.demod_seconds), {x.name for x in modem.Modems})
+    def testStreamTX(self):
+        packets = [modem.Packet(b'test'), modem.Packet(b'test'*200)]
+        burst = modem.FreeDVTX().write(list(packets))
+        stream = list(modem.FreeDVTX().write_stream(list(packets)))
+        self.assertGreater(len(stream), 2) # one item per frame plus trailing silence
+        self.assertEqual(b"".join(stream), burst)
+        self.assertEqual(list(modem.FreeDVTX().write_stream([])), []) # nothing to key up for
+    def testTXModePool(self):
+        tx = modem.FreeDVTX(max_packets_combined=3)
+        datac1 = tx.modem
+        tx.set_mode("DATAC4")
+        self.assertEqual(tx.modem.modem_name, "DATAC4")
+        tx.set_mode("DATAC1")
+        self.assertIs(tx.modem, datac1)
+        tx.max_packets_combined = 7
+        self.assertEqual([x.max_packets_combined for x in tx.modems.values()], [7, 7, 7])
+        tx.close()
+        self.assertTrue(all(x.modem is None for x in tx.modems.values()))
+
+    def testAdaptiveTX(self):
+        from .linkquality import LinkQualityTable
+        from .test_linkquality import ax25
+        links = LinkQualityTable()
+        links.heard(modem.Packet(ax25("N0CALL", "VK4ABC"), header=255, mode="DATAC1", snr=15))
+        links.heard(modem.Packet(ax25("N0CALL", "VK4XYZ"), header=255, mode="DATAC4", snr=-3))
+        tx = modem.FreeDVTX(modem="DATAC3", links=links, adaptive=True)
+        queue = [
+            modem.Packet(ax25("VK4ABC", "N0CALL", bytes(256))),
+            modem.Packet(ax25("VK4XYZ", "N0CALL", bytes(256))),
+            modem.Packet(b"\x00not ax25"),
+            modem.Packet(ax25("VK4ABC", "N0CALL", bytes(256))),
+        ]
+        plan = {tx_modem.modem_name: len(packets) for tx_modem, packets in tx.plan(queue)}
+        self.assertEqual(plan, {"DATAC1": 2, "DATAC4": 1, "DATAC3": 1})
+        self.assertEqual(queue, [])
+        tx.close()
+
+    def testArqTX(self):
+        from .arq import ArqSender
+        tx = modem.FreeDVTX(modem="DATAC3", arq=ArqSender())
+        audio = list(tx.write_stream([modem.Packet(b"a"*1000), modem.Packet(b"b"*10)]))
+        packet_id, (mode, frames) = next(iter(tx.arq.cache.items()))
+        self.assertEqual(mode, "DATAC3")
+        self.assertEqual(len(audio), len(frames) + 2) # ARQ frames, the small packet and silence
+        self.assertEqual(audio[:len(frames)], [tx.modem.burst_from_audio([x]) for x in frames])
+
+        tx.arq.nack(packet_id + bytes([0b100]))
+        self.assertTrue(tx.pending)
+        self.assertAlmostEqual(tx.pending_seconds, 2 * tx.modem.frame_seconds) # the start frame and frame 2
+        resend = list(tx.write_stream([]))
+        self.assertEqual(resend[:2], [tx.modem.burst_from_audio([frames[0]]), tx.modem.burst_from_audio([frames[2]])])
+        self.assertFalse(tx.pending)
+        tx.close()
+
+    def testMultiFrameBurst(self):
+        tx = modem.FreeDVTX(modem="DATAC3", frames_per_burst=4)
+        callback = Mock()
+        rx = modem.FreeDVRX(callback, progress=Mock(), inhibit=Mock(), modes=["DATAC3"], frames_per_burst=4)
+        packets = [modem.Packet(b"a"*500), modem.Packet(b"b"*10)]
+        frames = tx.modem.pack(list(packets))
+        audio = tx.write(list(packets))
+        self.assertEqual(len(audio), tx.modem.burst_bytes * -(-len(frames) // 4) + tx.modem.silence_bytes)
+        rx.write(audio)
+        self.assertEqual([x[0][0].data for x in callback.call_args_list], [b"a"*500, b"b"*10])
+        self.assertLess(tx.modem.frame_seconds, modem.Modem(modem.Modems.DATAC3).frame_seconds)
+        tx.close()
+        rx.close()
+
+    def testResamplerLoopback(self):
+        from . import dsp
+        import numpy as np
+        audio = modem.FreeDVTX().write([modem.Packet(bytes(range(200)))]*5)
+        interference = None
+        snrs = {}
+        for resampler in dsp.RESAMPLERS:
+            device = np.frombuffer(dsp.OutputDSP(1, 8000, 48000, resampler=resampler).process(audio), dtype=np.int16)
+            if interference is None: # a strong signal at 7kHz - aliases to 1kHz without filtering
+                interference = (4000 * np.sin(2 * np.pi * 7000 * np.arange(len(device)) / 48000)).astype(np.int16)
+            device = (device + interference).tobytes()
+            callback = Mock()
+            rx = modem.FreeDVRX(callback, progress=Mock(), inhibit=Mock(), modes=["DATAC1"])
+            input_dsp = dsp.InputDSP(1, 48000, 8000, resampler=resampler)
+            for offset in range(0, len(device), 8192):
+                rx.write(input_dsp.process(device[offset:offset+8192]))
+            rx.close()
+            snrs[resampler] = [x[0][0].snr for x in callback.call_args_list]
+        self.assertEqual(len(snrs["polyphase"]), 5)
+        self.assertGreater(sum(snrs["polyphase"]) / 5, sum(snrs["linear"]) / max(len(snrs["linear"]), 1))
+
+    def testFecTX(self):
+        tx_modem = modem.Modem(modem.Modems.DATAC3, fec_repair=0.5)
+        frames = tx_modem.pack([modem.Packet(b"a"*1000), modem.Packet(b"b"*10)])
+        fec_frames = [x for x in frames if x[0] == 0xfa]
+        self.assertEqual(len(frames) - len(fec_frames), 1)
+        self.assertEqual(len(fec_frames), 9 + 5)
+
+        received = []
+        reassembler = modem.Reassembler(received.append)
+        for frame in frames[:1] + fec_frames[3:]: # lose 3 data frames
+            reassembler.feed(bytes(frame[:-2]), "DATAC3")
+        self.assertEqual([x.data for x in received], [b"b"*10, b"a"*1000])
+        tx_modem.close()
+
+    @unittest.skipUnless(hasattr(os, "mkfifo"), "needs FIFOs")
+    def testTwoTNCsThroughPipes(self):
+        from . import audio
+        with tempfile.TemporaryDirectory() as directory:
+            a_to_b, b_to_a = os.path.join(directory, "a_to_b"), os.path.join(directory, "b_to_a")
+            os.mkfifo(a_to_b)
+            os.mkfifo(b_to_a)
+            received = {"a": [], "b": []}
+            tncs = {}
+            for name, tx_path, rx_path in (("a", a_to_b, b_to_a), ("b", b_to_a, a_to_b)):
+                tx = modem.FreeDVTX(modem="DATAC3")
+                rx = modem.FreeDVRX(received[name].append, progress=Mock(), inhibit=Mock(), modes=["DATAC3"])
+                # free running - each TNC's input is only read as fast as it can demodulate
+                output_device = audio.OutputDevice(rx.sample_rate, tx, name_or_id=f"file:{tx_path}?pace=fast", frames_per_buffer=1024)
+                input_device = audio.InputDevice(rx.write, rx.sample_rate, name_or_id=f"file:{rx_path}?pace=fast", frames_per_buffer=1024)
+                tncs[name] = (tx, rx, input_device, output_device)
+
+            for sender, receiver in (("a", "b"), ("b", "a")):
+                tncs[sender][3].write(modem.Packet(f"hello {receiver}".encode()))
+                deadline = time.monotonic() + 60
+                while not received[receiver] and time.monotonic() < deadline:
+                    time.sleep(0.1)
+
+            for tx, rx, input_device, output_device in tncs.values():
+                output_device.close() # the other TNC's input ends once its writer closes
+            for tx, rx, input_device, output_device in tncs.values():
+                input_device.close()
+                rx.close()
+                tx.close()
+        self.assertEqual([x.data for x in received["b"]], [b"hello b"])
+        self.assertEqual([x.data for x in received["a"]], [b"hello a"])
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
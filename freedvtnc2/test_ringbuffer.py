@@ -0,0 +1,32 @@
+import unittest
+from .ringbuffer import RingBuffer
+
+class TestRingBuffer(unittest.TestCase):
+    def test_wrap_around(self):
+        ring = RingBuffer(8)
+        self.assertEqual(ring.write(b"abcdef"), 6)
+        self.assertEqual(ring.read(4), b"abcd")
+        self.assertEqual(ring.write(b"ghijkl"), 6) # wraps past the end of the buffer
+        self.assertEqual(len(ring), 8)
+        self.assertEqual(ring.read(), b"efghijkl")
+        self.assertEqual(ring.overruns, 0)
+
+    def test_overrun(self):
+        ring = RingBuffer(4)
+        self.assertEqual(ring.write(b"abcdef"), 4)
+        self.assertEqual(ring.overruns, 1)
+        self.assertEqual(ring.dropped_bytes, 2)
+        self.assertEqual(ring.write(b"gh", partial=False), 0)
+        self.assertEqual(ring.dropped_bytes, 4)
+        self.assertEqual(ring.read(), b"abcd")
+
+    def test_read_into(self):
+        ring = RingBuffer(4)
+        ring.write(b"ab")
+        out = bytearray(4)
+        self.assertEqual(ring.read_into(out), 2)
+        self.assertEqual(out, b"ab\x00\x00")
+        self.assertFalse(ring.wait(0))
+
+if __name__ == '__main__':
+    unittest.main()
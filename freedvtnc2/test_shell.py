@@ -0,0 +1,27 @@
+import unittest
+from unittest.mock import Mock
+from . import audio
+from . import shell
+
+class TestShellCommands(unittest.TestCase):
+    def setUp(self):
+        tuner = Mock(frames_per_buffer=512, auto=True)
+        self.input_device = Mock(tuner=tuner, stream_latency=0.02, latency=audio.Latency(), overruns=1)
+        self.output_device = Mock(
+            tuner=tuner, stream_latency=0.03, latency=audio.Latency(), queue_ms=0, ring=Mock(capacity=16000), bytes_per_ms=16,
+            underruns=2, late_callbacks=3, chained_batches=4
+        )
+        self.commands = shell.FreeDVShellCommands(Mock(), Mock(), self.output_device, self.input_device, Mock(), Mock())
+
+    def test_audio(self):
+        self.input_device.latency.add(40)
+        self.output_device.latency.add(250)
+        output = self.commands.do_audio("")
+        self.assertRegex(output, r"input to demod ms\s+40 \(avg 40, max 40\)")
+        self.assertRegex(output, r"input stream latency ms\s+20")
+        self.assertRegex(output, r"queue to air ms\s+250")
+        self.assertRegex(output, r"output underruns\s+2")
+        self.assertRegex(output, r"output late callbacks\s+3")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import unittest
+from . import txqueue
+from .framing import Packet
+
+def ax25(control: int, info: bytes = b"") -> Packet:
+    address = bytes(x << 1 for x in b"N0CALL") + b"\x60" + bytes(x << 1 for x in b"N1CALL") + b"\x61"
+    return Packet(address + bytes([control]) + info)
+
+class TestClassify(unittest.TestCase):
+    def test_classes(self):
+        self.assertEqual(txqueue.classify(ax25(0x01)), txqueue.CONTROL) # RR
+        self.assertEqual(txqueue.classify(ax25(0x3f)), txqueue.CONTROL) # SABM
+        self.assertEqual(txqueue.classify(ax25(0x03, b"\xf0hello")), txqueue.BULK) # UI
+        self.assertEqual(txqueue.classify(ax25(0x00, b"\xf0data")), txqueue.BULK) # I frame
+        self.assertEqual(txqueue.classify(Packet(b"me\xffhi", header=b"\xfe")), txqueue.CHAT)
+        self.assertEqual(txqueue.classify(Packet(b"\x00\x01\x02", header=0xfd)), txqueue.CONTROL)
+        self.assertEqual(txqueue.classify(Packet(b"not ax25")), txqueue.BULK)
+
+class TestTxQueue(unittest.TestCase):
+    def test_priority(self):
+        queue = txqueue.TxQueue()
+        bulk = ax25(0x00, b"a"*100)
+        chat = Packet(b"me\xffhi", header=b"\xfe")
+        ack = ax25(0x01)
+        for packet in (bulk, chat, ack):
+            queue.put(packet)
+        self.assertEqual(queue.depths(), {"control": 1, "chat": 1, "bulk": 1})
+        self.assertEqual(queue.take(), [ack, chat, bulk])
+        self.assertEqual(len(queue), 0)
+
+    def test_bulk_batches(self):
+        queue = txqueue.TxQueue(airtime=lambda packet: 10, batch_seconds=25)
+        bulk = [ax25(0x00, bytes([x])) for x in range(5)]
+        for packet in bulk:
+            queue.put(packet)
+        self.assertEqual(queue.take(), bulk[:3])
+        ack = ax25(0x01)
+        queue.put(ack)
+        self.assertEqual(queue.take(), [ack] + bulk[3:])
+
+    def test_take_max_seconds(self):
+        queue = txqueue.TxQueue(airtime=lambda packet: 10, batch_seconds=25)
+        bulk = [ax25(0x00, bytes([x])) for x in range(3)]
+        for packet in bulk:
+            queue.put(packet)
+        self.assertEqual(queue.take(max_seconds=5, at_least_one=False), []) # nothing fits in what's left of the transmission
+        ack = ax25(0x01)
+        queue.put(ack)
+        self.assertEqual(queue.take(max_seconds=15, at_least_one=False), [ack]) # control packets count against it too
+        self.assertEqual(queue.take(max_seconds=100, at_least_one=False), bulk)
+
+    def test_take_max_seconds_all_classes(self):
+        queue = txqueue.TxQueue(airtime=lambda packet: 10)
+        acks = [ax25(0x01) for x in range(3)]
+        chat = Packet(b"me\xffhi", header=b"\xfe")
+        bulk = ax25(0x00, b"a")
+        for packet in acks + [chat, bulk]:
+            queue.put(packet)
+        self.assertEqual(queue.take(max_seconds=25), acks[:2])
+        self.assertEqual(queue.take(max_seconds=25), [acks[2], chat])
+        self.assertEqual(queue.take(max_seconds=25), [bulk])
+
+    def test_take_at_least_one(self):
+        queue = txqueue.TxQueue(airtime=lambda packet: 100)
+        bulk = [ax25(0x00, bytes([x])) for x in range(2)]
+        for packet in bulk:
+            queue.put(packet)
+        # a packet longer than the transmission still goes out on its own
+        self.assertEqual(queue.take(max_seconds=60), bulk[:1])
+        self.assertEqual(queue.take(max_seconds=60, at_least_one=False), [])
+
+    def test_drop_oldest(self):
+        limits = txqueue.default_limits()
+        limits[txqueue.CONTROL].max_packets = 2
+        queue = txqueue.TxQueue(limits=limits)
+        acks = [ax25(0x01 | x << 5) for x in range(3)]
+        for packet in acks:
+            self.assertTrue(queue.put(packet))
+        self.assertEqual(queue.waiting, 2)
+        self.assertEqual(queue.take(), acks[1:])
+        self.assertEqual(queue.waiting, 0)
+        self.assertEqual(queue.rows()[0]["dropped"], 1)
+
+    def test_drop_newest(self):
+        limits = txqueue.default_limits()
+        limits[txqueue.CHAT].max_bytes = 10
+        queue = txqueue.TxQueue(limits=limits)
+        self.assertTrue(queue.put(Packet(b"a"*8, header=b"\xfe")))
+        self.assertFalse(queue.put(Packet(b"b"*8, header=b"\xfe")))
+        self.assertEqual(queue.depths()["chat"], 1)
+        self.assertEqual(queue.waiting, 1)
+
+    def test_block(self):
+        limits = txqueue.default_limits()
+        limits[txqueue.BULK].max_seconds = 15
+        now = [0]
+        def clock():
+            now[0] += 1
+            return now[0]
+        queue = txqueue.TxQueue(airtime=lambda packet: 10, limits=limits, block_seconds=0.5, clock=clock)
+        self.assertTrue(queue.put(ax25(0x00, b"a"))) # an oversized packet is accepted into an empty queue
+        self.assertFalse(queue.put(ax25(0x00, b"b"))) # waits block_seconds then gives up
+        queue.take()
+        self.assertTrue(queue.put(ax25(0x00, b"c")))
+        queue.take()
+        self.assertEqual(queue.oldest_taken, now[0]) # the time c was queued
+
+    def test_clear(self):
+        queue = txqueue.TxQueue()
+        queue.put(ax25(0x00, b"a"*100))
+        queue.clear()
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(queue.waiting, 0)
+        self.assertEqual(queue.rows()[2]["bytes"], 0)
+
+if __name__ == '__main__':
+    unittest.main()
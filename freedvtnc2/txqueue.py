@@ -0,0 +1,200 @@
+"""
+Priority TX queue.
+
+Packets are split into classes that are sent in priority order - control (AX.25 supervisory frames like RR/REJ, link
+setup and ARQ NACKs), chat and bulk (everything else). Each class has its own limits on packets, bytes and estimated
+airtime and its own policy for when it's full:
+
+ - drop_oldest - the oldest packet in the class is dropped. ACKs supersede each other so the newest is worth more
+ - drop_newest - the new packet is dropped
+ - block - the writer waits for room (up to block_seconds) then the new packet is dropped. KISS clients are read on
+   a single thread so this pushes back on them through TCP flow control rather than us buffering without limit
+"""
+from collections import deque
+from dataclasses import dataclass, field
+from threading import Condition
+from typing import Callable
+import logging
+import time
+from .framing import Packet, header_bytes, ARQ_NACK_HEADER
+
+CONTROL = "control"
+CHAT = "chat"
+BULK = "bulk"
+CLASSES = [CONTROL, CHAT, BULK] # in priority order
+POLICIES = ["drop_oldest", "drop_newest", "block"]
+
+def ax25_control(data: bytes) -> int|None:
+    """
+    The AX.25 control byte - the address field ends at the first byte with bit 0 set. None if there isn't one
+    """
+    for offset in range(6, min(len(data), 70), 7):
+        if data[offset] & 1:
+            return data[offset + 1] if offset + 1 < len(data) else None
+    return None
+
+def classify(packet: Packet) -> str:
+    header = header_bytes(packet)[0]
+    if header == ARQ_NACK_HEADER:
+        return CONTROL
+    if header == 0xfe:
+        return CHAT
+    if header == 0xff:
+        control = ax25_control(packet.data)
+        # S frames (RR, RNR, REJ, SREJ) and U frames other than UI (SABM, DISC, UA, DM...) are link control
+        if control is not None and control & 1 and control & 0xef != 0x03:
+            return CONTROL
+    return BULK
+
+@dataclass
+class ClassLimit():
+    max_packets: int
+    max_bytes: int
+    max_seconds: float # estimated airtime
+    policy: str = "drop_newest"
+
+@dataclass
+class ClassQueue():
+    limit: ClassLimit
+    packets: deque[tuple[Packet, float, float]] = field(default_factory=deque) # (packet, airtime, time queued)
+    bytes: int = 0
+    seconds: float = 0
+    dropped: int = 0
+
+    def fits(self, size: int, seconds: float) -> bool:
+        if not self.packets: # a packet bigger than the limits can still be sent on its own
+            return True
+        return (
+            len(self.packets) < self.limit.max_packets and
+            self.bytes + size <= self.limit.max_bytes and
+            self.seconds + seconds <= self.limit.max_seconds
+        )
+
+    def append(self, packet: Packet, seconds: float, queued: float):
+        self.packets.append((packet, seconds, queued))
+        self.bytes += len(packet.data)
+        self.seconds += seconds
+
+    def popleft(self) -> tuple[Packet, float, float]:
+        packet, seconds, queued = self.packets.popleft()
+        self.bytes -= len(packet.data)
+        self.seconds -= seconds
+        return packet, seconds, queued
+
+def default_limits() -> dict[str, ClassLimit]:
+    return {
+        CONTROL: ClassLimit(max_packets=64, max_bytes=16*1024, max_seconds=60, policy="drop_oldest"),
+        CHAT: ClassLimit(max_packets=32, max_bytes=32*1024, max_seconds=120, policy="drop_newest"),
+        BULK: ClassLimit(max_packets=1024, max_bytes=1024*1024, max_seconds=600, policy="block"),
+    }
+
+class TxQueue():
+    """
+    Packets waiting to be modulated. airtime estimates how long a packet takes to send, used for the airtime limits
+    and for splitting bulk traffic into transmissions so higher priority packets never wait behind more than
+    batch_seconds of it.
+    """
+    def __init__(self, airtime: Callable[[Packet], float] = lambda packet: 0, limits: dict[str, ClassLimit]|None = None,
+                 batch_seconds: float = 30, block_seconds: float = 30, clock: Callable[[], float] = time.monotonic):
+        self.airtime = airtime
+        self.limits = limits or default_limits()
+        self.batch_seconds = batch_seconds
+        self.block_seconds = block_seconds
+        self.clock = clock
+        self.queues = {x: ClassQueue(self.limits[x]) for x in CLASSES}
+        self.condition = Condition()
+        self.oldest_taken: float|None = None # when the oldest packet from the last take() was queued, from clock
+        # packets queued, only changed under condition. A plain int so the audio callback can check it without a lock
+        self.waiting = 0
+
+    def __len__(self) -> int:
+        with self.condition:
+            return sum(len(x.packets) for x in self.queues.values())
+
+    def put(self, packet: Packet) -> bool:
+        """
+        Queues packet. Returns False if it was dropped.
+        """
+        name = classify(packet)
+        seconds = self.airtime(packet)
+        size = len(packet.data)
+        with self.condition:
+            queue = self.queues[name]
+            policy = queue.limit.policy
+            if policy == "drop_oldest":
+                while not queue.fits(size, seconds):
+                    queue.popleft()
+                    queue.dropped += 1
+                    self.waiting -= 1
+                    logging.warning(f"TX queue full - dropped the oldest {name} packet")
+            elif policy == "block":
+                deadline = self.clock() + self.block_seconds
+                while not queue.fits(size, seconds) and self.clock() < deadline:
+                    self.condition.wait(max(deadline - self.clock(), 0))
+            if not queue.fits(size, seconds):
+                queue.dropped += 1
+                logging.warning(f"TX queue full - dropped a {size} byte {name} packet")
+                return False
+            queue.append(packet, seconds, self.clock())
+            self.waiting += 1
+            return True
+
+    def take(self, max_seconds: float|None = None, at_least_one: bool = True) -> list[Packet]:
+        """
+        Removes the packets for the next transmission - control and chat packets, then bulk packets up to
+        batch_seconds of airtime.
+
+        max_seconds caps the airtime of everything taken, whatever its class - packets are only taken while they fit
+        and the rest wait in order for the next transmission. at_least_one takes the first packet even if it doesn't
+        fit so a packet longer than max_seconds still goes out on its own. Adding to a transmission that's already
+        going passes False.
+        """
+        packets = []
+        oldest = None
+        remaining = float("inf") if max_seconds is None else max_seconds
+        with self.condition:
+            for name in CLASSES:
+                queue = self.queues[name]
+                batch = self.batch_seconds if name == BULK else float("inf")
+                while queue.packets:
+                    seconds = queue.packets[0][1]
+                    if (packets or not at_least_one) and (seconds > remaining or batch <= 0):
+                        break
+                    packet, seconds, queued = queue.popleft()
+                    packets.append(packet)
+                    oldest = queued if oldest is None else min(oldest, queued)
+                    remaining -= seconds
+                    batch -= seconds
+                if queue.packets and remaining < queue.packets[0][1]: # lower priority packets don't jump the queue
+                    break
+            self.oldest_taken = oldest
+            self.waiting -= len(packets)
+            self.condition.notify_all()
+        return packets
+
+    def clear(self):
+        with self.condition:
+            for queue in self.queues.values():
+                queue.packets.clear()
+                queue.bytes = 0
+                queue.seconds = 0
+            self.waiting = 0
+            self.condition.notify_all()
+
+    def depths(self) -> dict[str, int]:
+        with self.condition:
+            return {name: len(queue.packets) for name, queue in self.queues.items()}
+
+    def rows(self) -> list[dict]:
+        with self.condition:
+            return [
+                {
+                    "class": name,
+                    "packets": len(queue.packets),
+                    "bytes": queue.bytes,
+                    "airtime s": round(queue.seconds, 1),
+                    "dropped": queue.dropped,
+                    "policy": queue.limit.policy,
+                }
+                for name, queue in self.queues.items()
+            ]